@@ -0,0 +1,79 @@
+'''
+    Microbenchmark for the ImpersonateConfig settings snapshot.
+
+    Compares reading the IMPERSONATE_* settings used on a typical request
+    straight from django.conf.settings (as the helpers used to) with
+    reading them from the snapshot. Run from the repo checkout:
+
+        $ python benchmarks/config_snapshot.py
+'''
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+settings.configure(
+    INSTALLED_APPS=(
+        'django.contrib.auth',
+        'django.contrib.contenttypes',
+        'impersonate',
+    ),
+    IMPERSONATE_REDIRECT_FIELD_NAME='next',
+    IMPERSONATE_ALLOW_SUPERUSER=True,
+)
+django.setup()
+
+from impersonate.config import get_config  # noqa: E402
+
+NUMBER = 200000
+
+
+def read_settings():
+    # The settings read while serving an impersonated request and
+    # rendering the list view before the snapshot existed.
+    getattr(settings, 'IMPERSONATE_REQUIRE_SUPERUSER', False)
+    getattr(settings, 'IMPERSONATE_ALLOW_SUPERUSER', False)
+    hasattr(settings, 'IMPERSONATE_CUSTOM_ALLOW')
+    hasattr(settings, 'IMPERSONATE_CUSTOM_USER_QUERYSET')
+    getattr(settings, 'IMPERSONATE_URI_EXCLUSIONS', (r'^admin/',))
+    getattr(settings, 'IMPERSONATE_REDIRECT_FIELD_NAME', None)
+    getattr(settings, 'IMPERSONATE_REDIRECT_FIELD_NAME', None)
+    int(getattr(settings, 'IMPERSONATE_PAGINATE_COUNT', 20))
+
+
+def read_snapshot():
+    config = get_config()
+    config.require_superuser
+    config.allow_superuser
+    config.custom_allow
+    config.custom_user_queryset
+    config.uri_exclusions
+    config.redirect_field_name
+    config.redirect_field_name
+    config.paginate_count
+
+
+def main():
+    results = {}
+    for func in (read_settings, read_snapshot):
+        best = min(timeit.repeat(func, number=NUMBER, repeat=5))
+        results[func.__name__] = best / NUMBER * 1e9
+        print('{0:<15} {1:8.1f} ns/request'.format(
+            func.__name__,
+            results[func.__name__],
+        ))
+
+    saved = results['read_settings'] - results['read_snapshot']
+    print('{0:<15} {1:8.1f} ns/request ({2:.1f}x)'.format(
+        'saved',
+        saved,
+        results['read_settings'] / results['read_snapshot'],
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,370 @@
+'''
+    Benchmarks for the middleware and helper hot paths.
+
+    Builds a SQLite database with a generated user table, times each
+    case and writes the results (with the number of queries each call
+    makes) as JSON, so runs of different versions can be compared. Run
+    from the repo checkout:
+
+        $ python benchmarks/hot_paths.py --users 50000 --output before.json
+        ... change things ...
+        $ python benchmarks/hot_paths.py --users 50000 --compare before.json
+
+    The database is in memory unless --database is given. Sessions are
+    plain dicts, so session backend queries are not counted.
+'''
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+FIRST_NAMES = ('John', 'Jane', 'Maria', 'Ahmed', 'Wei', 'Olga', 'Pedro')
+LAST_NAMES = ('Smith', 'Doe', 'Garcia', 'Khan', 'Chen', 'Ivanova', 'Silva')
+SEARCH_TERMS = ('john', 'smith', 'user1', 'example', 'com')
+
+
+def configure(database):
+    settings.configure(
+        DEBUG=False,
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': database,
+            },
+        },
+        INSTALLED_APPS=(
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'django.contrib.sessions',
+            'impersonate',
+        ),
+        PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+        USE_TZ=True,
+        SECRET_KEY='benchmarks',
+        ROOT_URLCONF='impersonate.urls',
+        IMPERSONATE_DISABLE_LOGGING=True,
+    )
+    django.setup()
+
+
+def create_users(count):
+    from django.contrib.auth import get_user_model
+
+    User = get_user_model()
+    if User.objects.count() >= count + 1:
+        return User.objects.get(username='impersonator')
+
+    User.objects.all().delete()
+    superuser = User.objects.create(
+        username='impersonator',
+        email='impersonator@example.com',
+        is_superuser=True,
+        is_staff=True,
+    )
+    batch = []
+    for i in range(count):
+        batch.append(User(
+            username='user{0}'.format(i),
+            first_name=FIRST_NAMES[i % len(FIRST_NAMES)],
+            last_name=LAST_NAMES[(i // len(FIRST_NAMES)) % len(LAST_NAMES)],
+            email='user{0}@example.com'.format(i),
+            is_staff=(i % 10 == 0),
+        ))
+        if len(batch) == 5000:
+            User.objects.bulk_create(batch)
+            batch = []
+    User.objects.bulk_create(batch)
+    return superuser
+
+
+def with_settings(**overrides):
+    ''' Settings a case runs with, applied once around all its runs.
+    '''
+    def decorator(func):
+        func.settings = overrides
+        return func
+    return decorator
+
+
+class Cases(object):
+    ''' Every run_* method is a benchmark case, taking no arguments.
+    '''
+    def __init__(self, superuser, user_count):
+        from django.contrib.auth import get_user_model
+        from django.test import RequestFactory
+
+        from impersonate.middleware import ImpersonateMiddleware
+
+        User = get_user_model()
+        self.User = User
+        self.superuser = superuser
+        self.target = User.objects.filter(is_superuser=False).order_by('pk')[
+            user_count // 2
+        ]
+        self.factory = RequestFactory()
+        self.middleware = ImpersonateMiddleware(lambda request: None)
+        self.uri_counter = 0
+
+    def request(self, path='/', user=None, session=None, **get):
+        request = self.factory.get(path, get)
+        request.user = user if user is not None else self.superuser
+        request.session = session if session is not None else {}
+        return request
+
+    def lazy_request(self, path='/', session=None):
+        from django.utils.functional import SimpleLazyObject
+
+        User = self.User
+        pk = self.superuser.pk
+        request = self.factory.get(path)
+        request.user = SimpleLazyObject(lambda: User.objects.get(pk=pk))
+        request.session = session if session is not None else {}
+        return request
+
+    # ImpersonateMiddleware.process_request
+
+    def run_middleware_lazy_untouched(self):
+        request = self.lazy_request(session={'_impersonate': self.target.pk})
+        self.middleware.process_request(request)
+
+    def run_middleware_not_impersonating(self):
+        request = self.request()
+        self.middleware.process_request(request)
+
+    def run_middleware_impersonating(self):
+        request = self.request(session={'_impersonate': self.target.pk})
+        self.middleware.process_request(request)
+        assert request.user.is_impersonate
+
+    def run_middleware_excluded_uri(self):
+        request = self.request(
+            '/admin/auth/user/',
+            session={'_impersonate': self.target.pk},
+        )
+        self.middleware.process_request(request)
+        assert not request.user.is_impersonate
+
+    # helpers
+
+    def run_check_allow_for_user(self):
+        from impersonate.helpers import check_allow_for_user
+
+        request = self.request()
+        request.user.is_impersonate = False
+        assert check_allow_for_user(request, self.target)
+
+    def run_check_allow_for_uri(self):
+        from impersonate.helpers import check_allow_for_uri
+
+        check_allow_for_uri('/accounts/profile/')
+
+    def run_check_allow_for_uri_uncached(self):
+        from impersonate.helpers import check_allow_for_uri
+
+        self.uri_counter += 1
+        check_allow_for_uri('/accounts/{0}/profile/'.format(self.uri_counter))
+
+    @with_settings(IMPERSONATE_UID_CACHE_TIMEOUT=0)
+    def run_resolve_uid_email(self):
+        from impersonate.resolvers import resolve_uid
+
+        assert resolve_uid(self.target.email) == self.target
+
+    def run_resolve_uid_email_cached(self):
+        from impersonate.resolvers import resolve_uid
+
+        assert resolve_uid(self.target.email) == self.target
+
+    def search(self, terms):
+        from impersonate.contexts import get_search_template_context
+
+        request = self.request()
+        request.user.is_impersonate = False
+        context = get_search_template_context(
+            request,
+            u' '.join(SEARCH_TERMS[:terms]),
+        )
+        list(context['page'])
+
+    def run_search_1_term(self):
+        self.search(1)
+
+    def run_search_2_terms(self):
+        self.search(2)
+
+    def run_search_3_terms(self):
+        self.search(3)
+
+    def run_search_4_terms(self):
+        self.search(4)
+
+    def run_search_5_terms(self):
+        self.search(5)
+
+    def deep_page(self, **get):
+        from impersonate.helpers import get_paginator
+
+        request = self.request(**get)
+        paginator, page, page_number = get_paginator(
+            request,
+            self.User.objects.order_by('pk'),
+        )
+        list(page)
+
+    def run_paginator_deep_page(self):
+        self.deep_page(page=self.last_page)
+
+    @with_settings(IMPERSONATE_PAGINATION='countless')
+    def run_paginator_deep_page_countless(self):
+        self.deep_page(page=self.last_page)
+
+    @with_settings(IMPERSONATE_PAGINATION='cursor')
+    def run_paginator_deep_page_cursor(self):
+        self.deep_page(cursor=self.last_cursor)
+
+    def setup_pagination(self):
+        from impersonate.config import get_config
+        from impersonate.pagination import NEXT, CursorPaginator
+
+        per_page = get_config().paginate_count
+        count = self.User.objects.count()
+        self.last_page = max(1, (count - 1) // per_page)
+        last = self.User.objects.order_by('pk')[
+            max(0, (self.last_page - 1) * per_page - 1)
+        ]
+        self.last_cursor = CursorPaginator(
+            self.User.objects.all(),
+            per_page,
+        ).encode_cursor(last, NEXT)
+
+    def names(self):
+        return sorted(
+            name[len('run_'):] for name in dir(self)
+            if name.startswith('run_')
+        )
+
+
+def count_queries(func):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    with CaptureQueriesContext(connection) as queries:
+        func()
+    return len(queries)
+
+
+def time_case(func, repeat):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = timer.repeat(repeat=repeat, number=number)
+    per_call = [t / number * 1e6 for t in times]
+    return {
+        'best_us': round(min(per_call), 3),
+        'mean_us': round(sum(per_call) / len(per_call), 3),
+        'calls': number * repeat,
+    }
+
+
+def run(cases, names, repeat):
+    from django.test.utils import override_settings
+
+    results = {}
+    for name in names:
+        func = getattr(cases, 'run_' + name)
+        with override_settings(**getattr(func, 'settings', {})):
+            func()  # warm up caches, e.g. the compiled URI exclusions
+            result = time_case(func, repeat)
+            result['queries'] = count_queries(func)
+        results[name] = result
+        print('{0:<36} {1:12.2f} us {2:3d} queries'.format(
+            name,
+            result['best_us'],
+            result['queries'],
+        ))
+    return results
+
+
+def compare(results, previous):
+    print('\n{0:<36} {1:>12} {2:>12} {3:>8}'.format(
+        'case', 'before', 'after', 'change',
+    ))
+    for name, result in sorted(results.items()):
+        if name not in previous:
+            continue
+        before = previous[name]['best_us']
+        after = result['best_us']
+        queries = ''
+        if previous[name]['queries'] != result['queries']:
+            queries = ' (queries {0} -> {1})'.format(
+                previous[name]['queries'],
+                result['queries'],
+            )
+        print('{0:<36} {1:12.2f} {2:12.2f} {3:+7.1f}%{4}'.format(
+            name,
+            before,
+            after,
+            (after - before) / before * 100 if before else 0,
+            queries,
+        ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=10000,
+                        help='number of generated users (default 10000)')
+    parser.add_argument('--database', default=':memory:',
+                        help='SQLite file, reused if it has enough users')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timing runs per case (default 5)')
+    parser.add_argument('--output',
+                        help='write the results to this JSON file')
+    parser.add_argument('--compare',
+                        help='JSON file from an earlier run to compare with')
+    parser.add_argument('cases', nargs='*',
+                        help='run only these cases (default all)')
+    args = parser.parse_args(argv)
+
+    configure(args.database)
+
+    from django.core.management import call_command
+
+    import impersonate
+
+    call_command('migrate', verbosity=0, interactive=False)
+    superuser = create_users(args.users)
+
+    cases = Cases(superuser, args.users)
+    cases.setup_pagination()
+    names = args.cases or cases.names()
+
+    results = run(cases, names, args.repeat)
+    report = {
+        'meta': {
+            'impersonate': impersonate.get_version(),
+            'django': django.get_version(),
+            'python': platform.python_version(),
+            'users': args.users,
+            'repeat': args.repeat,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(results, json.load(fp)['results'])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,7 @@
 VERSION = (0, 9, 2, 'beta', 4)
 
+default_app_config = 'impersonate.apps.ImpersonateAppConfig'
+
 
 # taken from django-registration
 
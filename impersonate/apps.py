@@ -0,0 +1,151 @@
+from django.apps import AppConfig
+from django.core import checks
+from django.core.signals import request_finished, setting_changed
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete, pre_save)
+
+
+class ImpersonateAppConfig(AppConfig):
+    name = 'impersonate'
+    verbose_name = 'Impersonate'
+    default_auto_field = 'django.db.models.AutoField'
+
+    def ready(self):
+        from .audit import flush_log_buffer
+        from .cache import (invalidate_session_decision,
+                            invalidate_user_decisions)
+        from .checks import (FUNCTION_SETTINGS, check_function_settings,
+                             check_uid_resolvers)
+        from .config import reset_config
+        from .dispatch import connect_internal
+        from .exclusions import get_uri_matcher, reset_uri_matcher
+        from .helpers import User, get_setting_func, reset_setting_funcs
+        from .instrumentation import reset_instrumentation
+        from .permissions import (refresh_group_members,
+                                  refresh_group_permissions,
+                                  refresh_user_permissions,
+                                  remember_group_members,
+                                  remember_user_fields)
+        from .signals import session_end
+
+        post_save.connect(
+            invalidate_user_decisions,
+            sender=User,
+            dispatch_uid='impersonate.cache.user_saved',
+        )
+        post_delete.connect(
+            invalidate_user_decisions,
+            sender=User,
+            dispatch_uid='impersonate.cache.user_deleted',
+        )
+        pre_save.connect(
+            remember_user_fields,
+            sender=User,
+            dispatch_uid='impersonate.permissions.user_saving',
+        )
+        post_save.connect(
+            refresh_user_permissions,
+            sender=User,
+            dispatch_uid='impersonate.permissions.user_saved',
+        )
+        groups = getattr(User, 'groups', None)
+        if groups is not None and hasattr(groups, 'through'):
+            m2m_changed.connect(
+                refresh_group_permissions,
+                sender=groups.through,
+                dispatch_uid='impersonate.permissions.groups_changed',
+            )
+            group_model = groups.field.related_model
+            pre_delete.connect(
+                remember_group_members,
+                sender=group_model,
+                dispatch_uid='impersonate.permissions.group_deleting',
+            )
+            post_delete.connect(
+                refresh_group_members,
+                sender=group_model,
+                dispatch_uid='impersonate.permissions.group_deleted',
+            )
+        self.connect_user_cache(User)
+        connect_internal(session_end, invalidate_session_decision)
+
+        request_finished.connect(
+            flush_log_buffer,
+            dispatch_uid='impersonate.audit.request_finished',
+        )
+
+        setting_changed.connect(
+            reset_config,
+            dispatch_uid='impersonate.config.setting_changed',
+        )
+        setting_changed.connect(
+            reset_uri_matcher,
+            dispatch_uid='impersonate.exclusions.setting_changed',
+        )
+        # Compile the URI exclusions now rather than on the first request
+        get_uri_matcher()
+
+        checks.register(check_function_settings)
+        checks.register(check_uid_resolvers, checks.Tags.models)
+        setting_changed.connect(
+            reset_setting_funcs,
+            dispatch_uid='impersonate.helpers.setting_changed',
+        )
+        setting_changed.connect(
+            reset_instrumentation,
+            dispatch_uid='impersonate.instrumentation.setting_changed',
+        )
+        # Import the custom functions now, broken paths are reported by
+        # check_function_settings instead
+        for setting_name, default in FUNCTION_SETTINGS:
+            try:
+                get_setting_func(setting_name, default)
+            except (ImportError, AttributeError, ValueError):
+                pass
+
+    def connect_user_cache(self, User):
+        ''' Invalidates the UserCache (IMPERSONATE_USER_CACHE_TIMEOUT) on
+            changes to users, their groups and permissions
+        '''
+        from .cache import (invalidate_user_cache, invalidate_user_cache_m2m,
+                            invalidate_user_caches)
+
+        post_save.connect(
+            invalidate_user_cache,
+            sender=User,
+            dispatch_uid='impersonate.cache.user_cache_saved',
+        )
+        post_delete.connect(
+            invalidate_user_cache,
+            sender=User,
+            dispatch_uid='impersonate.cache.user_cache_deleted',
+        )
+        for name in ('groups', 'user_permissions'):
+            related = getattr(User, name, None)
+            if related is not None and hasattr(related, 'through'):
+                m2m_changed.connect(
+                    invalidate_user_cache_m2m,
+                    sender=related.through,
+                    dispatch_uid='impersonate.cache.user_cache_' + name,
+                )
+
+        if not self.apps.is_installed('django.contrib.auth'):
+            return
+        from django.contrib.auth.models import Group, Permission
+
+        for model in (Group, Permission):
+            post_save.connect(
+                invalidate_user_caches,
+                sender=model,
+                dispatch_uid='impersonate.cache.saved_' + model.__name__,
+            )
+            post_delete.connect(
+                invalidate_user_caches,
+                sender=model,
+                dispatch_uid='impersonate.cache.deleted_' + model.__name__,
+            )
+        m2m_changed.connect(
+            invalidate_user_caches,
+            sender=Group.permissions.through,
+            dispatch_uid='impersonate.cache.user_caches_group_permissions',
+        )
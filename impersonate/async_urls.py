@@ -0,0 +1,26 @@
+from django.urls import re_path
+
+from .views import (aimpersonate, alist_users, asearch_users,
+                    astop_impersonate, search_users_json)
+
+
+# Drop-in replacement for impersonate.urls with the async views
+urlpatterns = [
+    re_path(r'^stop/$',
+        astop_impersonate,
+        name='impersonate-stop'),
+    re_path(r'^list/$',
+        alist_users,
+        {'template': 'impersonate/list_users.html'},
+        name='impersonate-list'),
+    re_path(r'^search/$',
+        asearch_users,
+        {'template': 'impersonate/search_users.html'},
+        name='impersonate-search'),
+    re_path(r'^search/json/$',
+        search_users_json,
+        name='impersonate-search-json'),
+    re_path(r'^(?P<uid>.+)/$',
+        aimpersonate,
+        name='impersonate-start'),
+]
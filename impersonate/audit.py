@@ -0,0 +1,189 @@
+import logging
+import threading
+import time
+
+from django.db import DatabaseError, router, transaction
+from django.utils import timezone
+
+from .config import get_config
+from .helpers import sync_to_async
+
+logger = logging.getLogger(__name__)
+
+_buffer = None
+
+
+class LogBuffer(object):
+    ''' Collects new ImpersonationLog rows in memory and writes them with
+        a single bulk_create().
+
+        The buffer is flushed when max_size rows are waiting, when a row
+        is added more than max_age seconds after the oldest waiting one,
+        and at the end of every request (see flush_log_buffer()), so the
+        INSERT happens after the response has been sent.
+    '''
+    def __init__(self, max_size=100, max_age=5):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.pending = []
+        self.oldest = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, log):
+        ''' Returns True if the buffer should be flushed now.
+        '''
+        now = time.monotonic()
+        with self.lock:
+            self.pending.append(log)
+            if self.oldest is None:
+                self.oldest = now
+            return (
+                len(self.pending) >= self.max_size or
+                now - self.oldest >= self.max_age
+            )
+
+    def end(self, impersonator_pk, session_key, ended_at):
+        ''' Sets session_ended_at on waiting rows of the session. Returns
+            True if there were any, in which case the rows in the database
+            need no update.
+        '''
+        found = False
+        with self.lock:
+            for log in self.pending:
+                if log.impersonator_id == impersonator_pk and \
+                   log.session_key == session_key and \
+                   log.session_ended_at is None:
+                    log.session_ended_at = ended_at
+                    found = True
+        return found
+
+    def take(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            self.oldest = None
+        return pending
+
+    def flush(self):
+        from .models import ImpersonationLog
+
+        pending = self.take()
+        if not pending:
+            return
+        try:
+            # The savepoint keeps a failed write from breaking the
+            # transaction of the request (ATOMIC_REQUESTS)
+            with transaction.atomic(
+                    using=router.db_for_write(ImpersonationLog)):
+                ImpersonationLog.objects.bulk_create(pending)
+        except DatabaseError:
+            # Never break the request over the audit log
+            logger.exception(
+                'Could not write %d impersonation log rows', len(pending),
+            )
+
+
+def get_log_buffer():
+    global _buffer
+
+    config = get_config()
+    buffer = _buffer
+    if buffer is None or \
+       buffer.max_size != config.log_buffer_size or \
+       buffer.max_age != config.log_buffer_timeout:
+        if buffer is not None:
+            buffer.flush()
+        buffer = _buffer = LogBuffer(
+            max_size=config.log_buffer_size,
+            max_age=config.log_buffer_timeout,
+        )
+    return buffer
+
+
+def flush_log_buffer(sender=None, **kwargs):
+    ''' request_finished receiver
+    '''
+    if _buffer is not None:
+        _buffer.flush()
+
+
+def _new_log(request, new_user):
+    from .models import ImpersonationLog
+
+    return ImpersonationLog(
+        impersonator_id=request.user.pk,
+        impersonating_id=new_user.pk,
+        session_key=request.session.session_key or '',
+        session_started_at=timezone.now(),
+    )
+
+
+def _end_filter(request, impersonator):
+    from .models import ImpersonationLog
+
+    return ImpersonationLog.objects.filter(
+        impersonator_id=impersonator.pk,
+        session_key=request.session.session_key or '',
+        session_ended_at__isnull=True,
+    )
+
+
+def _end_rows(request, impersonator, ended_at):
+    ''' Ends the written rows of impersonator's session, as flush() does
+        errors are logged rather than raised
+    '''
+    from .models import ImpersonationLog
+
+    try:
+        with transaction.atomic(using=router.db_for_write(ImpersonationLog)):
+            _end_filter(request, impersonator).update(
+                session_ended_at=ended_at,
+            )
+    except DatabaseError:
+        logger.exception('Could not end the impersonation log rows')
+
+
+def log_begin(request, new_user):
+    ''' Records that request.user started impersonating new_user
+    '''
+    if get_config().disable_logging:
+        return
+    buffer = get_log_buffer()
+    if buffer.add(_new_log(request, new_user)):
+        buffer.flush()
+
+
+def log_end(request, impersonator):
+    ''' Records the end of impersonator's session in this request's
+        session
+    '''
+    if get_config().disable_logging or impersonator is None:
+        return
+    now = timezone.now()
+    if not get_log_buffer().end(
+            impersonator.pk, request.session.session_key or '', now):
+        _end_rows(request, impersonator, now)
+
+
+async def alog_begin(request, new_user):
+    ''' Async version of log_begin()
+    '''
+    if get_config().disable_logging:
+        return
+    buffer = get_log_buffer()
+    if buffer.add(_new_log(request, new_user)):
+        await sync_to_async(buffer.flush)()
+
+
+async def alog_end(request, impersonator):
+    ''' Async version of log_end()
+    '''
+    if get_config().disable_logging or impersonator is None:
+        return
+    now = timezone.now()
+    if not get_log_buffer().end(
+            impersonator.pk, request.session.session_key or '', now):
+        # transaction.atomic() is sync only
+        await sync_to_async(_end_rows)(request, impersonator, now)
@@ -0,0 +1,333 @@
+import uuid
+
+from django.core.cache import caches
+
+from .config import get_config
+from .helpers import get_setting_func, sync_to_async
+
+
+class DecisionCache(object):
+    ''' Stores the outcome of check_allow_for_user() in the Django cache
+        framework, keyed on (impersonator pk, target pk, settings
+        fingerprint, see ImpersonateConfig).
+
+        Every user has a version token stored alongside the decisions.
+        Saving or deleting a user replaces that token, which orphans all
+        decisions involving that user without having to know their keys.
+    '''
+    key_prefix = 'impersonate:decision'
+
+    def __init__(self, alias='default', timeout=300):
+        self.alias = alias
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _version_key(self, user_pk):
+        return u'{0}:v:{1}'.format(self.key_prefix, user_pk)
+
+    def _get_versions(self, *user_pks):
+        keys = [self._version_key(pk) for pk in user_pks]
+        versions = self.cache.get_many(keys)
+        for key in keys:
+            if key not in versions:
+                # A missing token (never set, or evicted) must never
+                # resurrect decisions stored under an older token.
+                self.cache.add(key, uuid.uuid4().hex, None)
+                versions[key] = self.cache.get(key)
+        return [versions[key] for key in keys]
+
+    def _decision_key(self, impersonator_pk, target_pk):
+        impersonator_version, target_version = self._get_versions(
+            impersonator_pk,
+            target_pk,
+        )
+        return u'{0}:{1}:{2}:{3}:{4}:{5}'.format(
+            self.key_prefix,
+            get_config().fingerprint,
+            impersonator_pk,
+            impersonator_version,
+            target_pk,
+            target_version,
+        )
+
+    def get(self, impersonator_pk, target_pk):
+        ''' Returns True/False for a cached decision, None on a miss.
+        '''
+        return self.cache.get(self._decision_key(impersonator_pk, target_pk))
+
+    def set(self, impersonator_pk, target_pk, allowed):
+        self.cache.set(
+            self._decision_key(impersonator_pk, target_pk),
+            bool(allowed),
+            self.timeout,
+        )
+
+    # Async versions for the async middleware, they use the cache
+    # backend's own a*() methods (Django 4.0+)
+
+    async def _aget_versions(self, *user_pks):
+        keys = [self._version_key(pk) for pk in user_pks]
+        versions = await self.cache.aget_many(keys)
+        for key in keys:
+            if key not in versions:
+                await self.cache.aadd(key, uuid.uuid4().hex, None)
+                versions[key] = await self.cache.aget(key)
+        return [versions[key] for key in keys]
+
+    async def _adecision_key(self, impersonator_pk, target_pk):
+        impersonator_version, target_version = await self._aget_versions(
+            impersonator_pk,
+            target_pk,
+        )
+        return u'{0}:{1}:{2}:{3}:{4}:{5}'.format(
+            self.key_prefix,
+            get_config().fingerprint,
+            impersonator_pk,
+            impersonator_version,
+            target_pk,
+            target_version,
+        )
+
+    async def aget(self, impersonator_pk, target_pk):
+        return await self.cache.aget(
+            await self._adecision_key(impersonator_pk, target_pk)
+        )
+
+    async def aset(self, impersonator_pk, target_pk, allowed):
+        await self.cache.aset(
+            await self._adecision_key(impersonator_pk, target_pk),
+            bool(allowed),
+            self.timeout,
+        )
+
+    def invalidate_pair(self, impersonator_pk, target_pk):
+        self.cache.delete(self._decision_key(impersonator_pk, target_pk))
+
+    def invalidate_user(self, user_pk):
+        self.cache.set(self._version_key(user_pk), uuid.uuid4().hex, None)
+
+
+class UserCache(object):
+    ''' Keeps what the impersonated user would otherwise load again on
+        every request: the permission caches that ModelBackend sets on the
+        user (_perm_cache, _user_perm_cache, _group_perm_cache) and the
+        related objects of IMPERSONATE_USER_CACHE_RELATED.
+
+        Entries are keyed on the user pk, a version token of that user
+        and a global version token. Changes to the user, their groups or
+        permissions replace the user's token, changes to any group or
+        permission replace the global one.
+    '''
+    key_prefix = 'impersonate:user'
+    perm_cache_attrs = ('_perm_cache', '_user_perm_cache', '_group_perm_cache')
+
+    def __init__(self, alias='default', timeout=300, related=()):
+        self.alias = alias
+        self.timeout = timeout
+        self.related = related
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _version_key(self, user_pk=None):
+        if user_pk is None:
+            return u'{0}:v'.format(self.key_prefix)
+        return u'{0}:v:{1}'.format(self.key_prefix, user_pk)
+
+    def _key(self, user_pk, versions):
+        return u'{0}:{1}:{2}:{3}'.format(
+            self.key_prefix,
+            versions[self._version_key()],
+            user_pk,
+            versions[self._version_key(user_pk)],
+        )
+
+    def _get_key(self, user_pk):
+        keys = [self._version_key(), self._version_key(user_pk)]
+        versions = self.cache.get_many(keys)
+        for key in keys:
+            if key not in versions:
+                # Same as DecisionCache._get_versions()
+                self.cache.add(key, uuid.uuid4().hex, None)
+                versions[key] = self.cache.get(key)
+        return self._key(user_pk, versions)
+
+    async def _aget_key(self, user_pk):
+        keys = [self._version_key(), self._version_key(user_pk)]
+        versions = await self.cache.aget_many(keys)
+        for key in keys:
+            if key not in versions:
+                await self.cache.aadd(key, uuid.uuid4().hex, None)
+                versions[key] = await self.cache.aget(key)
+        return self._key(user_pk, versions)
+
+    def _collect(self, user, related):
+        state = dict(
+            (attr, user.__dict__[attr])
+            for attr in self.perm_cache_attrs
+            if attr in user.__dict__
+        )
+        state['related'] = related
+        return state
+
+    def _apply(self, user, state):
+        for attr in self.perm_cache_attrs:
+            if attr in state:
+                setattr(user, attr, state[attr])
+        if not state['related']:
+            return
+        prefetched = user.__dict__.setdefault('_prefetched_objects_cache', {})
+        for name, objs in state['related'].items():
+            # What prefetch_related_objects() leaves behind
+            manager = getattr(user, name)
+            qs = manager.all()
+            qs._result_cache = objs
+            qs._prefetch_done = True
+            prefetched[manager.prefetch_cache_name] = qs
+
+    def warm(self, user):
+        ''' Loads the cached state into user. On a miss, loads it from
+            the database and caches it. Returns True on a hit.
+        '''
+        key = self._get_key(user.pk)
+        state = self.cache.get(key)
+        if state is not None:
+            self._apply(user, state)
+            return True
+
+        user.get_all_permissions()
+        related = dict(
+            (name, list(getattr(user, name).all())) for name in self.related
+        )
+        state = self._collect(user, related)
+        self.cache.set(key, state, self.timeout)
+        self._apply(user, state)
+        return False
+
+    async def awarm(self, user):
+        key = await self._aget_key(user.pk)
+        state = await self.cache.aget(key)
+        if state is not None:
+            self._apply(user, state)
+            return True
+
+        if hasattr(user, 'aget_all_permissions'):
+            # Django 5.0+
+            await user.aget_all_permissions()
+        else:
+            await sync_to_async(user.get_all_permissions)()
+        related = {}
+        for name in self.related:
+            related[name] = [obj async for obj in getattr(user, name).all()]
+        state = self._collect(user, related)
+        await self.cache.aset(key, state, self.timeout)
+        self._apply(user, state)
+        return False
+
+    def invalidate_user(self, user_pk):
+        self.cache.set(self._version_key(user_pk), uuid.uuid4().hex, None)
+
+    def invalidate_all(self):
+        self.cache.set(self._version_key(), uuid.uuid4().hex, None)
+
+
+def get_user_cache():
+    ''' Returns the UserCache, or None if the IMPERSONATE_USER_CACHE_TIMEOUT
+        setting is not enabled.
+    '''
+    config = get_config()
+    if not config.user_cache_timeout:
+        return None
+    return UserCache(
+        alias=config.cache_alias,
+        timeout=config.user_cache_timeout,
+        related=config.user_cache_related,
+    )
+
+
+def get_decision_cache():
+    ''' Returns the configured decision cache, or None if the
+        IMPERSONATE_DECISION_CACHE_TIMEOUT setting is not enabled.
+    '''
+    config = get_config()
+    if not config.decision_cache_timeout:
+        return None
+
+    cache_class = get_setting_func(
+        'IMPERSONATE_DECISION_CACHE',
+        'impersonate.cache.DecisionCache',
+    )
+    return cache_class(
+        alias=config.decision_cache_alias,
+        timeout=config.decision_cache_timeout,
+    )
+
+
+def invalidate_user_decisions(sender, instance, **kwargs):
+    ''' post_save/post_delete receiver for the user model.
+    '''
+    decision_cache = get_decision_cache()
+    if decision_cache is not None and instance.pk is not None:
+        decision_cache.invalidate_user(instance.pk)
+
+
+def invalidate_session_decision(sender, impersonator=None,
+                                impersonating=None, event=None, **kwargs):
+    ''' session_end receiver. The impersonating argument is the user id
+        that was stored in the session. When sent in the background (see
+        impersonate.dispatch) only the event is passed.
+    '''
+    decision_cache = get_decision_cache()
+    if decision_cache is None:
+        return
+
+    if impersonator is None and event is not None:
+        impersonator_pk = event['impersonator']
+        impersonating = event['impersonating']
+    else:
+        impersonator_pk = getattr(impersonator, 'pk', None)
+    if impersonator_pk is not None and impersonating is not None:
+        decision_cache.invalidate_pair(
+            impersonator_pk,
+            getattr(impersonating, 'pk', impersonating),
+        )
+
+
+def invalidate_user_cache(sender, instance, **kwargs):
+    ''' post_save/post_delete receiver for the user model.
+    '''
+    user_cache = get_user_cache()
+    if user_cache is not None and instance.pk is not None:
+        user_cache.invalidate_user(instance.pk)
+
+
+def invalidate_user_cache_m2m(sender, instance, action, reverse=False,
+                              pk_set=None, **kwargs):
+    ''' m2m_changed receiver for user.groups and user.user_permissions
+    '''
+    user_cache = get_user_cache()
+    if user_cache is None or \
+       action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        user_cache.invalidate_user(instance.pk)
+    elif pk_set:
+        for pk in pk_set:
+            user_cache.invalidate_user(pk)
+    else:
+        # e.g. group.user_set.clear(), which users were in it is gone
+        user_cache.invalidate_all()
+
+
+def invalidate_user_caches(sender, **kwargs):
+    ''' Receiver for changes to any group or permission, which may be
+        part of any user's cached state
+    '''
+    user_cache = get_user_cache()
+    if user_cache is not None:
+        user_cache.invalidate_all()
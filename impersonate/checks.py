@@ -0,0 +1,102 @@
+from django.conf import settings
+from django.core.checks import Error, Warning
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+
+from .helpers import import_func_from_string
+
+# Settings holding a dotted path to a function (or class), and the
+# default used when they are not set
+FUNCTION_SETTINGS = (
+    ('IMPERSONATE_CUSTOM_ALLOW', None),
+    ('IMPERSONATE_CUSTOM_USER_QUERYSET', None),
+    ('IMPERSONATE_DECISION_CACHE', 'impersonate.cache.DecisionCache'),
+    ('IMPERSONATE_SEARCH_BACKEND', 'impersonate.search.QuerySearchBackend'),
+    ('IMPERSONATE_INSTRUMENTATION',
+     'impersonate.instrumentation.NullInstrumentation'),
+    ('IMPERSONATE_STATE_BACKEND', 'impersonate.state.SessionStateBackend'),
+)
+
+
+def check_function_settings(app_configs, **kwargs):
+    ''' Makes sure the dotted paths in FUNCTION_SETTINGS can be imported,
+        so a typo fails at startup instead of on the first impersonated
+        request.
+    '''
+    errors = []
+    for setting_name, default in FUNCTION_SETTINGS:
+        string_name = getattr(settings, setting_name, default)
+        if string_name is None:
+            continue
+
+        try:
+            func = import_func_from_string(string_name)
+        except (ImportError, AttributeError, ValueError) as err:
+            errors.append(Error(
+                u'{0} refers to {1!r}, which cannot be imported: {2}'.format(
+                    setting_name,
+                    string_name,
+                    err,
+                ),
+                hint=u'Use a dotted path such as "module.function_name".',
+                id='impersonate.E001',
+            ))
+            continue
+
+        if not callable(func):
+            errors.append(Error(
+                u'{0} refers to {1!r}, which is not callable.'.format(
+                    setting_name,
+                    string_name,
+                ),
+                id='impersonate.E002',
+            ))
+    return errors
+
+
+def check_uid_resolvers(app_configs, **kwargs):
+    ''' Makes sure every IMPERSONATE_UID_RESOLVERS lookup refers to a
+        user field and warns about the ones without an index, which make
+        the impersonate view scan the user table. The default chain is
+        not checked, the user model may be beyond the project's control
+        (auth.User has no index on email).
+    '''
+    from .config import get_config
+    from .resolvers import UIDResolver
+
+    explicit = hasattr(settings, 'IMPERSONATE_UID_RESOLVERS')
+    errors = []
+    for lookup in get_config().uid_resolvers:
+        try:
+            resolver = UIDResolver(lookup)
+        except (FieldDoesNotExist, ImproperlyConfigured) as err:
+            if not explicit:
+                continue
+            errors.append(Error(
+                u'IMPERSONATE_UID_RESOLVERS contains {0!r}, which is not '
+                u'a valid lookup: {1}'.format(lookup, err),
+                hint=u'Use a user field name, optionally followed by '
+                     u'"__iexact".',
+                id='impersonate.E003',
+            ))
+            continue
+
+        if not explicit or resolver.is_indexed():
+            continue
+        if resolver.case_insensitive:
+            hint = (
+                u'Add models.Index(Lower({0!r}), name=...) to the user '
+                u'model\'s Meta.indexes.'.format(resolver.field.name)
+            )
+        else:
+            hint = (
+                u'Set db_index=True or unique=True on the field, or add '
+                u'it to the user model\'s Meta.indexes.'
+            )
+        errors.append(Warning(
+            u'IMPERSONATE_UID_RESOLVERS contains {0!r}, but no index of '
+            u'the user table serves it; looking up users by it scans the '
+            u'table.'.format(lookup),
+            hint=hint + u' Or remove it from IMPERSONATE_UID_RESOLVERS.',
+            id='impersonate.W001',
+        ))
+    return errors
@@ -0,0 +1,322 @@
+import hashlib
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+
+_config = None
+
+
+class ImpersonateConfig(object):
+    ''' Read-only snapshot of the IMPERSONATE_* settings.
+
+        Reading a Django setting goes through LazySettings.__getattr__,
+        which adds up on paths that run on every request. The snapshot is
+        built once by get_config() and rebuilt when a relevant setting
+        changes (see reset_config()).
+    '''
+    __slots__ = (
+        'redirect_field_name',
+        'redirect_url',
+        'login_url',
+        'use_http_referer',
+        'paginate_count',
+        'pagination',
+        'pagination_count',
+        'count_cache_timeout',
+        'cursor_field',
+        'require_superuser',
+        'allow_superuser',
+        'custom_allow',
+        'custom_user_queryset',
+        'materialize_permissions',
+        'materialize_fields',
+        'uri_exclusions',
+        'uri_cache_size',
+        'never_impersonate_paths',
+        'never_impersonate_hosts',
+        'list_fields',
+        'search_fields',
+        'lookup_type',
+        'typeahead_limit',
+        'typeahead_max_age',
+        'decision_cache',
+        'decision_cache_alias',
+        'cache_alias',
+        'decision_cache_timeout',
+        'lease_timeout',
+        'user_cache_timeout',
+        'user_cache_related',
+        'user_select_related',
+        'user_prefetch_related',
+        'uid_resolvers',
+        'uid_cache_timeout',
+        'check_revocations',
+        'state_cookie_name',
+        'disable_logging',
+        'log_buffer_size',
+        'log_buffer_timeout',
+        'signal_dispatch',
+        'signal_workers',
+        'signal_queue_size',
+        'signal_overflow',
+        'fingerprint',
+    )
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ImpersonateConfig is read-only')
+
+    def __delattr__(self, name):
+        raise AttributeError('ImpersonateConfig is read-only')
+
+    def __repr__(self):
+        return '<ImpersonateConfig {0}>'.format(self.fingerprint)
+
+    @classmethod
+    def from_settings(cls):
+        from django.contrib.auth import get_user_model
+
+        uri_exclusions = getattr(
+            settings,
+            'IMPERSONATE_URI_EXCLUSIONS',
+            (r'^admin/',),
+        )
+        if not isinstance(uri_exclusions, (list, tuple)):
+            uri_exclusions = (uri_exclusions,)
+
+        user_model = get_user_model()
+        username_field = getattr(user_model, 'USERNAME_FIELD', 'username')
+        try:
+            user_model._meta.get_field('groups')
+        except FieldDoesNotExist:
+            user_cache_related = ()
+        else:
+            user_cache_related = ('groups',)
+        # Only the fields the user model has, see IMPERSONATE_UID_RESOLVERS
+        uid_resolvers = ['pk']
+        for field_name in (getattr(user_model, 'EMAIL_FIELD', 'email'),
+                           username_field):
+            try:
+                user_model._meta.get_field(field_name)
+            except FieldDoesNotExist:
+                continue
+            if field_name not in uid_resolvers:
+                uid_resolvers.append(field_name)
+        search_fields = getattr(
+            settings,
+            'IMPERSONATE_SEARCH_FIELDS',
+            [username_field, 'first_name', 'last_name', 'email'],
+        )
+        decision_cache_alias = getattr(
+            settings,
+            'IMPERSONATE_DECISION_CACHE_ALIAS',
+            'default',
+        )
+
+        values = dict(
+            redirect_field_name=getattr(
+                settings,
+                'IMPERSONATE_REDIRECT_FIELD_NAME',
+                None,
+            ),
+            redirect_url=getattr(
+                settings,
+                'IMPERSONATE_REDIRECT_URL',
+                getattr(settings, 'LOGIN_REDIRECT_URL', u'/'),
+            ),
+            login_url=settings.LOGIN_URL,
+            use_http_referer=getattr(
+                settings,
+                'IMPERSONATE_USE_HTTP_REFERER',
+                False,
+            ),
+            paginate_count=int(
+                getattr(settings, 'IMPERSONATE_PAGINATE_COUNT', 20)
+            ),
+            pagination=getattr(settings, 'IMPERSONATE_PAGINATION', 'page'),
+            pagination_count=getattr(
+                settings,
+                'IMPERSONATE_PAGINATION_COUNT',
+                'none',
+            ),
+            count_cache_timeout=getattr(
+                settings,
+                'IMPERSONATE_COUNT_CACHE_TIMEOUT',
+                300,
+            ),
+            cursor_field=getattr(settings, 'IMPERSONATE_CURSOR_FIELD', 'pk'),
+            require_superuser=getattr(
+                settings,
+                'IMPERSONATE_REQUIRE_SUPERUSER',
+                False,
+            ),
+            allow_superuser=getattr(
+                settings,
+                'IMPERSONATE_ALLOW_SUPERUSER',
+                False,
+            ),
+            custom_allow=getattr(settings, 'IMPERSONATE_CUSTOM_ALLOW', None),
+            custom_user_queryset=getattr(
+                settings,
+                'IMPERSONATE_CUSTOM_USER_QUERYSET',
+                None,
+            ),
+            materialize_permissions=getattr(
+                settings,
+                'IMPERSONATE_MATERIALIZE_PERMISSIONS',
+                False,
+            ),
+            materialize_fields=getattr(
+                settings,
+                'IMPERSONATE_MATERIALIZE_FIELDS',
+                None,
+            ),
+            uri_exclusions=tuple(uri_exclusions),
+            uri_cache_size=getattr(settings, 'IMPERSONATE_URI_CACHE_SIZE', 512),
+            never_impersonate_paths=frozenset(getattr(
+                settings,
+                'IMPERSONATE_NEVER_IMPERSONATE_PATHS',
+                (),
+            )),
+            never_impersonate_hosts=frozenset(
+                host.lower() for host in getattr(
+                    settings,
+                    'IMPERSONATE_NEVER_IMPERSONATE_HOSTS',
+                    (),
+                )
+            ),
+            list_fields=getattr(settings, 'IMPERSONATE_LIST_FIELDS', None),
+            search_fields=tuple(search_fields),
+            lookup_type=getattr(settings, 'IMPERSONATE_LOOKUP_TYPE', 'icontains'),
+            typeahead_limit=int(
+                getattr(settings, 'IMPERSONATE_TYPEAHEAD_LIMIT', 10)
+            ),
+            typeahead_max_age=getattr(
+                settings,
+                'IMPERSONATE_TYPEAHEAD_MAX_AGE',
+                60,
+            ),
+            decision_cache=getattr(
+                settings,
+                'IMPERSONATE_DECISION_CACHE',
+                'impersonate.cache.DecisionCache',
+            ),
+            decision_cache_alias=decision_cache_alias,
+            cache_alias=getattr(
+                settings,
+                'IMPERSONATE_CACHE_ALIAS',
+                decision_cache_alias,
+            ),
+            decision_cache_timeout=getattr(
+                settings,
+                'IMPERSONATE_DECISION_CACHE_TIMEOUT',
+                0,
+            ),
+            lease_timeout=int(
+                getattr(settings, 'IMPERSONATE_LEASE_TIMEOUT', 0)
+            ),
+            user_cache_timeout=getattr(
+                settings,
+                'IMPERSONATE_USER_CACHE_TIMEOUT',
+                0,
+            ),
+            user_cache_related=tuple(getattr(
+                settings,
+                'IMPERSONATE_USER_CACHE_RELATED',
+                user_cache_related,
+            )),
+            user_select_related=tuple(getattr(
+                settings,
+                'IMPERSONATE_USER_SELECT_RELATED',
+                (),
+            )),
+            user_prefetch_related=tuple(getattr(
+                settings,
+                'IMPERSONATE_USER_PREFETCH_RELATED',
+                (),
+            )),
+            uid_resolvers=tuple(getattr(
+                settings,
+                'IMPERSONATE_UID_RESOLVERS',
+                uid_resolvers,
+            )),
+            uid_cache_timeout=getattr(
+                settings,
+                'IMPERSONATE_UID_CACHE_TIMEOUT',
+                60,
+            ),
+            check_revocations=getattr(
+                settings,
+                'IMPERSONATE_CHECK_REVOCATIONS',
+                False,
+            ),
+            state_cookie_name=getattr(
+                settings,
+                'IMPERSONATE_STATE_COOKIE_NAME',
+                'impersonate',
+            ),
+            disable_logging=getattr(
+                settings,
+                'IMPERSONATE_DISABLE_LOGGING',
+                False,
+            ),
+            log_buffer_size=int(
+                getattr(settings, 'IMPERSONATE_LOG_BUFFER_SIZE', 100)
+            ),
+            log_buffer_timeout=getattr(
+                settings,
+                'IMPERSONATE_LOG_BUFFER_TIMEOUT',
+                5,
+            ),
+            signal_dispatch=getattr(
+                settings,
+                'IMPERSONATE_SIGNAL_DISPATCH',
+                'sync',
+            ),
+            signal_workers=int(
+                getattr(settings, 'IMPERSONATE_SIGNAL_WORKERS', 2)
+            ),
+            signal_queue_size=int(
+                getattr(settings, 'IMPERSONATE_SIGNAL_QUEUE_SIZE', 100)
+            ),
+            signal_overflow=getattr(
+                settings,
+                'IMPERSONATE_SIGNAL_OVERFLOW',
+                'drop',
+            ),
+        )
+
+        # Hash of every setting that has an effect on check_allow_for_user()
+        values['fingerprint'] = hashlib.md5(repr((
+            values['require_superuser'],
+            values['allow_superuser'],
+            values['custom_allow'],
+            values['custom_user_queryset'],
+            values['materialize_permissions'],
+        )).encode('utf-8')).hexdigest()[:12]
+
+        return cls(**values)
+
+
+def get_config():
+    ''' Returns the current ImpersonateConfig snapshot.
+    '''
+    global _config
+
+    config = _config
+    if config is None:
+        config = _config = ImpersonateConfig.from_settings()
+    return config
+
+
+def reset_config(setting=None, **kwargs):
+    ''' setting_changed receiver, the snapshot is rebuilt on next use.
+    '''
+    global _config
+
+    if setting is None or setting.startswith('IMPERSONATE_') or \
+       setting in ('LOGIN_URL', 'LOGIN_REDIRECT_URL', 'AUTH_USER_MODEL'):
+        _config = None
@@ -1,80 +1,134 @@
-from django.conf import settings
-from django.db.models import Q
+from django.core.exceptions import FieldDoesNotExist
 
-from .helpers import (get_paginator, get_redir_arg, get_redir_field,
-                      users_impersonable)
-
-try:
-    # Django 1.5 check
-    from django.contrib.auth import get_user_model
-except ImportError:
-    from django.contrib.auth.models import User
-else:
-    User = get_user_model()
+from .config import get_config
+from .helpers import (User, add_start_urls, get_paginator, get_redir_arg,
+                      get_redir_field, only_list_fields, users_impersonable)
+from .instrumentation import instrumented
+from .search import get_search_backend
 
 
+@instrumented('get_list_template_context')
 def get_list_template_context(request):
     ''' List all users in the system.
-        Will add 5 items to the context.
+        Will add 8 items to the context.
           * users - queryset of all users
           * paginator - Django Paginator instance
-          * page - Current page of objects (from Paginator)
+          * page - Current page of objects (from Paginator), each user
+                              with an impersonate_start_url attribute
           * page_number - Current page number, defaults to 1
+          * next_cursor / previous_cursor - cursors for the adjacent pages
+                              when IMPERSONATE_PAGINATION is 'cursor'
           * redirect - arg for redirect target, e.g. "?next=/foo/bar"
+          * redirect_field - hidden input field with redirect argument
     '''
     users = users_impersonable(request)
 
-    paginator, page, page_number = get_paginator(request, users)
+    paginator, page, page_number = get_paginator(
+        request,
+        only_list_fields(users),
+    )
+    add_start_urls(request, page)
 
     return {
         'users': users,
         'paginator': paginator,
         'page': page,
         'page_number': page_number,
+        'next_cursor': getattr(page, 'next_cursor', None),
+        'previous_cursor': getattr(page, 'previous_cursor', None),
         'redirect': get_redir_arg(request),
         'redirect_field': get_redir_field(request),
     }
 
 
+@instrumented('get_search_template_context')
 def get_search_template_context(request, query):
     ''' Simple search through the users.
-        Will add 7 items to the context.
+        Will add 9 items to the context.
           * users - All users that match the query passed.
           * paginator - Django Paginator instance
-          * page - Current page of objects (from Paginator)
+          * page - Current page of objects (from Paginator), each user
+                              with an impersonate_start_url attribute
           * page_number - Current page number, defaults to 1
+          * next_cursor / previous_cursor - cursors for the adjacent pages
+                              when IMPERSONATE_PAGINATION is 'cursor'
           * query - The search query that was entered
           * redirect - arg for redirect target, e.g. "?next=/foo/bar"
           * redirect_field - hidden input field with redirect argument,
                               put this inside search form
     '''
 
-    # get username field
-    username_field = getattr(User, 'USERNAME_FIELD', 'username')
-
-    # define search fields and lookup type
-    search_fields = set(getattr(settings, 'IMPERSONATE_SEARCH_FIELDS',
-                        [username_field, 'first_name', 'last_name', 'email']))
-    lookup_type = getattr(settings, 'IMPERSONATE_LOOKUP_TYPE', 'icontains')
-
-    # prepare kwargs
-    search_q = Q()
-    for term in query.split():
-        sub_q = Q()
-        for search_field in search_fields:
-            sub_q |= Q(**{'{0}__{1}'.format(search_field, lookup_type): term})
-        search_q &= sub_q
-
-    users = users_impersonable(request)
-    users = users.filter(search_q)
-    paginator, page, page_number = get_paginator(request, users)
+    # see IMPERSONATE_SEARCH_BACKEND
+    users = get_search_backend().search(users_impersonable(request), query)
+    paginator, page, page_number = get_paginator(
+        request,
+        only_list_fields(users),
+    )
+    add_start_urls(request, page)
 
     return {
         'users': users,
         'paginator': paginator,
         'page': page,
         'page_number': page_number,
+        'next_cursor': getattr(page, 'next_cursor', None),
+        'previous_cursor': getattr(page, 'previous_cursor', None),
         'query': query,
         'redirect': get_redir_arg(request),
         'redirect_field': get_redir_field(request),
     }
+
+
+def get_typeahead_fields():
+    ''' Returns {key: field name} of the user fields that end up in the
+        typeahead results, skipping the ones the user model lacks.
+    '''
+    candidates = (
+        ('username', getattr(User, 'USERNAME_FIELD', 'username')),
+        ('email', getattr(User, 'EMAIL_FIELD', 'email')),
+        ('first_name', 'first_name'),
+        ('last_name', 'last_name'),
+    )
+    fields = {}
+    for key, field_name in candidates:
+        try:
+            User._meta.get_field(field_name)
+        except FieldDoesNotExist:
+            continue
+        fields[key] = field_name
+    return fields
+
+
+@instrumented('get_typeahead_context')
+def get_typeahead_context(request, query):
+    ''' Search for the typeahead endpoint. Only the columns needed are
+        fetched (with values()), and at most IMPERSONATE_TYPEAHEAD_LIMIT
+        rows.
+        Will return 2 items.
+          * query - The search query that was entered
+          * results - list of dicts with pk, username, email and name
+    '''
+    query = query.strip()
+    if not query:
+        return {'query': query, 'results': []}
+
+    users = get_search_backend().search(users_impersonable(request), query)
+    if not users.ordered:
+        users = users.order_by('pk')
+
+    fields = get_typeahead_fields()
+    rows = users.values('pk', *fields.values())[:get_config().typeahead_limit]
+
+    results = []
+    for row in rows:
+        name = u' '.join(
+            row[fields[key]] for key in ('first_name', 'last_name')
+            if key in fields and row[fields[key]]
+        )
+        results.append({
+            'pk': row['pk'],
+            'username': row.get(fields.get('username')),
+            'email': row.get(fields.get('email')),
+            'name': name,
+        })
+    return {'query': query, 'results': results}
@@ -1,10 +1,12 @@
 import django
-from django.conf import settings
 from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.shortcuts import redirect
+from functools import wraps
 from urllib.parse import quote
 
-from .helpers import check_allow_impersonate, get_redir_path
+from .config import get_config
+from .helpers import (acheck_allow_impersonate, check_allow_impersonate,
+                      get_redir_path)
 
 
 def get_login_url():
@@ -13,12 +15,13 @@ def get_login_url():
         from django.shortcuts import resolve_url
         from django.utils.encoding import force_str
 
-        return force_str(resolve_url(settings.LOGIN_URL))
+        return force_str(resolve_url(get_config().login_url))
     else:
-        return settings.LOGIN_URL
+        return get_config().login_url
 
 
 def allowed_user_required(view_func):
+    @wraps(view_func)
     def _checkuser(request, *args, **kwargs):
         if not request.user.is_authenticated:
             return redirect(u'{0}?{1}={2}'.format(
@@ -35,3 +38,27 @@ def allowed_user_required(view_func):
             return redirect(get_redir_path())
 
     return _checkuser
+
+
+def aallowed_user_required(view_func):
+    ''' allowed_user_required for async views
+    '''
+    @wraps(view_func)
+    async def _checkuser(request, *args, **kwargs):
+        if hasattr(request, 'auser'):
+            # loads request.user without blocking
+            await request.auser()
+
+        if not request.user.is_authenticated:
+            return redirect(u'{0}?{1}={2}'.format(
+                get_login_url(),
+                REDIRECT_FIELD_NAME,
+                quote(request.get_full_path()),
+            ))
+
+        if await acheck_allow_impersonate(request):
+            return await view_func(request, *args, **kwargs)
+        else:
+            return redirect(get_redir_path())
+
+    return _checkuser
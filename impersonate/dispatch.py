@@ -0,0 +1,239 @@
+import logging
+import threading
+from concurrent import futures
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .config import get_config
+from .helpers import asend, iscoroutinefunction, sync_to_async
+
+logger = logging.getLogger(__name__)
+
+_dispatcher = None
+
+# Receivers of the package itself by signal, see connect_internal()
+_internal_receivers = {}
+
+
+def connect_internal(signal, receiver):
+    ''' Connects one of the package's own receivers to session_begin or
+        session_end. They are called during the request by
+        send_session_signal(), never from the background queue where
+        they could be dropped.
+    '''
+    receivers = _internal_receivers.setdefault(signal, [])
+    if receiver not in receivers:
+        receivers.append(receiver)
+
+
+def get_event(name, request, impersonator, impersonating):
+    ''' The serializable description of a session_begin/session_end that
+        receivers get as the event argument.
+    '''
+    return {
+        'name': name,
+        'impersonator': getattr(impersonator, 'pk', impersonator),
+        'impersonating': getattr(impersonating, 'pk', impersonating),
+        'session_key': getattr(request.session, 'session_key', None),
+        'path': request.path,
+        'remote_addr': request.META.get('REMOTE_ADDR'),
+        'user_agent': request.META.get('HTTP_USER_AGENT', ''),
+        'timestamp': timezone.now().isoformat(),
+    }
+
+
+class SignalDispatcher(object):
+    ''' Sends signals from a bounded thread pool, so receivers do not add
+        to the response time.
+
+        At most queue_size sends may be waiting or running. Beyond that
+        the overflow policy applies: 'drop' discards the send, 'inline'
+        leaves it to the request, as if dispatching in the background was
+        disabled. Counters are available from stats().
+    '''
+    def __init__(self, workers=2, queue_size=100, overflow='drop'):
+        if overflow not in ('drop', 'inline'):
+            raise ValueError(
+                'Unknown IMPERSONATE_SIGNAL_OVERFLOW: {0!r}'.format(overflow)
+            )
+        self.workers = workers
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.executor = futures.ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix='impersonate-signals',
+        )
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.counts = dict.fromkeys(
+            ('submitted', 'completed', 'dropped', 'failed', 'inline'),
+            0,
+        )
+
+    def _count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['pending'] = len(self.pending)
+        return stats
+
+    def _send(self, signal, kwargs):
+        # Worker threads outlive requests, which is when Django closes
+        # expired or broken connections otherwise
+        close_old_connections()
+        try:
+            self._send_robust(signal, kwargs)
+        finally:
+            close_old_connections()
+
+    def _send_robust(self, signal, kwargs):
+        failed = False
+        for receiver, response in signal.send_robust(**kwargs):
+            if isinstance(response, Exception):
+                failed = True
+                logger.error(
+                    'Error in %r receiver %r',
+                    kwargs['event']['name'],
+                    receiver,
+                    exc_info=(type(response), response,
+                              response.__traceback__),
+                )
+        self._count('failed' if failed else 'completed')
+
+    def _done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+        self.slots.release()
+
+    def submit(self, signal, **kwargs):
+        ''' Queues signal.send(**kwargs), never blocks. Returns False if
+            the queue is full and the overflow policy is 'inline', the
+            caller has to send the signal itself then.
+        '''
+        if not self.slots.acquire(False):
+            if self.overflow == 'inline':
+                self._count('inline')
+                return False
+            self._count('dropped')
+            logger.warning(
+                'Signal queue full, dropped %r',
+                kwargs['event']['name'],
+            )
+            return True
+
+        self._count('submitted')
+        try:
+            future = self.executor.submit(self._send, signal, kwargs)
+        except RuntimeError:
+            # Interpreter shutting down
+            self.slots.release()
+            self._count('dropped')
+            return True
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self._done)
+        return True
+
+    def flush(self, timeout=None):
+        ''' Waits for the queued sends, e.g. before shutting down.
+        '''
+        with self.lock:
+            pending = list(self.pending)
+        futures.wait(pending, timeout=timeout)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+def get_dispatcher():
+    ''' Returns the SignalDispatcher, or None unless
+        IMPERSONATE_SIGNAL_DISPATCH is 'background'.
+    '''
+    global _dispatcher
+
+    config = get_config()
+    if config.signal_dispatch != 'background':
+        return None
+
+    dispatcher = _dispatcher
+    if dispatcher is None or \
+       dispatcher.workers != config.signal_workers or \
+       dispatcher.queue_size != config.signal_queue_size or \
+       dispatcher.overflow != config.signal_overflow:
+        if dispatcher is not None:
+            dispatcher.shutdown(wait=False)
+        dispatcher = _dispatcher = SignalDispatcher(
+            workers=config.signal_workers,
+            queue_size=config.signal_queue_size,
+            overflow=config.signal_overflow,
+        )
+    return dispatcher
+
+
+def send_session_signal(signal, name, request, impersonator, impersonating):
+    ''' Sends session_begin/session_end. Receivers always get the event
+        argument (see get_event()); when dispatching in the background it
+        is all they get, the users and the request are not passed to
+        other threads.
+    '''
+    event = get_event(name, request, impersonator, impersonating)
+    for receiver in _internal_receivers.get(signal, ()):
+        receiver(
+            signal=signal,
+            sender=None,
+            impersonator=impersonator,
+            impersonating=impersonating,
+            request=request,
+            event=event,
+        )
+
+    dispatcher = get_dispatcher()
+    if dispatcher is not None and \
+       dispatcher.submit(signal, sender=None, event=event):
+        return
+
+    signal.send(
+        sender=None,
+        impersonator=impersonator,
+        impersonating=impersonating,
+        request=request,
+        event=event,
+    )
+
+
+async def asend_session_signal(signal, name, request, impersonator,
+                               impersonating):
+    ''' Async version of send_session_signal()
+    '''
+    event = get_event(name, request, impersonator, impersonating)
+    for receiver in _internal_receivers.get(signal, ()):
+        if not iscoroutinefunction(receiver):
+            receiver = sync_to_async(receiver)
+        await receiver(
+            signal=signal,
+            sender=None,
+            impersonator=impersonator,
+            impersonating=impersonating,
+            request=request,
+            event=event,
+        )
+
+    dispatcher = get_dispatcher()
+    # submit() does not block
+    if dispatcher is not None and \
+       dispatcher.submit(signal, sender=None, event=event):
+        return
+
+    await asend(
+        signal,
+        sender=None,
+        impersonator=impersonator,
+        impersonating=impersonating,
+        request=request,
+        event=event,
+    )
@@ -0,0 +1,123 @@
+import re
+from functools import lru_cache
+
+from .config import get_config
+
+REGEX_METACHARS = frozenset('.^$*+?{}[]\\|()')
+BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+TRIE_END = None
+
+_matcher = None
+
+
+def get_literal_prefix(pattern):
+    r''' Returns the literal string matched by a pattern such as r'^admin/'
+        or r'^static\.files/', or None if the pattern uses anything
+        other than a start anchor and (escaped) literal characters.
+    '''
+    if not isinstance(pattern, str) or not pattern.startswith('^'):
+        return None
+
+    prefix = []
+    chars = iter(pattern[1:])
+    for char in chars:
+        if char == '\\':
+            char = next(chars, '')
+            if not char or char.isalnum() or char == '_':
+                # \d, \w, \A, ... or a trailing backslash
+                return None
+        elif char in REGEX_METACHARS:
+            return None
+        prefix.append(char)
+    return u''.join(prefix)
+
+
+class URIExclusionMatcher(object):
+    ''' Matches a URI (without its leading slash) against
+        IMPERSONATE_URI_EXCLUSIONS.
+
+        Patterns that are nothing more than an anchored literal prefix are
+        stored in a character trie, the rest are compiled into a single
+        alternation. Verdicts for recently seen URIs are kept in a bounded
+        LRU cache.
+    '''
+    def __init__(self, exclusions, cache_size=512):
+        self.prefix_trie = {}
+        self.regexes = []
+
+        patterns = []
+        for exclusion in exclusions:
+            prefix = get_literal_prefix(exclusion)
+            if prefix is not None:
+                self._add_prefix(prefix)
+            elif isinstance(exclusion, str):
+                patterns.append(exclusion)
+            else:
+                # Already compiled, keep its flags intact
+                self.regexes.append(exclusion)
+
+        self.regexes.extend(self._compile(patterns))
+
+        if cache_size:
+            self.is_excluded = lru_cache(maxsize=cache_size)(self.is_excluded)
+
+    def _add_prefix(self, prefix):
+        node = self.prefix_trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[TRIE_END] = True
+
+    def _compile(self, patterns):
+        if not patterns:
+            return []
+        if len(patterns) > 1 and \
+           not any(BACKREFERENCE.search(p) for p in patterns):
+            try:
+                return [re.compile(u'|'.join(
+                    u'(?:{0})'.format(pattern) for pattern in patterns
+                ))]
+            except re.error:
+                # e.g. repeated group names or inline global flags
+                pass
+        return [re.compile(pattern) for pattern in patterns]
+
+    def match_prefix(self, uri):
+        node = self.prefix_trie
+        for char in uri:
+            if TRIE_END in node:
+                return True
+            node = node.get(char)
+            if node is None:
+                return False
+        return TRIE_END in node
+
+    def is_excluded(self, uri):
+        if self.match_prefix(uri):
+            return True
+        for regex in self.regexes:
+            if regex.search(uri):
+                return True
+        return False
+
+
+def get_uri_matcher():
+    global _matcher
+
+    matcher = _matcher
+    if matcher is None:
+        config = get_config()
+        matcher = _matcher = URIExclusionMatcher(
+            config.uri_exclusions,
+            cache_size=config.uri_cache_size,
+        )
+    return matcher
+
+
+def reset_uri_matcher(setting=None, **kwargs):
+    ''' setting_changed receiver, the matcher is rebuilt on next use.
+    '''
+    global _matcher
+
+    if setting in (None, 'IMPERSONATE_URI_EXCLUSIONS',
+                   'IMPERSONATE_URI_CACHE_SIZE'):
+        _matcher = None
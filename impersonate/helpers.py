@@ -1,9 +1,17 @@
-import re
-
 from django.conf import settings
+from django.core.exceptions import DisallowedHost
 from django.core.paginator import EmptyPage, Paginator
+from django.db import NotSupportedError
+from django.http.request import split_domain_port
+from django.urls import reverse
+from django.utils.http import RFC3986_SUBDELIMS
 from django.utils.safestring import mark_safe
 
+from .config import get_config
+from .exclusions import get_uri_matcher
+from .instrumentation import instrumented
+from .pagination import CountlessPaginator, CursorPaginator
+
 try:
     # Django 1.5 check
     from django.contrib.auth import get_user_model
@@ -17,29 +25,42 @@ try:
 except ImportError:
     from django.utils.importlib import import_module
 
+try:
+    # Django 3.0+
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+try:
+    # asgiref 3.6+, also recognises markcoroutinefunction()
+    from asgiref.sync import iscoroutinefunction
+except ImportError:
+    from asyncio import iscoroutinefunction
+
+try:
+    # Python 3
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+# Functions imported from dotted path settings, see get_setting_func()
+_setting_funcs = {}
+
+# Stands in for the user id when reversing 'impersonate-start' once
+START_URL_PLACEHOLDER = 'impersonate-uid'
+
 
 def get_redir_path(request=None):
     nextval = None
-    redirect_field_name = getattr(
-        settings,
-        'IMPERSONATE_REDIRECT_FIELD_NAME',
-        None,
-    )
+    config = get_config()
+    redirect_field_name = config.redirect_field_name
     if request and redirect_field_name:
         nextval = request.GET.get(redirect_field_name, None)
-    return nextval or getattr(
-        settings,
-        'IMPERSONATE_REDIRECT_URL',
-        getattr(settings, 'LOGIN_REDIRECT_URL', u'/'),
-    )
+    return nextval or config.redirect_url
 
 
 def get_redir_arg(request):
-    redirect_field_name = getattr(
-        settings,
-        'IMPERSONATE_REDIRECT_FIELD_NAME',
-        None,
-    )
+    redirect_field_name = get_config().redirect_field_name
     if redirect_field_name:
         nextval = request.GET.get(redirect_field_name, None)
         if nextval:
@@ -48,11 +69,7 @@ def get_redir_arg(request):
 
 
 def get_redir_field(request):
-    redirect_field_name = getattr(
-        settings,
-        'IMPERSONATE_REDIRECT_FIELD_NAME',
-        None,
-    )
+    redirect_field_name = get_config().redirect_field_name
     if redirect_field_name:
         nextval = request.GET.get(redirect_field_name, None)
         if nextval:
@@ -65,16 +82,83 @@ def get_redir_field(request):
     return u''
 
 
+def get_start_url_func():
+    ''' Returns a function taking a user pk and returning the same URL
+        as reverse('impersonate-start', args=[pk]), for pages linking to
+        many users. The URL is reversed once, with a placeholder, and the
+        function only fills in the pk.
+    '''
+    url = reverse('impersonate-start', args=[START_URL_PLACEHOLDER])
+    prefix, found, suffix = url.partition(START_URL_PLACEHOLDER)
+    if not found or START_URL_PLACEHOLDER in suffix:
+        # Not a plain substitution, e.g. a converter changes the value
+        return lambda pk: reverse('impersonate-start', args=[pk])
+
+    # reverse() quotes arguments the same way
+    safe = RFC3986_SUBDELIMS + '/~:@'
+    return lambda pk: prefix + quote(str(pk), safe=safe) + suffix
+
+
+def add_start_urls(request, page):
+    ''' Sets impersonate_start_url, the 'impersonate-start' URL with the
+        redirect argument, on every user in page. The rows are loaded
+        here.
+    '''
+    if page is None:
+        return
+    start_url = get_start_url_func()
+    redirect = get_redir_arg(request)
+    page.object_list = list(page.object_list)
+    for user in page.object_list:
+        user.impersonate_start_url = start_url(user.pk) + redirect
+
+
+def only_list_fields(qs):
+    ''' Restricts qs to the columns in IMPERSONATE_LIST_FIELDS (plus the
+        primary key, and the cursor field when paginating by cursor),
+        if that setting is used.
+    '''
+    config = get_config()
+    if config.list_fields is None:
+        return qs
+
+    fields = list(config.list_fields)
+    if config.pagination == 'cursor' and config.cursor_field != 'pk':
+        fields.append(config.cursor_field)
+    return qs.only(*fields)
+
+
+@instrumented('get_paginator')
 def get_paginator(request, qs):
+    ''' Returns (paginator, page, page_number) for qs.
+        With IMPERSONATE_PAGINATION = 'cursor' the paginator is a
+        CursorPaginator positioned by the 'cursor' GET parameter, and
+        page_number is None. With 'countless' it is a CountlessPaginator.
+    '''
+    config = get_config()
+    if config.pagination == 'cursor':
+        paginator = CursorPaginator(
+            qs,
+            config.paginate_count,
+            ordering_field=config.cursor_field,
+        )
+        page = paginator.page(request.GET.get('cursor'))
+        return (paginator, page, None)
+
     try:
         page_number = int(request.GET.get('page', 1))
     except ValueError:
         page_number = 1
 
-    paginator = Paginator(
-        qs,
-        int(getattr(settings, 'IMPERSONATE_PAGINATE_COUNT', 20)),
-    )
+    if config.pagination == 'countless':
+        paginator = CountlessPaginator(
+            qs,
+            config.paginate_count,
+            count_strategy=config.pagination_count,
+            count_timeout=config.count_cache_timeout,
+        )
+    else:
+        paginator = Paginator(qs, config.paginate_count)
     try:
         page = paginator.page(page_number)
     except EmptyPage:
@@ -84,47 +168,173 @@ def get_paginator(request, qs):
 
 
 def check_allow_staff():
-    return (not getattr(settings, 'IMPERSONATE_REQUIRE_SUPERUSER', False))
+    return (not get_config().require_superuser)
 
 
+@instrumented('users_impersonable')
 def users_impersonable(request):
     ''' Returns a QuerySet of users that this user can impersonate.
         Uses the IMPERSONATE_CUSTOM_USER_QUERYSET if set, else, it
         returns all users
     '''
-    if hasattr(settings, 'IMPERSONATE_CUSTOM_USER_QUERYSET'):
-        custom_queryset_func = import_func_from_string(
-            settings.IMPERSONATE_CUSTOM_USER_QUERYSET
-        )
+    custom_queryset_func = get_setting_func('IMPERSONATE_CUSTOM_USER_QUERYSET')
+    if custom_queryset_func is not None:
         impersonator = get_impersonator(request)
+        if get_config().materialize_permissions:
+            from .permissions import materialized_users
+            return materialized_users(impersonator)
         return custom_queryset_func(impersonator, request)
     else:
         return User.objects.all()
 
 
+def with_user_related(qs=None):
+    ''' Applies IMPERSONATE_USER_SELECT_RELATED and
+        IMPERSONATE_USER_PREFETCH_RELATED to qs (all users by default),
+        for the queries that load the user to impersonate
+    '''
+    if qs is None:
+        qs = User.objects.all()
+    config = get_config()
+    if config.user_select_related:
+        qs = qs.select_related(*config.user_select_related)
+    if config.user_prefetch_related:
+        qs = qs.prefetch_related(*config.user_prefetch_related)
+    return qs
+
+
+def check_allow_superuser(request, end_user):
+    ''' Return True unless end_user is a superuser that this request is
+        not allowed to impersonate.
+        Can impersonate superusers if IMPERSONATE_ALLOW_SUPERUSER is True
+        and the request user is a superuser too.
+    '''
+    allow_superusers = get_config().allow_superuser
+    return (
+        (request.user.is_superuser and allow_superusers) or
+        not end_user.is_superuser
+    )
+
+
+@instrumented('check_allow_for_user')
 def check_allow_for_user(request, end_user):
     ''' Return True if some request can impersonate end_user
     '''
     if check_allow_impersonate(request):
         # start user can impersonate
-        # Can impersonate superusers if IMPERSONATE_ALLOW_SUPERUSER is True
         # Can impersonate anyone who is in your queryset of 'who i can impersonate'.
-        allow_superusers = getattr(
-            settings,
-            'IMPERSONATE_ALLOW_SUPERUSER',
-            False,
-        )
         upk = end_user.pk
-        return (
-            ((request.user.is_superuser and allow_superusers) or
-                not end_user.is_superuser) and
-            users_impersonable(request).filter(pk=upk).exists()
-        )
+        if not check_allow_superuser(request, end_user):
+            return False
+        config = get_config()
+        if config.materialize_permissions and config.custom_user_queryset:
+            from .permissions import has_permission
+            return has_permission(get_impersonator(request), upk)
+        return users_impersonable(request).filter(pk=upk).exists()
 
     # start user not allowed impersonate at all
     return False
 
 
+@instrumented('get_impersonable_user')
+def get_impersonable_user(request, user_pk):
+    ''' Return the user with user_pk if this request can impersonate
+        them, else None.
+
+        Equivalent to fetching the user and calling check_allow_for_user(),
+        but the user is fetched straight out of users_impersonable() so it
+        costs a single query. Custom querysets that cannot be filtered
+        any further (sliced, union()'d, ...) fall back to fetching the
+        user and checking it against the queryset's primary keys.
+    '''
+    if not check_allow_impersonate(request):
+        return None
+
+    qs = users_impersonable(request)
+    try:
+        end_user = with_user_related(qs).get(pk=user_pk)
+    except User.DoesNotExist:
+        return None
+    except User.MultipleObjectsReturned:
+        # Joins in the custom queryset repeat the user
+        end_user = with_user_related(qs).filter(pk=user_pk).distinct()[:1][0]
+    except (AssertionError, TypeError, NotSupportedError):
+        try:
+            end_user = with_user_related().get(pk=user_pk)
+        except User.DoesNotExist:
+            return None
+        if end_user.pk not in set(qs.values_list('pk', flat=True)):
+            return None
+
+    if not check_allow_superuser(request, end_user):
+        return None
+    return end_user
+
+
+@instrumented('check_allow_for_users')
+def check_allow_for_users(request, users_or_pks):
+    ''' Bulk version of check_allow_for_user(), for pages listing many
+        users. Takes users or primary keys and returns a dict mapping
+        each primary key to True or False, at the cost of a single query
+        (none if this request cannot impersonate at all).
+    '''
+    to_pk = User._meta.pk.to_python
+    pks = set(
+        to_pk(getattr(user_or_pk, 'pk', user_or_pk))
+        for user_or_pk in users_or_pks
+    )
+    allowed = dict.fromkeys(pks, False)
+    if not pks or not check_allow_impersonate(request):
+        return allowed
+
+    qs = users_impersonable(request)
+    try:
+        rows = list(
+            qs.filter(pk__in=pks).values_list('pk', 'is_superuser')
+        )
+    except (AssertionError, TypeError, NotSupportedError):
+        impersonable_pks = set(qs.values_list('pk', flat=True)) & pks
+        rows = User.objects.filter(pk__in=impersonable_pks).values_list(
+            'pk',
+            'is_superuser',
+        )
+
+    # check_allow_superuser() without fetching whole users
+    allow_superusers = (
+        request.user.is_superuser and get_config().allow_superuser
+    )
+    for pk, is_superuser in rows:
+        allowed[pk] = allow_superusers or not is_superuser
+    return allowed
+
+
+def annotate_impersonable(request, queryset, name='can_impersonate'):
+    ''' Annotates queryset (of users) with a boolean field, name, that
+        is True for the users this request can impersonate. The check
+        runs in the database as an EXISTS subquery of users_impersonable().
+    '''
+    from django.db.models import BooleanField, Exists, OuterRef, Value
+
+    if not check_allow_impersonate(request):
+        return queryset.annotate(
+            **{name: Value(False, output_field=BooleanField())}
+        )
+
+    lookups = {'pk': OuterRef('pk')}
+    if not (request.user.is_superuser and get_config().allow_superuser):
+        lookups['is_superuser'] = False
+
+    qs = users_impersonable(request)
+    try:
+        subquery = qs.filter(**lookups)
+    except (AssertionError, TypeError, NotSupportedError):
+        subquery = User.objects.filter(
+            pk__in=list(qs.values_list('pk', flat=True)),
+            **lookups
+        )
+    return queryset.annotate(**{name: Exists(subquery)})
+
+
 def import_func_from_string(string_name):
     ''' Given a string like 'mod.mod2.funcname' which refers to a function,
         return that function so it can be called
@@ -134,6 +344,35 @@ def import_func_from_string(string_name):
     return getattr(mod, func_name)
 
 
+def get_setting_func(setting_name, default=None):
+    ''' Returns the function named by the dotted path in the setting_name
+        setting (or default), or None if neither is set.
+        The import only happens once, the result is cached until the
+        setting changes. See reset_setting_funcs()
+    '''
+    try:
+        return _setting_funcs[setting_name, default]
+    except KeyError:
+        pass
+
+    string_name = getattr(settings, setting_name, default)
+    func = None
+    if string_name is not None:
+        func = import_func_from_string(string_name)
+    _setting_funcs[setting_name, default] = func
+    return func
+
+
+def reset_setting_funcs(setting=None, **kwargs):
+    ''' setting_changed receiver, drops the cached function so it is
+        imported again on next use.
+    '''
+    for key in list(_setting_funcs):
+        if setting is None or key[0] == setting:
+            del _setting_funcs[key]
+
+
+@instrumented('check_allow_impersonate')
 def check_allow_impersonate(request):
     ''' Returns True if this request is allowed to do any impersonation.
         Uses the IMPERSONATE_CUSTOM_ALLOW function if required, else
@@ -141,32 +380,53 @@ def check_allow_impersonate(request):
     '''
     impersonator = get_impersonator(request)
 
-    if hasattr(settings, 'IMPERSONATE_CUSTOM_ALLOW'):
-        custom_allow_func = \
-            import_func_from_string(settings.IMPERSONATE_CUSTOM_ALLOW)
-
+    custom_allow_func = get_setting_func('IMPERSONATE_CUSTOM_ALLOW')
+    if custom_allow_func is not None:
         return custom_allow_func(impersonator, request)
     else:
-        # default allow checking:
-        if not impersonator.is_superuser:
-            if not impersonator.is_staff or not check_allow_staff():
-                return False
+        return check_allow_default(impersonator)
+
+
+def check_allow_default(impersonator):
+    ''' The allow checking used when IMPERSONATE_CUSTOM_ALLOW is not set
+    '''
+    if not impersonator.is_superuser:
+        if not impersonator.is_staff or not check_allow_staff():
+            return False
 
-        return True
+    return True
 
 
+@instrumented('check_allow_for_uri')
 def check_allow_for_uri(uri):
-    uri = uri.lstrip('/')
+    ''' Returns False if uri matches one of IMPERSONATE_URI_EXCLUSIONS.
+        The exclusions are compiled once, see exclusions.URIExclusionMatcher
+    '''
+    return not get_uri_matcher().is_excluded(uri.lstrip('/'))
 
-    exclusions = getattr(settings, 'IMPERSONATE_URI_EXCLUSIONS', (r'^admin/',))
-    if not isinstance(exclusions, (list, tuple)):
-        exclusions = (exclusions,)
 
-    for exclusion in exclusions:
-        if re.search(exclusion, uri):
+@instrumented('check_allow_for_request')
+def check_allow_for_request(request):
+    ''' Returns False if impersonation never applies to this request: its
+        path is one of IMPERSONATE_NEVER_IMPERSONATE_PATHS or matches
+        IMPERSONATE_URI_EXCLUSIONS, or its host is one of
+        IMPERSONATE_NEVER_IMPERSONATE_HOSTS.
+        Only looks at the path and host, not at the user or session.
+    '''
+    config = get_config()
+    if request.path in config.never_impersonate_paths:
+        return False
+
+    if config.never_impersonate_hosts:
+        try:
+            domain = split_domain_port(request.get_host())[0]
+        except DisallowedHost:
+            # Left for Django to reject
+            domain = None
+        if domain in config.never_impersonate_hosts:
             return False
 
-    return True
+    return check_allow_for_uri(request.path)
 
 
 def get_impersonator(request):
@@ -174,3 +434,169 @@ def get_impersonator(request):
         return request.impersonator
     else:
         return request.user
+
+
+# Async versions of the checks above, for ASGI deployments. They only leave
+# the event loop when a function named in the settings is not itself a
+# coroutine function.
+
+async def acall_setting_func(func, *args):
+    ''' Calls a function loaded by get_setting_func() from async code.
+        Coroutine functions are awaited, anything else may touch the
+        database and is run in a thread.
+    '''
+    if iscoroutinefunction(func):
+        return await func(*args)
+    return await sync_to_async(func)(*args)
+
+
+async def ausers_impersonable(request):
+    ''' Async version of users_impersonable()
+    '''
+    custom_queryset_func = get_setting_func('IMPERSONATE_CUSTOM_USER_QUERYSET')
+    if custom_queryset_func is not None:
+        impersonator = get_impersonator(request)
+        if get_config().materialize_permissions:
+            from .permissions import materialized_users
+            return materialized_users(impersonator)
+        return await acall_setting_func(
+            custom_queryset_func,
+            impersonator,
+            request,
+        )
+    else:
+        return User.objects.all()
+
+
+async def acheck_allow_impersonate(request):
+    ''' Async version of check_allow_impersonate()
+    '''
+    impersonator = get_impersonator(request)
+
+    custom_allow_func = get_setting_func('IMPERSONATE_CUSTOM_ALLOW')
+    if custom_allow_func is not None:
+        return await acall_setting_func(custom_allow_func, impersonator, request)
+    else:
+        return check_allow_default(impersonator)
+
+
+async def acheck_allow_for_user(request, end_user):
+    ''' Async version of check_allow_for_user()
+    '''
+    if await acheck_allow_impersonate(request):
+        if not check_allow_superuser(request, end_user):
+            return False
+        config = get_config()
+        if config.materialize_permissions and config.custom_user_queryset:
+            from .permissions import ahas_permission
+            return await ahas_permission(
+                get_impersonator(request),
+                end_user.pk,
+            )
+        qs = await ausers_impersonable(request)
+        return await qs.filter(pk=end_user.pk).aexists()
+
+    return False
+
+
+async def acheck_allow_for_users(request, users_or_pks):
+    ''' Async version of check_allow_for_users()
+    '''
+    to_pk = User._meta.pk.to_python
+    pks = set(
+        to_pk(getattr(user_or_pk, 'pk', user_or_pk))
+        for user_or_pk in users_or_pks
+    )
+    allowed = dict.fromkeys(pks, False)
+    if not pks or not await acheck_allow_impersonate(request):
+        return allowed
+
+    qs = await ausers_impersonable(request)
+    try:
+        rows = [
+            row async for row in
+            qs.filter(pk__in=pks).values_list('pk', 'is_superuser')
+        ]
+    except (AssertionError, TypeError, NotSupportedError):
+        impersonable_pks = set()
+        async for pk in qs.values_list('pk', flat=True):
+            impersonable_pks.add(pk)
+        rows = [
+            row async for row in
+            User.objects.filter(
+                pk__in=impersonable_pks & pks,
+            ).values_list('pk', 'is_superuser')
+        ]
+
+    allow_superusers = (
+        request.user.is_superuser and get_config().allow_superuser
+    )
+    for pk, is_superuser in rows:
+        allowed[pk] = allow_superusers or not is_superuser
+    return allowed
+
+
+@instrumented('aget_impersonable_user')
+async def aget_impersonable_user(request, user_pk):
+    ''' Async version of get_impersonable_user()
+    '''
+    if not await acheck_allow_impersonate(request):
+        return None
+
+    qs = await ausers_impersonable(request)
+    try:
+        end_user = await with_user_related(qs).aget(pk=user_pk)
+    except User.DoesNotExist:
+        return None
+    except User.MultipleObjectsReturned:
+        end_user = await with_user_related(qs).filter(
+            pk=user_pk,
+        ).distinct().afirst()
+    except (AssertionError, TypeError, NotSupportedError):
+        try:
+            end_user = await with_user_related().aget(pk=user_pk)
+        except User.DoesNotExist:
+            return None
+        impersonable_pks = set()
+        async for pk in qs.values_list('pk', flat=True):
+            impersonable_pks.add(pk)
+        if end_user.pk not in impersonable_pks:
+            return None
+
+    if not check_allow_superuser(request, end_user):
+        return None
+    return end_user
+
+
+async def asession_get(session, key, default=None):
+    # SessionBase.aget() and friends are Django 5.1+
+    if hasattr(session, 'aget'):
+        return await session.aget(key, default)
+    return await sync_to_async(session.get)(key, default)
+
+
+async def asession_set(session, key, value):
+    if hasattr(session, 'aset'):
+        await session.aset(key, value)
+    else:
+        await sync_to_async(session.__setitem__)(key, value)
+
+
+async def asession_pop(session, key, default=None):
+    if hasattr(session, 'apop'):
+        return await session.apop(key, default)
+    return await sync_to_async(session.pop)(key, default)
+
+
+async def asession_save(session):
+    if hasattr(session, 'asave'):
+        await session.asave()
+    else:
+        await sync_to_async(session.save)()
+
+
+async def asend(signal, **kwargs):
+    # Signal.asend() is Django 5.0+
+    if hasattr(signal, 'asend'):
+        return await signal.asend(**kwargs)
+    return await sync_to_async(signal.send)(**kwargs)
@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from functools import wraps
+
+try:
+    # asgiref 3.6+
+    from asgiref.sync import iscoroutinefunction
+except ImportError:
+    from asyncio import iscoroutinefunction
+
+_instrumentation = None
+
+
+class BaseInstrumentation(object):
+    ''' Interface for IMPERSONATE_INSTRUMENTATION classes.
+
+        timing() is called after every instrumented function with the
+        time it took and, if count_queries is True, the number of queries
+        it ran on the default database. incr() is called for events such
+        as decision cache hits.
+    '''
+    enabled = True
+    count_queries = False
+
+    def timing(self, name, seconds, queries=None):
+        pass
+
+    def incr(self, name, value=1):
+        pass
+
+
+class NullInstrumentation(BaseInstrumentation):
+    ''' The default, instrumented functions are called straight away.
+    '''
+    enabled = False
+
+
+class LoggingInstrumentation(BaseInstrumentation):
+    ''' Logs every event to the 'impersonate.instrumentation' logger at
+        DEBUG level.
+    '''
+    count_queries = True
+    logger = logging.getLogger(__name__)
+
+    def timing(self, name, seconds, queries=None):
+        self.logger.debug(
+            '%s took %.3fms, %s queries',
+            name,
+            seconds * 1000,
+            queries,
+        )
+
+    def incr(self, name, value=1):
+        self.logger.debug('%s +%d', name, value)
+
+
+class MemoryInstrumentation(BaseInstrumentation):
+    ''' Keeps every event in memory, for tests and ad hoc profiling.
+    '''
+    count_queries = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.timings = defaultdict(list)
+            self.queries = defaultdict(list)
+            self.counters = Counter()
+
+    def timing(self, name, seconds, queries=None):
+        with self.lock:
+            self.timings[name].append(seconds)
+            if queries is not None:
+                self.queries[name].append(queries)
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def summary(self):
+        ''' Returns {name: {calls, total, max, queries}} for the timings.
+        '''
+        with self.lock:
+            return dict(
+                (name, {
+                    'calls': len(seconds),
+                    'total': sum(seconds),
+                    'max': max(seconds),
+                    'queries': sum(self.queries.get(name, ())),
+                })
+                for name, seconds in self.timings.items()
+            )
+
+
+def get_instrumentation():
+    ''' Returns the IMPERSONATE_INSTRUMENTATION instance.
+    '''
+    instrumentation = _instrumentation
+    if instrumentation is None:
+        instrumentation = _load_instrumentation()
+    return instrumentation
+
+
+def _load_instrumentation():
+    global _instrumentation
+
+    # helpers imports this module
+    from .helpers import get_setting_func
+
+    instrumentation_class = get_setting_func(
+        'IMPERSONATE_INSTRUMENTATION',
+        'impersonate.instrumentation.NullInstrumentation',
+    )
+    if instrumentation_class is None:
+        instrumentation_class = NullInstrumentation
+    _instrumentation = instrumentation_class()
+    return _instrumentation
+
+
+def reset_instrumentation(setting=None, **kwargs):
+    ''' setting_changed receiver
+    '''
+    global _instrumentation
+
+    if setting in (None, 'IMPERSONATE_INSTRUMENTATION'):
+        _instrumentation = None
+
+
+class QueryCounter(object):
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def incr(name, value=1):
+    instrumentation = _instrumentation or get_instrumentation()
+    if instrumentation.enabled:
+        instrumentation.incr(name, value)
+
+
+def instrumented(name):
+    ''' Decorator reporting the time taken by each call to the function
+        as the timing name. When instrumentation is disabled the only
+        cost is the enabled check.
+    '''
+    def decorator(func):
+        if iscoroutinefunction(func):
+            # Queries of async code run in other threads, not counted
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                instrumentation = _instrumentation or get_instrumentation()
+                if not instrumentation.enabled:
+                    return await func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    instrumentation.timing(name, time.perf_counter() - start)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            instrumentation = _instrumentation or get_instrumentation()
+            if not instrumentation.enabled:
+                return func(*args, **kwargs)
+
+            if not instrumentation.count_queries:
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    instrumentation.timing(name, time.perf_counter() - start)
+
+            from django.db import connection
+
+            counter = QueryCounter()
+            start = time.perf_counter()
+            try:
+                with connection.execute_wrapper(counter):
+                    return func(*args, **kwargs)
+            finally:
+                instrumentation.timing(
+                    name,
+                    time.perf_counter() - start,
+                    counter.count,
+                )
+        return wrapper
+    return decorator
@@ -0,0 +1,58 @@
+import time
+
+from django.core import signing
+
+from .config import get_config
+
+LEASE_KEY = '_impersonate_lease'
+LEASE_SALT = 'impersonate.lease'
+
+
+def get_lease_version(impersonator):
+    ''' Changes whenever a setting that affects check_allow_for_user()
+        or the impersonator's own status does.
+    '''
+    return u'{0}:{1:d}{2:d}{3:d}'.format(
+        get_config().fingerprint,
+        impersonator.is_superuser,
+        impersonator.is_staff,
+        impersonator.is_active,
+    )
+
+
+def make_lease(impersonator, target_pk):
+    ''' Returns the signed value stored in the session under LEASE_KEY
+        once impersonator is known to be allowed to impersonate target_pk:
+        [target pk, impersonator pk, valid until, version].
+    '''
+    return signing.dumps(
+        [
+            str(target_pk),
+            str(impersonator.pk),
+            int(time.time()) + get_config().lease_timeout,
+            get_lease_version(impersonator),
+        ],
+        salt=LEASE_SALT,
+    )
+
+
+def check_lease(lease, impersonator, target_pk):
+    ''' Returns True if lease still vouches for impersonator being allowed
+        to impersonate target_pk.
+    '''
+    if not lease:
+        return False
+    try:
+        target, impersonator_pk, valid_until, version = signing.loads(
+            lease,
+            salt=LEASE_SALT,
+        )
+    except (signing.BadSignature, TypeError, ValueError):
+        return False
+
+    return (
+        target == str(target_pk) and
+        impersonator_pk == str(impersonator.pk) and
+        valid_until > time.time() and
+        version == get_lease_version(impersonator)
+    )
@@ -1,46 +1,176 @@
-from django.conf import settings
+import time
 
-from .helpers import check_allow_for_user, get_redir_path
+from .audit import alog_begin, alog_end, log_begin, log_end
+from .cache import get_user_cache
+from .config import get_config
+from .dispatch import asend_session_signal, send_session_signal
+from .helpers import (acheck_allow_for_user, check_allow_for_user,
+                      get_redir_path)
+from .lease import LEASE_KEY, make_lease
+from .registry import START_KEY
 from .signals import session_begin, session_end
+from .state import get_state_backend
 
 
 def impersonate(request, new_user):
     if check_allow_for_user(request, new_user):
-        request.session['_impersonate'] = new_user.id
+        state = get_state_backend()
+        state.set(request, '_impersonate', new_user.id)
+        state.set(request, START_KEY, time.time())
+        if get_config().lease_timeout:
+            state.set(request, LEASE_KEY, make_lease(request.user, new_user.pk))
         prev_path = request.META.get('HTTP_REFERER')
         if prev_path:
-            request.session['_impersonate_prev_path'] = \
-                                request.build_absolute_uri(prev_path)
+            state.set(
+                request,
+                '_impersonate_prev_path',
+                request.build_absolute_uri(prev_path),
+            )
 
-        request.session.modified = True  # Let's make sure...
+        user_cache = get_user_cache()
+        if user_cache is not None:
+            # Ready for the first impersonated request
+            user_cache.warm(new_user)
+
+        log_begin(request, new_user)
+        # can be used to hook up auditing of the session
+        send_session_signal(
+            session_begin,
+            'session_begin',
+            request,
+            impersonator=request.user,
+            impersonating=new_user,
+        )
+
+
+async def aimpersonate(request, new_user):
+    ''' Async version of impersonate(), request.user has to be loaded
+        already (see request.auser())
+    '''
+    if await acheck_allow_for_user(request, new_user):
+        state = get_state_backend()
+        await state.aset(request, '_impersonate', new_user.id)
+        await state.aset(request, START_KEY, time.time())
+        if get_config().lease_timeout:
+            await state.aset(
+                request,
+                LEASE_KEY,
+                make_lease(request.user, new_user.pk),
+            )
+        prev_path = request.META.get('HTTP_REFERER')
+        if prev_path:
+            await state.aset(
+                request,
+                '_impersonate_prev_path',
+                request.build_absolute_uri(prev_path),
+            )
+
+        user_cache = get_user_cache()
+        if user_cache is not None:
+            await user_cache.awarm(new_user)
+
+        await alog_begin(request, new_user)
         # can be used to hook up auditing of the session
-        session_begin.send(
-            sender=None,
+        await asend_session_signal(
+            session_begin,
+            'session_begin',
+            request,
             impersonator=request.user,
             impersonating=new_user,
-            request=request
         )
 
 
 def stop_impersonate(request):
-    if '_impersonate' in request.session:
+    state = get_state_backend()
+    if state.get(request, '_impersonate') is not None:
         # modify request.user before popping _impersonate to trigger
         # apply_impersonate with the correct state
-        request.session.modified = True
         request.user.is_impersonate = False
         request.user = request.impersonator
 
-        impersonating = request.session.pop('_impersonate', None)
+        impersonating = state.pop(request, '_impersonate')
+        log_end(request, request.impersonator)
 
-        session_end.send(
-            sender=None,
+        send_session_signal(
+            session_end,
+            'session_end',
+            request,
             impersonator=request.impersonator,
             impersonating=impersonating,
-            request=request
         )
 
-    original_path = request.session.pop('_impersonate_prev_path', None)
-    use_refer = getattr(settings, 'IMPERSONATE_USE_HTTP_REFERER', False)
+    state.pop(request, LEASE_KEY)
+    state.pop(request, START_KEY)
+    original_path = state.pop(request, '_impersonate_prev_path')
+    use_refer = get_config().use_http_referer
     dest = original_path \
         if original_path and use_refer else get_redir_path(request)
     return dest
+
+
+async def astop_impersonate(request):
+    ''' Async version of stop_impersonate()
+    '''
+    # load request.user (and apply the impersonation) first
+    if hasattr(request, 'auser'):
+        await request.auser()
+
+    state = get_state_backend()
+    impersonating = await state.apop(request, '_impersonate')
+    if impersonating is not None:
+        request.user.is_impersonate = False
+        if request.impersonator is not None:
+            request.user = request.impersonator
+        await alog_end(request, request.impersonator)
+
+        await asend_session_signal(
+            session_end,
+            'session_end',
+            request,
+            impersonator=request.impersonator,
+            impersonating=impersonating,
+        )
+
+    await state.apop(request, LEASE_KEY)
+    await state.apop(request, START_KEY)
+    original_path = await state.apop(request, '_impersonate_prev_path')
+    use_refer = get_config().use_http_referer
+    dest = original_path \
+        if original_path and use_refer else get_redir_path(request)
+    return dest
+
+
+def end_revoked(request, impersonating):
+    ''' Ends an impersonation revoked with registry.revoke(), called by
+        the middleware instead of applying it. request.user is the
+        impersonator.
+    '''
+    state = get_state_backend()
+    for key in ('_impersonate', LEASE_KEY, START_KEY,
+                '_impersonate_prev_path'):
+        state.pop(request, key)
+    log_end(request, request.user)
+    send_session_signal(
+        session_end,
+        'session_end',
+        request,
+        impersonator=request.user,
+        impersonating=impersonating,
+    )
+
+
+async def aend_revoked(request, impersonating):
+    ''' Async version of end_revoked()
+    '''
+    state = get_state_backend()
+    for key in ('_impersonate', LEASE_KEY, START_KEY,
+                '_impersonate_prev_path'):
+        await state.apop(request, key)
+    await alog_end(request, request.user)
+    await asend_session_signal(
+        session_end,
+        'session_end',
+        request,
+        impersonator=request.user,
+        impersonating=impersonating,
+    )
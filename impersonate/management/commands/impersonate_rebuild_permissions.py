@@ -0,0 +1,77 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from ...config import get_config
+from ...helpers import User, get_setting_func
+from ...models import ImpersonationPermission, MaterializedImpersonator
+from ...permissions import BATCH_SIZE, is_materialized, refresh_impersonator
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuilds the ImpersonationPermission table from '
+        'IMPERSONATE_CUSTOM_USER_QUERYSET, one impersonator at a time.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=BATCH_SIZE,
+            help='Users loaded, and rows written, per query.',
+        )
+
+    def get_candidates(self):
+        ''' The users that may be allowed to impersonate. With the default
+            allow check only staff and superusers can be.
+        '''
+        qs = User.objects.all()
+        if get_setting_func('IMPERSONATE_CUSTOM_ALLOW') is None:
+            if get_config().require_superuser:
+                qs = qs.filter(is_superuser=True)
+            else:
+                qs = qs.filter(Q(is_superuser=True) | Q(is_staff=True))
+        return qs.order_by('pk')
+
+    def handle(self, *args, **options):
+        if not is_materialized():
+            raise CommandError(
+                'IMPERSONATE_MATERIALIZE_PERMISSIONS needs to be True and '
+                'IMPERSONATE_CUSTOM_USER_QUERYSET set.'
+            )
+        batch_size = options['batch_size']
+
+        # Impersonators with rows that may not be candidates any more
+        stale = set(
+            MaterializedImpersonator.objects.values_list(
+                'impersonator_id',
+                flat=True,
+            )
+        )
+        stale.update(
+            ImpersonationPermission.objects.values_list(
+                'impersonator_id',
+                flat=True,
+            ).distinct()
+        )
+
+        candidates = self.get_candidates()
+        done = changed = 0
+        last_pk = None
+        while True:
+            batch = candidates
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            batch = list(batch[:batch_size])
+            if not batch:
+                break
+            for user in batch:
+                changed += refresh_impersonator(user, batch_size)
+                stale.discard(user.pk)
+            done += len(batch)
+            last_pk = batch[-1].pk
+            self.stdout.write(u'{0} impersonator(s) done'.format(done))
+
+        for user in User.objects.filter(pk__in=stale):
+            changed += refresh_impersonator(user, batch_size)
+        self.stdout.write(u'Rebuilt, {0} row(s) changed'.format(changed))
@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from ...helpers import User
+from ...search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = (
+        'Creates (or drops) the database indexes used by the configured '
+        'IMPERSONATE_SEARCH_BACKEND on the user table.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--database',
+            default=DEFAULT_DB_ALIAS,
+            help='Database to create the indexes on, defaults to "default".',
+        )
+        parser.add_argument(
+            '--drop',
+            action='store_true',
+            help='Drop the indexes instead of creating them.',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Print the SQL instead of running it.',
+        )
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        indexes = get_search_backend().get_indexes(connection)
+        if not indexes:
+            raise CommandError(
+                'The search backend has no indexes for the {0} '
+                'database.'.format(connection.vendor)
+            )
+
+        existing = set()
+        if not options['drop']:
+            with connection.cursor() as cursor:
+                constraints = connection.introspection.get_constraints(
+                    cursor,
+                    User._meta.db_table,
+                )
+            existing = set(constraints)
+
+        # Build the indexes without locking the user table for writes.
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction.
+        kwargs = {}
+        if connection.vendor == 'postgresql':
+            kwargs['concurrently'] = True
+
+        with connection.schema_editor(atomic=False,
+                                      collect_sql=options['dry_run']) as editor:
+            if not options['drop'] and connection.vendor == 'postgresql':
+                editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+            for index in indexes:
+                if options['drop']:
+                    editor.remove_index(User, index, **kwargs)
+                elif index.name in existing:
+                    self.stdout.write(u'{0} already exists'.format(index.name))
+                else:
+                    editor.add_index(User, index, **kwargs)
+
+        if options['dry_run']:
+            for statement in editor.collected_sql:
+                self.stdout.write(statement)
@@ -0,0 +1,99 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...config import get_config
+from ...registry import get_active_sessions, revoke
+
+
+class Command(BaseCommand):
+    help = (
+        'Lists the active impersonation sessions, or revokes them on '
+        'every node with --revoke.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--impersonator',
+            help='Only sessions of the impersonator with this primary key.',
+        )
+        parser.add_argument(
+            '--impersonating',
+            help='Only sessions impersonating the user with this primary '
+                 'key.',
+        )
+        parser.add_argument(
+            '--session',
+            help='Only the impersonation in the session with this key.',
+        )
+        parser.add_argument(
+            '--revoke',
+            action='store_true',
+            help='End the matching sessions. Without a filter, ends every '
+                 'active session.',
+        )
+
+    def check_revocations(self):
+        ''' Revocations only reach other processes if the middleware looks
+            for them, in a cache those processes share
+        '''
+        from django.core.cache import caches
+        from django.core.cache.backends.dummy import DummyCache
+        from django.core.cache.backends.locmem import LocMemCache
+
+        config = get_config()
+        if not config.check_revocations:
+            raise CommandError(
+                'IMPERSONATE_CHECK_REVOCATIONS is off, the middleware would '
+                'not end revoked sessions.'
+            )
+        cache = caches[config.cache_alias]
+        if isinstance(cache, DummyCache):
+            raise CommandError(
+                u'The {0!r} cache does not store anything, revocations '
+                u'need a shared cache.'.format(config.cache_alias)
+            )
+        if isinstance(cache, LocMemCache):
+            self.stderr.write(
+                u'Warning: the {0!r} cache is local to this process, other '
+                u'processes will not see the revocations.'.format(
+                    config.cache_alias,
+                )
+            )
+
+    def handle(self, *args, **options):
+        if get_config().disable_logging:
+            raise CommandError(
+                'Active sessions are read from the ImpersonationLog table, '
+                'which IMPERSONATE_DISABLE_LOGGING turns off.'
+            )
+
+        filters = dict(
+            impersonator=options['impersonator'],
+            impersonating=options['impersonating'],
+            session_key=options['session'],
+        )
+        sessions = get_active_sessions(**filters).order_by(
+            'session_started_at',
+        )
+
+        if not options['revoke']:
+            for log in sessions:
+                self.stdout.write(u'{0}\t{1}\t{2}\t{3}'.format(
+                    log.session_started_at.isoformat(),
+                    log.impersonator_id,
+                    log.impersonating_id,
+                    log.session_key,
+                ))
+            return
+
+        self.check_revocations()
+        if any(value is not None for value in filters.values()):
+            ended = revoke(**filters)
+        else:
+            # One revocation per impersonator covers all their sessions
+            impersonators = set(
+                sessions.values_list('impersonator_id', flat=True)
+            )
+            ended = 0
+            for impersonator in impersonators:
+                ended += revoke(impersonator=impersonator)
+        self.stdout.write(u'Revoked {0} session(s)'.format(ended))
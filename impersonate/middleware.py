@@ -1,29 +1,218 @@
-from django.utils.deprecation import MiddlewareMixin
 from django.utils.functional import empty, SimpleLazyObject
-from .helpers import User, check_allow_for_uri, check_allow_for_user
+from .cache import get_decision_cache, get_user_cache
+from .config import get_config
+from .helpers import (User, aget_impersonable_user, check_allow_for_request,
+                      check_allow_superuser, get_impersonable_user,
+                      sync_to_async, with_user_related)
+from .instrumentation import incr, instrumented
+from .lease import LEASE_KEY, check_lease, make_lease
+from .logic import aend_revoked, end_revoked
+from .registry import ais_revoked, is_revoked
+from .state import get_state_backend
 
+try:
+    # asgiref 3.6+
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:
+    iscoroutinefunction = markcoroutinefunction = None
 
-def apply_impersonate(request):
+
+def get_impersonated_user(request, new_user_id):
+    ''' Returns the user to impersonate, or None if that user does not
+        exist or may not be impersonated by request.user.
+
+        Costs a single query; get_impersonable_user() fetches and
+        authorizes in one go, and a valid lease or a decision cache hit
+        (if enabled) reduces it to a plain primary key lookup.
+    '''
+    lease_timeout = get_config().lease_timeout
+    if lease_timeout and check_lease(
+            get_state_backend().get(request, LEASE_KEY),
+            request.user,
+            new_user_id):
+        incr('lease.hit')
+        try:
+            new_user = with_user_related().get(pk=new_user_id)
+        except User.DoesNotExist:
+            return None
+        if check_allow_superuser(request, new_user):
+            return new_user
+        return None
+
+    decision_cache = get_decision_cache()
+    if decision_cache is not None:
+        allowed = decision_cache.get(request.user.pk, new_user_id)
+        incr('decision_cache.miss' if allowed is None else 'decision_cache.hit')
+        if allowed is not None:
+            if not allowed:
+                return None
+            try:
+                return with_user_related().get(pk=new_user_id)
+            except User.DoesNotExist:
+                return None
+
+    new_user = get_impersonable_user(request, new_user_id)
+    if decision_cache is not None and new_user is not None:
+        decision_cache.set(request.user.pk, new_user.pk, True)
+    if lease_timeout and new_user is not None:
+        get_state_backend().set(
+            request,
+            LEASE_KEY,
+            make_lease(request.user, new_user.pk),
+        )
+    return new_user
+
+
+async def aget_impersonated_user(request, new_user_id):
+    ''' Async version of get_impersonated_user()
+    '''
+    lease_timeout = get_config().lease_timeout
+    if lease_timeout:
+        lease = await get_state_backend().aget(request, LEASE_KEY)
+        if check_lease(lease, request.user, new_user_id):
+            incr('lease.hit')
+            try:
+                new_user = await with_user_related().aget(pk=new_user_id)
+            except User.DoesNotExist:
+                return None
+            if check_allow_superuser(request, new_user):
+                return new_user
+            return None
+
+    decision_cache = get_decision_cache()
+    if decision_cache is not None and not hasattr(decision_cache, 'aget'):
+        # Custom decision cache without async methods
+        decision_cache = None
+
+    if decision_cache is not None:
+        allowed = await decision_cache.aget(request.user.pk, new_user_id)
+        incr('decision_cache.miss' if allowed is None else 'decision_cache.hit')
+        if allowed is not None:
+            if not allowed:
+                return None
+            try:
+                return await with_user_related().aget(pk=new_user_id)
+            except User.DoesNotExist:
+                return None
+
+    new_user = await aget_impersonable_user(request, new_user_id)
+    if decision_cache is not None and new_user is not None:
+        await decision_cache.aset(request.user.pk, new_user.pk, True)
+    if lease_timeout and new_user is not None:
+        await get_state_backend().aset(
+            request,
+            LEASE_KEY,
+            make_lease(request.user, new_user.pk),
+        )
+    return new_user
+
+
+@instrumented('apply_impersonate')
+def apply_impersonate(request, allowed=None):
+    ''' allowed is the result of check_allow_for_request(request), if the
+        caller has it already.
+    '''
     request.user.is_impersonate = False
     request.impersonator = None
 
-    if request.user.is_authenticated and \
-       '_impersonate' in request.session:
-        new_user_id = request.session['_impersonate']
+    if allowed is None:
+        allowed = check_allow_for_request(request)
+
+    # The path and host are checked first, they are free to look at
+    if allowed and request.user.is_authenticated:
+        new_user_id = get_state_backend().get(request, '_impersonate')
+        if new_user_id is None:
+            return
         if isinstance(new_user_id, User):
             # Edge case for issue 15
             new_user_id = new_user_id.id
 
-        try:
-            new_user = User.objects.get(id=new_user_id)
-        except User.DoesNotExist:
+        if get_config().check_revocations and \
+           is_revoked(request, new_user_id):
+            incr('impersonate.revoked')
+            end_revoked(request, new_user_id)
             return
 
-        if check_allow_for_user(request, new_user) and \
-           check_allow_for_uri(request.path):
+        new_user = get_impersonated_user(request, new_user_id)
+        if new_user is not None:
+            user_cache = get_user_cache()
+            if user_cache is not None:
+                hit = user_cache.warm(new_user)
+                incr('user_cache.hit' if hit else 'user_cache.miss')
             request.impersonator = request.user
             request.user = new_user
             request.user.is_impersonate = True
+            incr('impersonate.applied')
+
+
+@instrumented('aapply_impersonate')
+async def aapply_impersonate(request, allowed=None):
+    ''' Async version of apply_impersonate(), request.user has to be
+        loaded already.
+    '''
+    request.user.is_impersonate = False
+    request.impersonator = None
+
+    if allowed is None:
+        allowed = check_allow_for_request(request)
+
+    if allowed and request.user.is_authenticated:
+        new_user_id = await get_state_backend().aget(request, '_impersonate')
+        if new_user_id is None:
+            return
+        if isinstance(new_user_id, User):
+            # Edge case for issue 15
+            new_user_id = new_user_id.id
+
+        if get_config().check_revocations and \
+           await ais_revoked(request, new_user_id):
+            incr('impersonate.revoked')
+            await aend_revoked(request, new_user_id)
+            return
+
+        new_user = await aget_impersonated_user(request, new_user_id)
+        if new_user is not None:
+            user_cache = get_user_cache()
+            if user_cache is not None:
+                hit = await user_cache.awarm(new_user)
+                incr('user_cache.hit' if hit else 'user_cache.miss')
+            request.impersonator = request.user
+            request.user = new_user
+            request.user.is_impersonate = True
+            incr('impersonate.applied')
+
+
+def skip_impersonate(request):
+    ''' For requests that can never impersonate, see
+        check_allow_for_request(). Neither loads request.user nor touches
+        the session.
+    '''
+    request.impersonator = None
+
+    user = request.user
+    if isinstance(user, SimpleLazyObject) and \
+       user.__dict__['_wrapped'] is empty:
+        get_user = user.__dict__['_setupfunc']
+
+        def wrap_user():
+            request.user = get_user()
+            request.user.is_impersonate = False
+            return request.user
+
+        user.__dict__['_setupfunc'] = wrap_user
+    else:
+        user.is_impersonate = False
+
+    if hasattr(request, 'auser'):
+        get_auser = request.auser
+
+        async def wrap_auser():
+            user = await get_auser()
+            user.is_impersonate = False
+            return user
+
+        request.auser = wrap_auser
+        request.aimpersonator = lambda: aimpersonator(request)
 
 
 def impersonator(request):
@@ -33,16 +222,56 @@ def impersonator(request):
     return request.impersonator
 
 
-class ImpersonateMiddleware(MiddlewareMixin):
+async def aimpersonator(request):
+    # Trigger aapply_impersonate
+    await request.auser()
+
+    return request.impersonator
+
+
+class ImpersonateMiddleware(object):
+    ''' Works as both sync and async middleware. Under ASGI the
+        impersonation is applied from request.auser() (and
+        request.aimpersonator()) without leaving the event loop.
+    '''
+    sync_capable = True
+    async_capable = markcoroutinefunction is not None
+
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+        self.is_async = (
+            self.async_capable and
+            get_response is not None and
+            iscoroutinefunction(get_response)
+        )
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        self.process_request(request)
+        return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        await self.aprocess_request(request)
+        response = await self.get_response(request)
+        await get_state_backend().asave(request, response)
+        return response
+
     def process_request(self, request):
+        if not check_allow_for_request(request):
+            skip_impersonate(request)
+            return None
+
         # User isn't lazy, don't preserve laziness.
         if not isinstance(request.user, SimpleLazyObject):
-            apply_impersonate(request)
+            apply_impersonate(request, allowed=True)
             return None
 
         # User is already set up, don't preserve laziness
         if request.user.__dict__['_wrapped'] is not empty:
-            apply_impersonate(request)
+            apply_impersonate(request, allowed=True)
             return None
 
         # User is still lazy and not set up. This request may not care about
@@ -52,9 +281,48 @@ class ImpersonateMiddleware(MiddlewareMixin):
 
         def wrap_user():
             request.user = get_user()
-            apply_impersonate(request)
+            apply_impersonate(request, allowed=True)
             return request.user
 
         request.user.__dict__['_setupfunc'] = wrap_user
         request.impersonator = SimpleLazyObject(lambda: impersonator(request))
         return None
+
+    def process_response(self, request, response):
+        ''' Lets IMPERSONATE_STATE_BACKEND write the state if it changed
+        '''
+        get_state_backend().save(request, response)
+        return response
+
+    async def aprocess_request(self, request):
+        if not check_allow_for_request(request):
+            skip_impersonate(request)
+            return None
+
+        if not hasattr(request, 'auser'):
+            # Django < 5.0 has no async way to load the user
+            await sync_to_async(self.process_request)(request)
+            return None
+
+        lazy_user = request.user
+        if isinstance(lazy_user, SimpleLazyObject) and \
+           lazy_user.__dict__['_wrapped'] is empty:
+            # Keep request.user lazy for sync code, see process_request()
+            self.process_request(request)
+        else:
+            await aapply_impersonate(request, allowed=True)
+
+        get_auser = request.auser
+
+        async def wrap_auser():
+            # Unless sync code got to request.user first
+            if request.user is lazy_user and \
+               isinstance(lazy_user, SimpleLazyObject) and \
+               lazy_user.__dict__['_wrapped'] is empty:
+                request.user = await get_auser()
+                await aapply_impersonate(request, allowed=True)
+            return request.user
+
+        request.auser = wrap_auser
+        request.aimpersonator = lambda: aimpersonator(request)
+        return None
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImpersonationLog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_key', models.CharField(blank=True, max_length=40)),
+                ('session_started_at', models.DateTimeField()),
+                ('session_ended_at', models.DateTimeField(blank=True, null=True)),
+                ('impersonating', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='impersonated_by', to=settings.AUTH_USER_MODEL)),
+                ('impersonator', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='impersonations', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ('-session_started_at',),
+                'indexes': [
+                    models.Index(fields=['session_ended_at', 'session_started_at'], name='impersonate_log_active'),
+                    models.Index(fields=['session_key', 'impersonator'], name='impersonate_log_session'),
+                    models.Index(fields=['impersonator', 'session_started_at'], name='impersonate_log_impersonator'),
+                    models.Index(fields=['impersonating', 'session_started_at'], name='impersonate_log_impersonating'),
+                ],
+            },
+        ),
+    ]
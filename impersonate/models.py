@@ -1 +1,99 @@
-# Empty on purpose
+from django.conf import settings
+from django.db import models
+
+
+class ImpersonationLog(models.Model):
+    ''' A record of one impersonation session. Rows are written in
+        batches, see impersonate.audit
+    '''
+    impersonator = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name='impersonations',
+        on_delete=models.CASCADE,
+        db_index=False,
+    )
+    impersonating = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name='impersonated_by',
+        on_delete=models.CASCADE,
+        db_index=False,
+    )
+    session_key = models.CharField(max_length=40, blank=True)
+    session_started_at = models.DateTimeField()
+    session_ended_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('-session_started_at',)
+        indexes = [
+            # Active sessions: session_ended_at IS NULL
+            models.Index(
+                fields=['session_ended_at', 'session_started_at'],
+                name='impersonate_log_active',
+            ),
+            # Ending a session
+            models.Index(
+                fields=['session_key', 'impersonator'],
+                name='impersonate_log_session',
+            ),
+            # History per user, in either role
+            models.Index(
+                fields=['impersonator', 'session_started_at'],
+                name='impersonate_log_impersonator',
+            ),
+            models.Index(
+                fields=['impersonating', 'session_started_at'],
+                name='impersonate_log_impersonating',
+            ),
+        ]
+
+    def __str__(self):
+        return u'{0} as {1} ({2})'.format(
+            self.impersonator_id,
+            self.impersonating_id,
+            self.session_started_at,
+        )
+
+    @property
+    def duration(self):
+        if self.session_ended_at is None:
+            return None
+        return self.session_ended_at - self.session_started_at
+
+
+class ImpersonationPermission(models.Model):
+    ''' Materialized IMPERSONATE_CUSTOM_USER_QUERYSET: impersonator may
+        impersonate target. See impersonate.permissions
+    '''
+    impersonator = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name='+',
+        on_delete=models.CASCADE,
+        db_index=False,
+    )
+    target = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name='+',
+        on_delete=models.CASCADE,
+    )
+
+    class Meta:
+        # Also the index behind users_impersonable() and the pk probes
+        unique_together = (('impersonator', 'target'),)
+
+    def __str__(self):
+        return u'{0} -> {1}'.format(self.impersonator_id, self.target_id)
+
+
+class MaterializedImpersonator(models.Model):
+    ''' Marks the ImpersonationPermission rows of impersonator as up to
+        date, even if there are none
+    '''
+    impersonator = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        related_name='+',
+        on_delete=models.CASCADE,
+        primary_key=True,
+    )
+
+    def __str__(self):
+        return str(self.impersonator_id)
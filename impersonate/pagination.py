@@ -0,0 +1,287 @@
+import hashlib
+import json
+
+from django.core import signing
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.db import DatabaseError, connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+from .config import get_config
+
+CURSOR_SALT = 'impersonate.pagination.cursor'
+NEXT, PREVIOUS = 'n', 'p'
+
+
+class CursorPage(object):
+    ''' A page of results from CursorPaginator. Quacks enough like
+        django.core.paginator.Page for the shipped templates, but has
+        next_cursor/previous_cursor instead of page numbers.
+    '''
+    def __init__(self, object_list, paginator, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return '<CursorPage of {0} objects>'.format(len(self.object_list))
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class CursorPaginator(object):
+    ''' Keyset pagination over (ordering_field, pk).
+
+        Each page is a single indexed range query, there is no OFFSET and
+        no COUNT(*). The position is passed around as an opaque, signed
+        cursor. ordering_field must be a non-nullable field; it defaults
+        to the primary key.
+    '''
+    is_cursor = True
+
+    def __init__(self, object_list, per_page, ordering_field='pk'):
+        self.object_list = object_list
+        self.per_page = int(per_page)
+        self.ordering_field = ordering_field
+
+    def _ordering(self):
+        if self.ordering_field == 'pk':
+            return ('pk',)
+        return (self.ordering_field, 'pk')
+
+    def _value(self, obj):
+        value = getattr(obj, self.ordering_field)
+        if isinstance(value, (str, int, float)):
+            return value
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()
+        return str(value)
+
+    def _pk(self, obj):
+        # JSON has no UUIDs, those (and other pk types) go as strings
+        if isinstance(obj.pk, int):
+            return obj.pk
+        return str(obj.pk)
+
+    def encode_cursor(self, obj, direction):
+        position = [self._pk(obj), direction]
+        if self.ordering_field != 'pk':
+            position.append(self._value(obj))
+        return signing.dumps(position, salt=CURSOR_SALT)
+
+    def decode_cursor(self, cursor):
+        ''' Returns (pk, direction, value) or None if the cursor is
+            missing, tampered with or from a different ordering field.
+        '''
+        if not cursor:
+            return None
+        try:
+            position = signing.loads(cursor, salt=CURSOR_SALT)
+        except signing.BadSignature:
+            return None
+
+        expected_length = 2 if self.ordering_field == 'pk' else 3
+        if not isinstance(position, list) or \
+           len(position) != expected_length or \
+           position[1] not in (NEXT, PREVIOUS):
+            return None
+        try:
+            position[0] = self.object_list.model._meta.pk.to_python(
+                position[0],
+            )
+        except ValidationError:
+            return None
+        position.append(None)
+        return tuple(position[:3])
+
+    def _after(self, pk, value):
+        if self.ordering_field == 'pk':
+            return Q(pk__gt=pk)
+        return (
+            Q(**{'{0}__gt'.format(self.ordering_field): value}) |
+            Q(**{self.ordering_field: value, 'pk__gt': pk})
+        )
+
+    def _before(self, pk, value):
+        if self.ordering_field == 'pk':
+            return Q(pk__lt=pk)
+        return (
+            Q(**{'{0}__lt'.format(self.ordering_field): value}) |
+            Q(**{self.ordering_field: value, 'pk__lt': pk})
+        )
+
+    def page(self, cursor=None):
+        ordering = self._ordering()
+        position = self.decode_cursor(cursor)
+        limit = self.per_page + 1
+
+        if position is None:
+            rows = list(self.object_list.order_by(*ordering)[:limit])
+            has_more = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            has_next, has_previous = has_more, False
+        elif position[1] == NEXT:
+            pk, direction, value = position
+            qs = self.object_list.filter(self._after(pk, value))
+            rows = list(qs.order_by(*ordering)[:limit])
+            has_more = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            has_next, has_previous = has_more, True
+        else:
+            pk, direction, value = position
+            qs = self.object_list.filter(self._before(pk, value))
+            reverse_ordering = ['-{0}'.format(field) for field in ordering]
+            rows = list(qs.order_by(*reverse_ordering)[:limit])
+            has_more = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            rows.reverse()
+            has_next, has_previous = True, has_more
+
+        next_cursor = previous_cursor = None
+        if rows and has_next:
+            next_cursor = self.encode_cursor(rows[-1], NEXT)
+        if rows and has_previous:
+            previous_cursor = self.encode_cursor(rows[0], PREVIOUS)
+
+        return CursorPage(rows, self, next_cursor, previous_cursor)
+
+
+def estimate_count(qs):
+    ''' Returns the row count the query planner expects qs to return,
+        or None if the database does not offer a cheap estimate.
+        Only PostgreSQL is supported.
+    '''
+    if connections[qs.db].vendor != 'postgresql':
+        return None
+    try:
+        plan = json.loads(qs.order_by().explain(format='json'))
+    except (DatabaseError, ValueError):
+        return None
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def cached_count(qs, timeout):
+    ''' Returns qs.count(), cached for timeout seconds in the
+        IMPERSONATE_CACHE_ALIAS cache.
+    '''
+    sql, params = qs.order_by().query.sql_with_params()
+    key = 'impersonate:count:{0}'.format(hashlib.md5(
+        u'{0}:{1}:{2!r}'.format(qs.db, sql, params).encode('utf-8')
+    ).hexdigest())
+    cache = caches[get_config().cache_alias]
+    count = cache.get(key)
+    if count is None:
+        count = qs.count()
+        cache.set(key, count, timeout)
+    return count
+
+
+class CountlessPage(Page):
+    ''' Page from CountlessPaginator, has_next() is known from fetching
+        one row more than the page needs.
+    '''
+    def __init__(self, object_list, number, paginator, has_next):
+        super(CountlessPage, self).__init__(object_list, number, paginator)
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+    def next_page_number(self):
+        if not self._has_next:
+            raise EmptyPage('That page contains no results')
+        return self.number + 1
+
+    def previous_page_number(self):
+        if self.number <= 1:
+            raise EmptyPage('That page number is less than 1')
+        return self.number - 1
+
+    def start_index(self):
+        if not self.object_list:
+            return 0
+        return (self.number - 1) * self.paginator.per_page + 1
+
+    def end_index(self):
+        return (self.number - 1) * self.paginator.per_page + \
+            len(self.object_list)
+
+
+class CountlessPaginator(Paginator):
+    ''' Paginator that never runs COUNT(*) over the whole queryset to
+        serve a page. It fetches per_page + 1 rows to find out whether
+        there is a next page.
+
+        count (and so num_pages) depends on count_strategy:
+          * 'none' - unknown, None
+          * 'estimate' - the query planner's estimate on PostgreSQL, or an
+                         exact count cached for count_timeout seconds on
+                         other databases
+        Either way count_is_estimate is True when count is set, as the
+        value may be stale.
+    '''
+    def __init__(self, object_list, per_page, count_strategy='none',
+                 count_timeout=300):
+        super(CountlessPaginator, self).__init__(object_list, per_page)
+        self.count_strategy = count_strategy
+        self.count_timeout = count_timeout
+
+    def validate_number(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not rows and number > 1:
+            raise EmptyPage('That page contains no results')
+        return CountlessPage(
+            rows[:self.per_page],
+            number,
+            self,
+            len(rows) > self.per_page,
+        )
+
+    @cached_property
+    def count(self):
+        if self.count_strategy != 'estimate':
+            return None
+        count = estimate_count(self.object_list)
+        if count is None:
+            count = cached_count(self.object_list, self.count_timeout)
+        return count
+
+    @property
+    def count_is_estimate(self):
+        return self.count is not None
+
+    @cached_property
+    def num_pages(self):
+        if self.count is None:
+            return None
+        return super(CountlessPaginator, self).num_pages
@@ -0,0 +1,300 @@
+from django.db import transaction
+
+from .config import get_config
+from .helpers import User, check_allow_default, get_setting_func
+
+# Rows per INSERT/DELETE when refreshing, see refresh_impersonator()
+BATCH_SIZE = 500
+
+# Where remember_user_fields() keeps the stored field values of a user
+FIELDS_ATTR = '_impersonate_fields'
+
+# Where refresh_group_permissions() and remember_group_members() keep the
+# members of a group that is cleared or deleted
+MEMBERS_ATTR = '_impersonate_members'
+
+
+def is_materialized():
+    ''' Returns True if users_impersonable() reads the
+        ImpersonationPermission table instead of calling
+        IMPERSONATE_CUSTOM_USER_QUERYSET
+    '''
+    config = get_config()
+    return bool(
+        config.materialize_permissions and config.custom_user_queryset
+    )
+
+
+def materialized_users(impersonator):
+    ''' The users impersonator can impersonate according to the
+        ImpersonationPermission table, as an indexed semi-join
+    '''
+    from .models import ImpersonationPermission
+
+    return User.objects.filter(
+        pk__in=ImpersonationPermission.objects.filter(
+            impersonator_id=impersonator.pk,
+        ).values('target_id'),
+    )
+
+
+def has_permission(impersonator, target_pk):
+    ''' Primary key probe of the ImpersonationPermission table
+    '''
+    from .models import ImpersonationPermission
+
+    return ImpersonationPermission.objects.filter(
+        impersonator_id=impersonator.pk,
+        target_id=target_pk,
+    ).exists()
+
+
+async def ahas_permission(impersonator, target_pk):
+    ''' Async version of has_permission()
+    '''
+    from .models import ImpersonationPermission
+
+    return await ImpersonationPermission.objects.filter(
+        impersonator_id=impersonator.pk,
+        target_id=target_pk,
+    ).aexists()
+
+
+def _allowed(impersonator):
+    ''' check_allow_impersonate() without a request
+    '''
+    if not impersonator.is_active:
+        return False
+    custom_allow_func = get_setting_func('IMPERSONATE_CUSTOM_ALLOW')
+    if custom_allow_func is not None:
+        return custom_allow_func(impersonator, None)
+    return check_allow_default(impersonator)
+
+
+def _custom_queryset(impersonator):
+    return get_setting_func('IMPERSONATE_CUSTOM_USER_QUERYSET')(
+        impersonator,
+        None,
+    )
+
+
+def _chunks(values, size):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def refresh_impersonator(impersonator, batch_size=BATCH_SIZE):
+    ''' Brings the rows of impersonator up to date: evaluates
+        IMPERSONATE_CUSTOM_USER_QUERYSET once and only writes the
+        difference with the stored targets. Returns the number of rows
+        added and removed.
+    '''
+    from .models import ImpersonationPermission, MaterializedImpersonator
+
+    rows = ImpersonationPermission.objects.filter(
+        impersonator_id=impersonator.pk,
+    )
+    if not _allowed(impersonator):
+        MaterializedImpersonator.objects.filter(
+            impersonator_id=impersonator.pk,
+        ).delete()
+        return rows.delete()[0]
+
+    targets = set(
+        _custom_queryset(impersonator).values_list('pk', flat=True)
+    )
+    with transaction.atomic():
+        # refresh_target() only looks at materialized impersonators
+        MaterializedImpersonator.objects.get_or_create(
+            impersonator_id=impersonator.pk,
+        )
+        stored = set(rows.values_list('target_id', flat=True))
+        removed = stored - targets
+        for pks in _chunks(removed, batch_size):
+            rows.filter(target_id__in=pks).delete()
+
+        added = targets - stored
+        # A concurrent refresh may have added some of them already
+        ImpersonationPermission.objects.bulk_create(
+            [
+                ImpersonationPermission(
+                    impersonator_id=impersonator.pk,
+                    target_id=pk,
+                )
+                for pk in added
+            ],
+            batch_size=batch_size,
+            ignore_conflicts=True,
+        )
+    return len(added) + len(removed)
+
+
+def refresh_target(target):
+    ''' Brings the rows of target up to date, probing the custom
+        queryset of every materialized impersonator for it. Returns the
+        number of rows added and removed.
+    '''
+    from .models import ImpersonationPermission, MaterializedImpersonator
+
+    impersonator_pks = MaterializedImpersonator.objects.values_list(
+        'impersonator_id',
+        flat=True,
+    )
+    allowed_by = set(
+        ImpersonationPermission.objects.filter(
+            target_id=target.pk,
+        ).values_list('impersonator_id', flat=True)
+    )
+
+    changed = 0
+    for impersonator in User.objects.filter(pk__in=impersonator_pks):
+        allowed = _custom_queryset(impersonator).filter(
+            pk=target.pk,
+        ).exists()
+        if allowed and impersonator.pk not in allowed_by:
+            ImpersonationPermission.objects.bulk_create(
+                [ImpersonationPermission(
+                    impersonator_id=impersonator.pk,
+                    target_id=target.pk,
+                )],
+                ignore_conflicts=True,
+            )
+            changed += 1
+        elif not allowed and impersonator.pk in allowed_by:
+            ImpersonationPermission.objects.filter(
+                impersonator_id=impersonator.pk,
+                target_id=target.pk,
+            ).delete()
+            changed += 1
+    return changed
+
+
+def refresh_permissions(impersonators=(), targets=()):
+    ''' Refreshes the rows of some impersonators and targets (users or
+        primary keys), for projects whose custom queryset depends on
+        models other than the user, e.g. from their own signal receivers
+    '''
+    users = {}
+    pks = set()
+    for user_or_pk in list(impersonators) + list(targets):
+        pks.add(getattr(user_or_pk, 'pk', user_or_pk))
+    for user in User.objects.filter(pk__in=pks):
+        users[user.pk] = user
+
+    changed = 0
+    for user_or_pk in impersonators:
+        user = users.get(getattr(user_or_pk, 'pk', user_or_pk))
+        if user is not None:
+            changed += refresh_impersonator(user)
+    for user_or_pk in targets:
+        user = users.get(getattr(user_or_pk, 'pk', user_or_pk))
+        if user is not None:
+            changed += refresh_target(user)
+    return changed
+
+
+def _tracked_fields():
+    ''' The attnames of IMPERSONATE_MATERIALIZE_FIELDS, or None to
+        refresh on every save
+    '''
+    names = get_config().materialize_fields
+    if names is None:
+        return None
+    return tuple(User._meta.get_field(name).attname for name in names)
+
+
+def remember_user_fields(sender, instance, raw=False, update_fields=None,
+                         **kwargs):
+    ''' pre_save receiver for the user model, keeps the stored values of
+        IMPERSONATE_MATERIALIZE_FIELDS so refresh_user_permissions() can
+        tell whether they changed
+    '''
+    if raw or update_fields is not None or instance._state.adding or \
+       not is_materialized():
+        return
+    attnames = _tracked_fields()
+    if attnames is None:
+        return
+    instance.__dict__[FIELDS_ATTR] = sender._default_manager.filter(
+        pk=instance.pk,
+    ).values_list(*attnames).first()
+
+
+def _fields_changed(instance, update_fields):
+    attnames = _tracked_fields()
+    if update_fields is not None:
+        update_fields = set(update_fields)
+        if attnames is None:
+            # Logging in
+            return not update_fields <= set(['last_login'])
+        names = set(get_config().materialize_fields) | set(attnames)
+        return bool(update_fields & names)
+
+    stored = instance.__dict__.pop(FIELDS_ATTR, None)
+    if attnames is None or stored is None:
+        return True
+    return stored != tuple(getattr(instance, name) for name in attnames)
+
+
+def refresh_user_permissions(sender, instance, created=False,
+                             update_fields=None, raw=False, **kwargs):
+    ''' post_save receiver for the user model, a new user, or one whose
+        IMPERSONATE_MATERIALIZE_FIELDS changed, is refreshed both as
+        impersonator and as target once the transaction commits
+    '''
+    if raw or not is_materialized():
+        return
+    if not created and not _fields_changed(instance, update_fields):
+        return
+
+    pk = instance.pk
+    transaction.on_commit(
+        lambda: refresh_permissions(impersonators=[pk], targets=[pk])
+    )
+
+
+def _group_members(group):
+    return list(User.objects.filter(groups=group).values_list('pk', flat=True))
+
+
+def _refresh_members(pks):
+    if pks:
+        transaction.on_commit(
+            lambda: refresh_permissions(impersonators=pks, targets=pks)
+        )
+
+
+def refresh_group_permissions(sender, instance, action, reverse=False,
+                              pk_set=None, **kwargs):
+    ''' m2m_changed receiver for user.groups
+    '''
+    if not is_materialized() or \
+       action not in ('pre_clear', 'post_add', 'post_remove', 'post_clear'):
+        return
+
+    if action == 'pre_clear':
+        # group.user_set.clear() does not tell who the members were
+        if reverse:
+            instance.__dict__[MEMBERS_ATTR] = _group_members(instance)
+    elif not reverse:
+        _refresh_members([instance.pk])
+    elif action == 'post_clear':
+        _refresh_members(instance.__dict__.pop(MEMBERS_ATTR, None))
+    else:
+        _refresh_members(list(pk_set or ()))
+
+
+def remember_group_members(sender, instance, **kwargs):
+    ''' pre_delete receiver for the group model, deleting a group removes
+        its memberships without sending m2m_changed
+    '''
+    if is_materialized():
+        instance.__dict__[MEMBERS_ATTR] = _group_members(instance)
+
+
+def refresh_group_members(sender, instance, **kwargs):
+    ''' post_delete receiver for the group model, refreshes the members
+        remember_group_members() found once the transaction commits
+    '''
+    _refresh_members(instance.__dict__.pop(MEMBERS_ATTR, None))
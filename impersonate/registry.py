@@ -0,0 +1,152 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+from .config import get_config
+from .state import get_state_backend
+
+# Session key holding when the impersonation started, as a timestamp
+START_KEY = '_impersonate_start'
+
+REVOCATION_PREFIX = 'impersonate:revoked'
+
+
+def get_active_sessions(impersonator=None, impersonating=None,
+                        session_key=None):
+    ''' Returns the ImpersonationLog rows of active impersonation sessions,
+        optionally only those of an impersonator, an impersonated user or
+        a session. Needs IMPERSONATE_DISABLE_LOGGING to be False.
+    '''
+    from .models import ImpersonationLog
+
+    qs = ImpersonationLog.objects.filter(session_ended_at__isnull=True)
+    if impersonator is not None:
+        qs = qs.filter(impersonator=impersonator)
+    if impersonating is not None:
+        qs = qs.filter(impersonating=impersonating)
+    if session_key is not None:
+        qs = qs.filter(session_key=session_key)
+    return qs
+
+
+def _revocation_key(impersonator_pk=None, impersonating_pk=None,
+                    session_key=None):
+    ''' The cache key revoking the sessions matching all the arguments
+        given, a session key alone is specific enough.
+    '''
+    if session_key:
+        return u'{0}:session:{1}'.format(REVOCATION_PREFIX, session_key)
+    if impersonator_pk is not None and impersonating_pk is not None:
+        return u'{0}:pair:{1}:{2}'.format(
+            REVOCATION_PREFIX,
+            impersonator_pk,
+            impersonating_pk,
+        )
+    if impersonator_pk is not None:
+        return u'{0}:impersonator:{1}'.format(
+            REVOCATION_PREFIX,
+            impersonator_pk,
+        )
+    if impersonating_pk is not None:
+        return u'{0}:impersonating:{1}'.format(
+            REVOCATION_PREFIX,
+            impersonating_pk,
+        )
+    return None
+
+
+def _revocation_keys(request, impersonating_pk):
+    ''' Every key that can revoke the impersonation in request
+    '''
+    keys = [
+        _revocation_key(impersonator_pk=request.user.pk),
+        _revocation_key(impersonating_pk=impersonating_pk),
+        _revocation_key(request.user.pk, impersonating_pk),
+    ]
+    session_key = getattr(request.session, 'session_key', None)
+    if session_key:
+        keys.append(_revocation_key(session_key=session_key))
+    return keys
+
+
+def _cache():
+    return caches[get_config().cache_alias]
+
+
+def revoke(impersonator=None, impersonating=None, session_key=None):
+    ''' Ends the impersonation sessions of an impersonator, of an
+        impersonated user, of both, or in a session (users or primary
+        keys), on every node sharing the cache.
+
+        A revocation is a single cache entry holding the time it was
+        made, kept for SESSION_COOKIE_AGE: the middleware drops any matching impersonation that
+        started earlier (see is_revoked()). The matching registry rows
+        are ended straight away. Returns the number of those rows.
+    '''
+    impersonator_pk = getattr(impersonator, 'pk', impersonator)
+    impersonating_pk = getattr(impersonating, 'pk', impersonating)
+    key = _revocation_key(impersonator_pk, impersonating_pk, session_key)
+    if key is None:
+        raise ValueError('Nothing to revoke')
+
+    # No session revoked now outlives the session cookie
+    _cache().set(key, time.time(), settings.SESSION_COOKIE_AGE)
+
+    if get_config().disable_logging:
+        return 0
+    return get_active_sessions(
+        impersonator=impersonator_pk,
+        impersonating=impersonating_pk,
+        session_key=session_key,
+    ).update(session_ended_at=timezone.now())
+
+
+def _revoked(stamps, started):
+    if started is None:
+        # Started before revocations existed
+        started = 0
+    return any(stamp >= started for stamp in stamps)
+
+
+def is_revoked(request, impersonating_pk):
+    ''' Returns True if the impersonation of impersonating_pk in request's
+        session was revoked after it started. One cache round trip.
+    '''
+    keys = _revocation_keys(request, impersonating_pk)
+    stamps = _cache().get_many(keys).values()
+    return bool(stamps) and _revoked(
+        stamps,
+        get_state_backend().get(request, START_KEY),
+    )
+
+
+async def ais_revoked(request, impersonating_pk):
+    ''' Async version of is_revoked()
+    '''
+    keys = _revocation_keys(request, impersonating_pk)
+    stamps = (await _cache().aget_many(keys)).values()
+    if not stamps:
+        return False
+    return _revoked(stamps, await get_state_backend().aget(request, START_KEY))
+
+
+async def arevoke(impersonator=None, impersonating=None, session_key=None):
+    ''' Async version of revoke()
+    '''
+    impersonator_pk = getattr(impersonator, 'pk', impersonator)
+    impersonating_pk = getattr(impersonating, 'pk', impersonating)
+    key = _revocation_key(impersonator_pk, impersonating_pk, session_key)
+    if key is None:
+        raise ValueError('Nothing to revoke')
+
+    await _cache().aset(key, time.time(), settings.SESSION_COOKIE_AGE)
+
+    if get_config().disable_logging:
+        return 0
+    return await get_active_sessions(
+        impersonator=impersonator_pk,
+        impersonating=impersonating_pk,
+        session_key=session_key,
+    ).aupdate(session_ended_at=timezone.now())
@@ -0,0 +1,206 @@
+import hashlib
+
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import models
+from django.db.models.functions import Lower
+
+from .config import get_config
+from .helpers import User, with_user_related
+
+# UIDResolver instances by IMPERSONATE_UID_RESOLVERS value
+_resolvers = {}
+
+
+class UIDResolver(object):
+    ''' Looks up the user a uid from the URL refers to, by a single field.
+
+        lookup is a field name, or a field name followed by '__iexact' for
+        a case-insensitive match. Case-insensitive lookups compare
+        LOWER(field), so an index on Lower(field) can serve them.
+    '''
+    def __init__(self, lookup):
+        self.lookup = lookup
+        field_name, _, lookup_type = lookup.partition('__')
+        if lookup_type not in ('', 'exact', 'iexact'):
+            raise ImproperlyConfigured(
+                u'Unsupported lookup in IMPERSONATE_UID_RESOLVERS: '
+                u'{0!r}'.format(lookup)
+            )
+        if field_name == 'pk':
+            self.field = User._meta.pk
+        else:
+            # Raises FieldDoesNotExist
+            self.field = User._meta.get_field(field_name)
+        self.case_insensitive = lookup_type == 'iexact'
+
+    def __repr__(self):
+        return '<UIDResolver {0}>'.format(self.lookup)
+
+    def accepts(self, uid):
+        ''' Returns False if uid cannot be a value of the field, so
+            looking it up would be a wasted query.
+        '''
+        if isinstance(self.field, models.EmailField) and '@' not in uid:
+            return False
+        if isinstance(self.field, (models.AutoField, models.IntegerField)) \
+           and not uid.isdigit():
+            return False
+        try:
+            self.field.to_python(uid)
+        except ValidationError:
+            return False
+        return True
+
+    def get_queryset(self, uid):
+        qs = with_user_related()
+        if self.case_insensitive:
+            return qs.annotate(
+                _impersonate_uid=Lower(self.field.name),
+            ).filter(_impersonate_uid=uid.lower())
+        return qs.filter(**{self.field.name: uid})
+
+    def matches(self, user, uid):
+        ''' Returns True if user is still the one uid refers to, for users
+            found through the uid cache.
+        '''
+        value = getattr(user, self.field.attname)
+        if self.case_insensitive:
+            return str(value).lower() == uid.lower()
+        return str(value) == uid
+
+    def is_indexed(self):
+        ''' Returns True if the user table has an index that serves this
+            lookup.
+        '''
+        field = self.field
+        if self.case_insensitive:
+            for index in User._meta.indexes:
+                expressions = getattr(index, 'expressions', ())
+                if not expressions:
+                    continue
+                expression = expressions[0]
+                if not isinstance(expression, Lower):
+                    continue
+                source = expression.get_source_expressions()[0]
+                if isinstance(source, models.F) and source.name == field.name:
+                    return True
+            return False
+
+        if field.primary_key or field.unique or field.db_index:
+            return True
+        for index in User._meta.indexes:
+            if index.fields and index.fields[0].lstrip('-') == field.name:
+                return True
+        for constraint in User._meta.constraints:
+            fields = getattr(constraint, 'fields', ())
+            if fields and fields[0] == field.name:
+                return True
+        for fields in User._meta.unique_together:
+            if fields and fields[0] == field.name:
+                return True
+        return False
+
+
+def get_uid_resolvers():
+    ''' Returns the UIDResolver chain for IMPERSONATE_UID_RESOLVERS
+    '''
+    lookups = get_config().uid_resolvers
+    try:
+        return _resolvers[lookups]
+    except KeyError:
+        pass
+    resolvers = _resolvers[lookups] = tuple(
+        UIDResolver(lookup) for lookup in lookups
+    )
+    return resolvers
+
+
+def _cache_key(uid):
+    return u'impersonate:uid:{0}'.format(
+        hashlib.md5(uid.encode('utf-8')).hexdigest()
+    )
+
+
+def _cache():
+    return caches[get_config().cache_alias]
+
+
+def _from_cache(cached):
+    ''' Returns the resolver a cached (lookup, pk) came from, or None if
+        it is no longer in the chain.
+    '''
+    if cached is None:
+        return None
+    for resolver in get_uid_resolvers():
+        if resolver.lookup == cached[0]:
+            return resolver
+    return None
+
+
+def resolve_uid(uid):
+    ''' Returns the user the uid from the URL refers to, or None.
+
+        The resolvers of IMPERSONATE_UID_RESOLVERS are tried in order,
+        skipping those that cannot match the uid and those that match
+        more than one user. A uid that can be a primary key is looked up
+        by primary key only, if the chain includes 'pk'. Which user a uid resolved to is kept in the
+        cache for IMPERSONATE_UID_CACHE_TIMEOUT seconds, a cached user
+        is fetched by primary key and checked against the uid again.
+    '''
+    uid = str(uid).strip()
+    timeout = get_config().uid_cache_timeout
+    key = _cache_key(uid)
+
+    if timeout:
+        cached = _cache().get(key)
+        resolver = _from_cache(cached)
+        if resolver is not None:
+            user = with_user_related().filter(pk=cached[1]).first()
+            if user is not None and resolver.matches(user, uid):
+                return user
+
+    for resolver in get_uid_resolvers():
+        if not resolver.accepts(uid):
+            continue
+        users = list(resolver.get_queryset(uid)[:2])
+        if len(users) != 1:
+            if resolver.field.primary_key:
+                # A uid that can be a primary key only ever refers to one
+                break
+            continue
+        user = users[0]
+        if timeout and not resolver.field.primary_key:
+            _cache().set(key, (resolver.lookup, user.pk), timeout)
+        return user
+    return None
+
+
+async def aresolve_uid(uid):
+    ''' Async version of resolve_uid()
+    '''
+    uid = str(uid).strip()
+    timeout = get_config().uid_cache_timeout
+    key = _cache_key(uid)
+
+    if timeout:
+        cached = await _cache().aget(key)
+        resolver = _from_cache(cached)
+        if resolver is not None:
+            user = await with_user_related().filter(pk=cached[1]).afirst()
+            if user is not None and resolver.matches(user, uid):
+                return user
+
+    for resolver in get_uid_resolvers():
+        if not resolver.accepts(uid):
+            continue
+        users = [user async for user in resolver.get_queryset(uid)[:2]]
+        if len(users) != 1:
+            if resolver.field.primary_key:
+                break
+            continue
+        user = users[0]
+        if timeout and not resolver.field.primary_key:
+            await _cache().aset(key, (resolver.lookup, user.pk), timeout)
+        return user
+    return None
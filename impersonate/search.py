@@ -0,0 +1,172 @@
+import hashlib
+import re
+
+from django.db.models import Q
+
+from .config import get_config
+from .helpers import get_setting_func
+
+NON_WORD = re.compile(r'\W+', re.UNICODE)
+
+
+def get_index_name(kind, *parts):
+    ''' Index names have to fit in 30 characters on some databases.
+    '''
+    digest = hashlib.md5(u':'.join(parts).encode('utf-8')).hexdigest()[:10]
+    return u'imp_{0}_{1}'.format(kind, digest)
+
+
+class BaseSearchBackend(object):
+    ''' Interface for IMPERSONATE_SEARCH_BACKEND classes.
+        search_fields and lookup_type come from IMPERSONATE_SEARCH_FIELDS
+        and IMPERSONATE_LOOKUP_TYPE.
+    '''
+    def __init__(self, search_fields, lookup_type):
+        self.search_fields = search_fields
+        self.lookup_type = lookup_type
+
+    def search(self, queryset, query):
+        ''' Returns queryset narrowed down to the users matching query.
+        '''
+        raise NotImplementedError
+
+    def get_indexes(self, connection):
+        ''' Returns the Index instances that speed up search() on
+            connection, see the impersonate_search_indexes command.
+        '''
+        return []
+
+
+class QuerySearchBackend(BaseSearchBackend):
+    ''' The default backend. Every term in the query has to match at
+        least one of the search fields using the lookup type.
+    '''
+    def search(self, queryset, query):
+        search_q = Q()
+        for term in query.split():
+            sub_q = Q()
+            for search_field in self.search_fields:
+                sub_q |= Q(**{
+                    '{0}__{1}'.format(search_field, self.lookup_type): term,
+                })
+            search_q &= sub_q
+        return queryset.filter(search_q)
+
+    def get_indexes(self, connection):
+        # On PostgreSQL, i(contains|startswith|endswith) compile to
+        # UPPER(col::text) LIKE UPPER(...), which a trigram index on
+        # the same expression can serve.
+        if connection.vendor != 'postgresql' or \
+           self.lookup_type not in ('icontains', 'istartswith', 'iendswith'):
+            return []
+
+        from django.contrib.postgres.indexes import GinIndex, OpClass
+        from django.db.models import TextField
+        from django.db.models.functions import Cast, Upper
+
+        return [
+            GinIndex(
+                OpClass(
+                    Upper(Cast(field, output_field=TextField())),
+                    name='gin_trgm_ops',
+                ),
+                name=get_index_name('upper_trgm', field),
+            )
+            for field in self.search_fields
+        ]
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    ''' Full text and trigram search for PostgreSQL, ranked by relevance.
+        Requires 'django.contrib.postgres' in INSTALLED_APPS and the
+        pg_trgm extension.
+
+        A user matches when the full text vector of the search fields
+        contains every term (as a prefix), or when any search field is
+        trigram-similar to the query. Results are ordered by the sum of
+        the text rank and the best trigram similarity.
+    '''
+    config = 'simple'
+
+    def get_vector(self):
+        from django.contrib.postgres.search import SearchVector
+
+        return SearchVector(*self.search_fields, config=self.config)
+
+    def get_search_query(self, query):
+        from django.contrib.postgres.search import SearchQuery
+
+        terms = [term for term in NON_WORD.split(query) if term]
+        if not terms:
+            return None
+        return SearchQuery(
+            u' & '.join(u'{0}:*'.format(term) for term in terms),
+            config=self.config,
+            search_type='raw',
+        )
+
+    def get_similarity(self, query):
+        from django.contrib.postgres.search import TrigramSimilarity
+        from django.db.models.functions import Greatest
+
+        similarities = [
+            TrigramSimilarity(field, query) for field in self.search_fields
+        ]
+        if len(similarities) == 1:
+            return similarities[0]
+        return Greatest(*similarities)
+
+    def search(self, queryset, query):
+        from django.contrib.postgres.search import SearchRank
+
+        query = query.strip()
+        search_query = self.get_search_query(query)
+        if search_query is None:
+            return queryset
+
+        vector = self.get_vector()
+        match_q = Q(impersonate_search=search_query)
+        for field in self.search_fields:
+            match_q |= Q(**{'{0}__trigram_similar'.format(field): query})
+
+        # alias() rather than annotate(), the vector is only needed in
+        # the WHERE clause
+        return queryset.alias(impersonate_search=vector).annotate(
+            impersonate_rank=(
+                SearchRank(vector, search_query) + self.get_similarity(query)
+            ),
+        ).filter(match_q).order_by('-impersonate_rank', 'pk')
+
+    def get_indexes(self, connection):
+        if connection.vendor != 'postgresql':
+            return []
+
+        from django.contrib.postgres.indexes import GinIndex
+
+        indexes = [
+            GinIndex(
+                self.get_vector(),
+                name=get_index_name('tsvector', self.config,
+                                    *self.search_fields),
+            ),
+        ]
+        indexes.extend(
+            GinIndex(
+                fields=[field],
+                opclasses=['gin_trgm_ops'],
+                name=get_index_name('trgm', field),
+            )
+            for field in self.search_fields
+        )
+        return indexes
+
+
+def get_search_backend():
+    ''' Returns an instance of the IMPERSONATE_SEARCH_BACKEND class.
+    '''
+    config = get_config()
+    backend_class = get_setting_func(
+        'IMPERSONATE_SEARCH_BACKEND',
+        'impersonate.search.QuerySearchBackend',
+    )
+    return backend_class(config.search_fields, config.lookup_type)
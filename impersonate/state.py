@@ -0,0 +1,274 @@
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+
+from .config import get_config
+from .helpers import (asession_get, asession_pop, asession_save, asession_set,
+                      get_setting_func)
+
+# Where StoredStateBackend keeps the state of the current request
+STATE_ATTR = '_impersonate_state'
+STATE_SALT = 'impersonate.state'
+
+# Owner of a stored state and the session it belongs to, see
+# StoredStateBackend
+OWNER_KEY = '_user'
+SESSION_KEY = '_session'
+
+
+class SessionStateBackend(object):
+    ''' The default, keeps the impersonation state in request.session
+    '''
+    def get(self, request, key, default=None):
+        return request.session.get(key, default)
+
+    def set(self, request, key, value):
+        request.session[key] = value
+
+    def pop(self, request, key, default=None):
+        return request.session.pop(key, default)
+
+    async def aget(self, request, key, default=None):
+        return await asession_get(request.session, key, default)
+
+    async def aset(self, request, key, value):
+        await asession_set(request.session, key, value)
+
+    async def apop(self, request, key, default=None):
+        return await asession_pop(request.session, key, default)
+
+    def save(self, request, response):
+        ''' Called by the middleware with every response
+        '''
+        pass
+
+    async def asave(self, request, response):
+        pass
+
+
+class StoredStateBackend(SessionStateBackend):
+    ''' Base class of the backends that keep the state outside the
+        session. It is loaded once per request (see load()), held in
+        memory and written by save() from the middleware's response hook
+        if it changed.
+
+        The state is bound to the impersonator's login: it records the
+        primary key of the user who stored it and the session key, and a
+        state stored by another user, or before logging out (which
+        replaces the session key), reads as empty.
+    '''
+    def load(self, request):
+        ''' Returns the stored state dict, or None
+        '''
+        raise NotImplementedError
+
+    async def aload(self, request):
+        return self.load(request)
+
+    def store(self, request, response, state):
+        ''' Writes state, or removes it if it is empty
+        '''
+        raise NotImplementedError
+
+    async def astore(self, request, response, state):
+        self.store(request, response, state)
+
+    def _owner_pk(self, request):
+        # Sets up a lazy request.user, which may apply the impersonation
+        user = request.user
+        if getattr(user, 'is_impersonate', False):
+            return request.impersonator.pk
+        return user.pk
+
+    def _session_key(self, request):
+        # Read from the session cookie, does not load the session
+        return getattr(request.session, 'session_key', None)
+
+    def _check(self, request, stored):
+        if not isinstance(stored, dict) or \
+           stored.get(OWNER_KEY) != self._owner_pk(request) or \
+           stored.get(SESSION_KEY) != self._session_key(request):
+            stored = {}
+        return {'state': stored, 'modified': False}
+
+    def _bind(self, request, state, owner_pk):
+        if OWNER_KEY not in state:
+            state[OWNER_KEY] = owner_pk
+            state[SESSION_KEY] = self._session_key(request)
+
+    def _state(self, request):
+        owner_pk = self._owner_pk(request)
+        current = request.__dict__.get(STATE_ATTR)
+        if current is None:
+            current = self._check(request, self.load(request))
+            request.__dict__[STATE_ATTR] = current
+        self._bind(request, current['state'], owner_pk)
+        return current
+
+    async def _astate(self, request):
+        # request.user has to be loaded already, see request.auser()
+        current = request.__dict__.get(STATE_ATTR)
+        if current is None:
+            current = self._check(request, await self.aload(request))
+            request.__dict__[STATE_ATTR] = current
+        self._bind(request, current['state'], self._owner_pk(request))
+        return current
+
+    def get(self, request, key, default=None):
+        return self._state(request)['state'].get(key, default)
+
+    def set(self, request, key, value):
+        current = self._state(request)
+        current['state'][key] = value
+        current['modified'] = True
+
+    def pop(self, request, key, default=None):
+        current = self._state(request)
+        if key not in current['state']:
+            return default
+        current['modified'] = True
+        return current['state'].pop(key)
+
+    async def aget(self, request, key, default=None):
+        return (await self._astate(request))['state'].get(key, default)
+
+    async def aset(self, request, key, value):
+        current = await self._astate(request)
+        current['state'][key] = value
+        current['modified'] = True
+
+    async def apop(self, request, key, default=None):
+        current = await self._astate(request)
+        if key not in current['state']:
+            return default
+        current['modified'] = True
+        return current['state'].pop(key)
+
+    def _changed_state(self, request):
+        current = request.__dict__.get(STATE_ATTR)
+        if current is None or not current['modified']:
+            return None
+        state = current['state']
+        if set(state) <= set([OWNER_KEY, SESSION_KEY]):
+            return {}
+        return state
+
+    def save(self, request, response):
+        state = self._changed_state(request)
+        if state is not None:
+            self.store(request, response, state)
+
+    async def asave(self, request, response):
+        state = self._changed_state(request)
+        if state is not None:
+            await self.astore(request, response, state)
+
+
+class SignedCookieStateBackend(StoredStateBackend):
+    ''' Keeps the state in a signed cookie (IMPERSONATE_STATE_COOKIE_NAME),
+        so reading it costs no server side lookup. The cookie uses the
+        SESSION_COOKIE_* settings and is HttpOnly.
+    '''
+    def load(self, request):
+        value = request.COOKIES.get(get_config().state_cookie_name)
+        if not value:
+            return None
+        try:
+            return signing.loads(
+                value,
+                salt=STATE_SALT,
+                max_age=settings.SESSION_COOKIE_AGE,
+            )
+        except signing.BadSignature:
+            return None
+
+    def store(self, request, response, state):
+        name = get_config().state_cookie_name
+        if not state:
+            response.delete_cookie(
+                name,
+                path=settings.SESSION_COOKIE_PATH,
+                domain=settings.SESSION_COOKIE_DOMAIN,
+            )
+            return
+
+        kwargs = {}
+        samesite = getattr(settings, 'SESSION_COOKIE_SAMESITE', None)
+        if samesite:
+            # Django 2.1+
+            kwargs['samesite'] = samesite
+        response.set_cookie(
+            name,
+            signing.dumps(state, salt=STATE_SALT, compress=True),
+            max_age=settings.SESSION_COOKIE_AGE,
+            path=settings.SESSION_COOKIE_PATH,
+            domain=settings.SESSION_COOKIE_DOMAIN,
+            secure=settings.SESSION_COOKIE_SECURE or None,
+            httponly=True,
+            **kwargs
+        )
+
+
+class CacheStateBackend(StoredStateBackend):
+    ''' Keeps the state in the IMPERSONATE_CACHE_ALIAS cache,
+        keyed on the session key. Only the key is taken from the session
+        cookie, the session itself is not loaded.
+    '''
+    key_prefix = 'impersonate:state'
+
+    @property
+    def cache(self):
+        return caches[get_config().cache_alias]
+
+    def _key(self, request):
+        session_key = getattr(request.session, 'session_key', None)
+        if not session_key:
+            return None
+        return u'{0}:{1}'.format(self.key_prefix, session_key)
+
+    def load(self, request):
+        key = self._key(request)
+        return self.cache.get(key) if key else None
+
+    async def aload(self, request):
+        key = self._key(request)
+        return (await self.cache.aget(key)) if key else None
+
+    def store(self, request, response, state):
+        key = self._key(request)
+        if key is None:
+            # A new session, save it to get a key
+            request.session.save()
+            key = self._key(request)
+        if state:
+            self.cache.set(key, state, settings.SESSION_COOKIE_AGE)
+        else:
+            self.cache.delete(key)
+
+    async def astore(self, request, response, state):
+        key = self._key(request)
+        if key is None:
+            await asession_save(request.session)
+            key = self._key(request)
+        if state:
+            await self.cache.aset(key, state, settings.SESSION_COOKIE_AGE)
+        else:
+            await self.cache.adelete(key)
+
+
+# Backend instances by class, they keep no state of their own
+_backends = {}
+
+
+def get_state_backend():
+    ''' Returns the IMPERSONATE_STATE_BACKEND instance
+    '''
+    backend_class = get_setting_func(
+        'IMPERSONATE_STATE_BACKEND',
+        'impersonate.state.SessionStateBackend',
+    )
+    try:
+        return _backends[backend_class]
+    except KeyError:
+        backend = _backends[backend_class] = backend_class()
+        return backend
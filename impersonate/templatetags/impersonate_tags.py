@@ -0,0 +1,25 @@
+from django import template
+
+from ..helpers import check_allow_for_users
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def impersonable_pks(context, users):
+    ''' Returns the set of primary keys, out of users, that the current
+        request can impersonate, with a single query:
+
+            {% load impersonate_tags %}
+            {% impersonable_pks users as allowed %}
+            {% for user in users %}
+              {% if user.pk in allowed %}...{% endif %}
+            {% endfor %}
+    '''
+    request = context.get('request')
+    if request is None or not hasattr(request, 'user'):
+        return frozenset()
+    return frozenset(
+        pk for pk, allowed in check_allow_for_users(request, users).items()
+        if allowed
+    )
@@ -63,6 +63,7 @@ urlpatterns = [
     url(r'^another-view/$',
         test_view,
         name='another-test-view'),
+    url('^async/', include(('impersonate.async_urls', 'impersonate-async'))),
     url('^', include('impersonate.urls')),
 ]
 
@@ -91,6 +92,68 @@ def test_qs(impersonator, request):
     return User.objects.all()
 
 
+test_qs_calls = []
+
+
+def test_qs_counted(impersonator, request):
+    ''' Used via the IMPERSONATE_CUSTOM_USER_QUERYSET setting.
+        Records every call, returns all users.
+    '''
+    test_qs_calls.append(impersonator)
+    return User.objects.all()
+
+
+def test_qs_visible(impersonator, request):
+    ''' Used via the IMPERSONATE_CUSTOM_USER_QUERYSET setting.
+        Records every call, returns the users not named 'hidden'.
+    '''
+    test_qs_calls.append(impersonator)
+    return User.objects.exclude(last_name='hidden')
+
+
+def test_qs_support(impersonator, request):
+    ''' Used via the IMPERSONATE_CUSTOM_USER_QUERYSET setting.
+        Members of the 'support' group can impersonate non-staff users.
+    '''
+    if not impersonator.groups.filter(name='support').exists():
+        return User.objects.none()
+    return User.objects.filter(is_staff=False)
+
+
+def test_qs_sliced(impersonator, request):
+    ''' Used via the IMPERSONATE_CUSTOM_USER_QUERYSET setting.
+        Returns a queryset that cannot be filtered any further.
+    '''
+    return User.objects.order_by('pk')[:10]
+
+
+def test_qs_grouped(impersonator, request):
+    ''' Used via the IMPERSONATE_CUSTOM_USER_QUERYSET setting.
+        Records every call, returns users once per group they are in.
+    '''
+    test_qs_calls.append(impersonator)
+    return User.objects.filter(groups__isnull=False)
+
+
+def test_qs_broken(impersonator, request):
+    ''' Used via the IMPERSONATE_CUSTOM_USER_QUERYSET setting.
+        Records every call, then fails.
+    '''
+    test_qs_calls.append(impersonator)
+    raise TypeError('broken queryset function')
+
+
+class TestSearchBackend(object):
+    ''' Used via the IMPERSONATE_SEARCH_BACKEND setting.
+        Matches usernames exactly.
+    '''
+    def __init__(self, search_fields, lookup_type):
+        pass
+
+    def search(self, queryset, query):
+        return queryset.filter(username=query)
+
+
 if six.PY3:
     # Temporary until factory_boy gets Py3k support
     class UserFactory(object):
@@ -108,23 +171,1915 @@ else:
     class UserFactory(factory.Factory):
         FACTORY_FOR = User
 
-        email = factory.LazyAttribute(
-            lambda a: '{0}@test-email.com'.format(a.username).lower()
+        email = factory.LazyAttribute(
+            lambda a: '{0}@test-email.com'.format(a.username).lower()
+        )
+
+        @classmethod
+        def _prepare(cls, create, **kwargs):
+            password = kwargs.pop('password', None)
+            user = super(UserFactory, cls)._prepare(create, **kwargs)
+            if password:
+                user.set_password(password)
+                if create:
+                    user.save()
+            return user
+
+
+class TestMiddleware(TestCase):
+    def setUp(self):
+        from impersonate.middleware import ImpersonateMiddleware
+
+        self.superuser = UserFactory.create(
+            username='superuser',
+            is_superuser=True,
+        )
+        self.user = UserFactory.create(username='regular')
+        self.factory = RequestFactory()
+        self.middleware = ImpersonateMiddleware()
+
+    def _impersonated_request(self, use_id=True):
+        request = self.factory.get('/')
+        request.user = self.superuser
+        request.session = {
+            '_impersonate': self.user.id if use_id else self.user,
+        }
+        self.middleware.process_request(request)
+
+        # Check request.user and request.user.real_user
+        self.assertEqual(request.user, self.user)
+        self.assertEqual(request.impersonator, self.superuser)
+        self.assertTrue(request.user.is_impersonate)
+
+    def test_impersonated_request(self):
+        self._impersonated_request()
+
+    def test_impersonated_request_non_id(self):
+        ''' Test to ensure User objects don't kill the app.
+            See Issue #15
+        '''
+        self._impersonated_request(use_id=False)
+
+
+class UntouchableSession(object):
+    ''' Session that fails the test when it is looked at.
+    '''
+    def __getattr__(self, name):
+        raise AssertionError('session accessed')
+
+    def __contains__(self, key):
+        raise AssertionError('session accessed')
+
+    def __getitem__(self, key):
+        raise AssertionError('session accessed')
+
+
+class TestSkippedRequests(TestCase):
+    def setUp(self):
+        from impersonate.middleware import ImpersonateMiddleware
+
+        self.superuser = UserFactory.create(
+            username='superuser',
+            is_superuser=True,
+        )
+        self.user = UserFactory.create(username='regular')
+        self.factory = RequestFactory()
+        self.middleware = ImpersonateMiddleware()
+
+    def _lazy_request(self, path, **extra):
+        from django.utils.functional import SimpleLazyObject
+
+        loaded = []
+        superuser = self.superuser
+
+        def get_user():
+            loaded.append(True)
+            return superuser
+
+        request = self.factory.get(path, **extra)
+        request.user = SimpleLazyObject(get_user)
+        request.session = UntouchableSession()
+        return request, loaded
+
+    def test_excluded_uri_untouched(self):
+        request, loaded = self._lazy_request('/admin/')
+        with self.assertNumQueries(0):
+            self.middleware.process_request(request)
+        self.assertEqual(loaded, [])
+        self.assertIsNone(request.impersonator)
+
+        # Loading the user later still marks it
+        self.assertFalse(request.user.is_impersonate)
+        self.assertEqual(request.user, self.superuser)
+        self.assertEqual(loaded, [True])
+
+    def test_excluded_uri_loaded_user(self):
+        request = self.factory.get('/admin/')
+        request.user = self.superuser
+        request.session = UntouchableSession()
+        with self.assertNumQueries(0):
+            self.middleware.process_request(request)
+        self.assertFalse(request.user.is_impersonate)
+        self.assertIsNone(request.impersonator)
+
+    @override_settings(IMPERSONATE_NEVER_IMPERSONATE_PATHS=['/health/'])
+    def test_never_impersonate_paths(self):
+        request, loaded = self._lazy_request('/health/')
+        self.middleware.process_request(request)
+        self.assertEqual(loaded, [])
+
+        request, loaded = self._lazy_request('/health/x/')
+        request.session = {'_impersonate': self.user.pk}
+        self.middleware.process_request(request)
+        self.assertEqual(request.user, self.user)
+
+    @override_settings(IMPERSONATE_NEVER_IMPERSONATE_HOSTS=['Static.Example.com'],
+                       ALLOWED_HOSTS=['.example.com'])
+    def test_never_impersonate_hosts(self):
+        request, loaded = self._lazy_request(
+            '/', HTTP_HOST='static.example.com:8000',
+        )
+        self.middleware.process_request(request)
+        self.assertEqual(loaded, [])
+
+        request, loaded = self._lazy_request('/', HTTP_HOST='www.example.com')
+        request.session = {'_impersonate': self.user.pk}
+        self.middleware.process_request(request)
+        self.assertEqual(request.user, self.user)
+
+    async def test_async_excluded_uri_untouched(self):
+        from django.utils.functional import SimpleLazyObject
+        from impersonate.middleware import ImpersonateMiddleware
+
+        async def aget_response(request):
+            return HttpResponse()
+
+        superuser = self.superuser
+
+        async def auser():
+            return superuser
+
+        def get_user():
+            raise AssertionError('request.user loaded synchronously')
+
+        request = self.factory.get('/admin/')
+        request.user = SimpleLazyObject(get_user)
+        request.auser = auser
+        request.session = UntouchableSession()
+        await ImpersonateMiddleware(aget_response)(request)
+
+        user = await request.auser()
+        self.assertFalse(user.is_impersonate)
+        self.assertIsNone(await request.aimpersonator())
+
+
+@override_settings(IMPERSONATE_DECISION_CACHE_TIMEOUT=60)
+class TestDecisionCache(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        from impersonate.middleware import ImpersonateMiddleware
+
+        cache.clear()
+        self.superuser = UserFactory.create(
+            username='superuser',
+            is_superuser=True,
+        )
+        self.user = UserFactory.create(username='regular')
+        self.factory = RequestFactory()
+        self.middleware = ImpersonateMiddleware()
+
+    def _impersonated_request(self):
+        request = self.factory.get('/')
+        request.user = self.superuser
+        request.session = {'_impersonate': self.user.id}
+        self.middleware.process_request(request)
+        self.assertEqual(request.user, self.user)
+        return request
+
+    @override_settings(
+        IMPERSONATE_CUSTOM_USER_QUERYSET='impersonate.tests.test_qs_counted')
+    def test_decision_is_cached(self):
+        del test_qs_calls[:]
+        with self.assertNumQueries(1):
+            self._impersonated_request()
+        self.assertEqual(len(test_qs_calls), 1)
+
+        # Plain pk lookup, authorization comes from the cache
+        with self.assertNumQueries(1):
+            self._impersonated_request()
+        self.assertEqual(len(test_qs_calls), 1)
+
+    def test_user_save_invalidates_decision(self):
+        self._impersonated_request()
+        self.user.is_superuser = True
+        self.user.save()
+
+        request = self.factory.get('/')
+        request.user = self.superuser
+        request.session = {'_impersonate': self.user.id}
+        self.middleware.process_request(request)
+        self.assertEqual(request.user, self.superuser)
+        self.assertFalse(request.user.is_impersonate)
+
+    def test_session_end_invalidates_decision(self):
+        from impersonate.cache import get_decision_cache
+        from impersonate.dispatch import send_session_signal
+
+        self._impersonated_request()
+        decision_cache = get_decision_cache()
+        self.assertTrue(decision_cache.get(self.superuser.pk, self.user.pk))
+
+        request = RequestFactory().get('/')
+        request.session = {}
+        send_session_signal(
+            session_end,
+            'session_end',
+            request,
+            impersonator=self.superuser,
+            impersonating=self.user.pk,
+        )
+        self.assertIsNone(decision_cache.get(self.superuser.pk, self.user.pk))
+
+    def test_settings_change_invalidates_decision(self):
+        from impersonate.cache import get_decision_cache
+
+        self._impersonated_request()
+        with self.settings(IMPERSONATE_REQUIRE_SUPERUSER=True):
+            decision_cache = get_decision_cache()
+            self.assertIsNone(
+                decision_cache.get(self.superuser.pk, self.user.pk)
+            )
+
+
+@override_settings(IMPERSONATE_USER_CACHE_TIMEOUT=60)
+class TestUserCache(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import Group, Permission
+        from django.core.cache import cache
+
+        cache.clear()
+        self.superuser = UserFactory.create(
+            username='superuser',
+            is_superuser=True,
+            password='foobar',
+        )
+        self.user = UserFactory.create(username='regular')
+        self.group = Group.objects.create(name='editors')
+        self.user.groups.add(self.group)
+        self.permission = Permission.objects.get(codename='change_user')
+        self.group.permissions.add(self.permission)
+
+    def _fresh(self):
+        from impersonate.cache import get_user_cache
+
+        user = User.objects.get(pk=self.user.pk)
+        return user, get_user_cache().warm(user)
+
+    def test_warm(self):
+        user, hit = self._fresh()
+        self.assertFalse(hit)
+        self.assertIn('auth.change_user', user.get_all_permissions())
+
+        user, hit = self._fresh()
+        self.assertTrue(hit)
+        with self.assertNumQueries(0):
+            self.assertTrue(user.has_perm('auth.change_user'))
+            self.assertEqual(user.get_group_permissions(),
+                             set(['auth.change_user']))
+            self.assertEqual(list(user.groups.all()), [self.group])
+
+    def test_invalidation(self):
+        from django.contrib.auth.models import Group, Permission
+
+        self._fresh()
+        add_user = Permission.objects.get(codename='add_user')
+        self.group.permissions.add(add_user)
+        user, hit = self._fresh()
+        self.assertFalse(hit)
+        self.assertTrue(user.has_perm('auth.add_user'))
+
+        other = Group.objects.create(name='others')
+        self.user.groups.add(other)
+        user, hit = self._fresh()
+        self.assertFalse(hit)
+        self.assertEqual(set(user.groups.all()), set([self.group, other]))
+
+        self._fresh()
+        other.user_set.remove(self.user)
+        user, hit = self._fresh()
+        self.assertFalse(hit)
+        self.assertEqual(list(user.groups.all()), [self.group])
+
+        self._fresh()
+        self.user.user_permissions.add(add_user)
+        self.assertFalse(self._fresh()[1])
+
+        self.permission.name = 'Can edit user'
+        self.permission.save()
+        self.assertFalse(self._fresh()[1])
+
+    def test_impersonation(self):
+        from impersonate.middleware import ImpersonateMiddleware
+
+        self.client.login(username='superuser', password='foobar')
+        self.client.get(reverse('impersonate-start', args=[self.user.pk]))
+
+        # Warmed by the impersonate view
+        request = RequestFactory().get('/')
+        request.user = self.superuser
+        request.session = self.client.session
+        ImpersonateMiddleware(lambda request: None).process_request(request)
+        self.assertEqual(request.user, self.user)
+        with self.assertNumQueries(0):
+            self.assertTrue(request.user.has_perm('auth.change_user'))
+            self.assertEqual(list(request.user.groups.all()), [self.group])
+
+    async def test_async(self):
+        from asgiref.sync import sync_to_async
+        from impersonate.cache import get_user_cache
+
+        user_cache = get_user_cache()
+        user = await User.objects.aget(pk=self.user.pk)
+        self.assertFalse(await user_cache.awarm(user))
+        user = await User.objects.aget(pk=self.user.pk)
+        self.assertTrue(await user_cache.awarm(user))
+        # Django < 5.2 has no aget_all_permissions()
+        get_all_permissions = getattr(
+            user,
+            'aget_all_permissions',
+            sync_to_async(user.get_all_permissions),
+        )
+        self.assertIn('auth.change_user', await get_all_permissions())
+        self.assertEqual([group async for group in user.groups.all()],
+                         [self.group])
+
+
+@override_settings(IMPERSONATE_USER_PREFETCH_RELATED=('groups',))
+class TestUserRelated(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import Group
+
+        self.superuser = UserFactory.create(
+            username='superuser',
+            is_superuser=True,
+            password='foobar',
+        )
+        self.user = UserFactory.create(username='regular')
+        self.group = Group.objects.create(name='editors')
+        self.user.groups.add(self.group)
+
+    def _process(self, session):
+        from impersonate.middleware import ImpersonateMiddleware
+
+        request = RequestFactory().get('/')
+        request.user = self.superuser
+        request.session = session
+        ImpersonateMiddleware(lambda request: None).process_request(request)
+        self.assertEqual(request.user, self.user)
+        return request
+
+    def test_with_user_related(self):
+        from impersonate.helpers import with_user_related
+
+        qs = with_user_related()
+        self.assertEqual(qs._prefetch_related_lookups, ('groups',))
+        self.assertFalse(qs.query.select_related)
+        # Not evaluated, auth.User has no relation to select
+        with self.settings(IMPERSONATE_USER_SELECT_RELATED=('profile',),
+                           IMPERSONATE_USER_PREFETCH_RELATED=()):
+            qs = with_user_related(User.objects.filter(is_active=True))
+            self.assertEqual(qs.query.select_related, {'profile': {}})
+            self.assertEqual(qs._prefetch_related_lookups, ())
+
+    def test_middleware(self):
+        request = self._process({'_impersonate': self.user.pk})
+        with self.assertNumQueries(0):
+            self.assertEqual(list(request.user.groups.all()), [self.group])
+
+    @override_settings(
+        IMPERSONATE_LEASE_TIMEOUT=60,
+        IMPERSONATE_CUSTOM_USER_QUERYSET='impersonate.tests.test_qs_sliced')
+    def test_lease_and_fallback(self):
+        session = {'_impersonate': self.user.pk}
+        # Sliced custom queryset, then a valid lease
+        for _ in range(2):
+            request = self._process(session)
+            with self.assertNumQueries(0):
+                self.assertEqual(
+                    list(request.user.groups.all()),
+                    [self.group],
+                )
+
+    def test_resolve_uid(self):
+        from impersonate.resolvers import resolve_uid
+
+        for uid in (self.user.pk, self.user.email, self.user.email):
+            user = resolve_uid(uid)
+            self.assertEqual(user, self.user)
+            with self.assertNumQueries(0):
+                self.assertEqual(list(user.groups.all()), [self.group])
+
+    async def test_async(self):
+        from impersonate.middleware import aget_impersonated_user
+
+        request = RequestFactory().get('/')
+        request.user = self.superuser
+        request.user.is_impersonate = False
+        request.session = {}
+        user = await aget_impersonated_user(request, self.user.pk)
+        self.assertEqual(user, self.user)
+        self.assertEqual(
+            user._prefetched_objects_cache['groups']._result_cache,
+            [self.group],
+        )
+
+
+@override_settings(IMPERSONATE_LEASE_TIMEOUT=60)
+class TestLease(TestCase):
+    def setUp(self):
+        from impersonate.middleware import ImpersonateMiddleware
+
+        self.superuser = UserFactory.create(
+            username='superuser',
+            is_superuser=True,
+            password='foobar',
+        )
+        self.user = UserFactory.create(username='regular')
+        self.factory = RequestFactory()
+        self.middleware = ImpersonateMiddleware()
+
+    def _process(self, session):
+        request = self.factory.get('/')
+        request.user = self.superuser
+        request.session = session
+        self.middleware.process_request(request)
+        return request
+
+    @override_settings(
+        IMPERSONATE_CUSTOM_USER_QUERYSET='impersonate.tests.test_qs_counted')
+    def test_lease_skips_revalidation(self):
+        from impersonate.lease import LEASE_KEY
+
+        del test_qs_calls[:]
+        # Sessions from before leases existed only hold the pk
+        session = {'_impersonate': self.user.pk}
+        request = self._process(session)
+        self.assertEqual(request.user, self.user)
+        self.assertEqual(len(test_qs_calls), 1)
+        self.assertIn(LEASE_KEY, session)
+
+        with self.assertNumQueries(1):
+            request = self._process(session)
+        self.assertEqual(request.user, self.user)
+        self.assertTrue(request.user.is_impersonate)
+        self.assertEqual(len(test_qs_calls), 1)
+
+    @override_settings(
+        IMPERSONATE_CUSTOM_USER_QUERYSET='impersonate.tests.test_qs_counted')
+    def test_expired_lease_revalidates(self):
+        from unittest import mock
+
+        from impersonate import lease
+
+        del test_qs_calls[:]
+        session = {'_impersonate': self.user.pk}
+        self._process(session)
+
+        now = lease.time.time()
+        with mock.patch.object(lease.time, 'time', return_value=now + 61):
+            request = self._process(session)
+        self.assertEqual(request.user, self.user)
+        self.assertEqual(len(test_qs_calls), 2)
+
+    def test_settings_change_revalidates(self):
+        session = {'_impersonate': self.user.pk}
+        self._process(session)
+
+        with self.settings(IMPERSONATE_CUSTOM_ALLOW='impersonate.tests.test_allow2'):
+            request = self._process(session)
+        self.assertEqual(request.user, self.superuser)
+        self.assertFalse(request.user.is_impersonate)
+
+    def test_impersonator_change_revalidates(self):
+        session = {'_impersonate': self.user.pk}
+        self._process(session)
+
+        self.superuser.is_superuser = False
+        self.superuser.save()
+        request = self._process(session)
+        self.assertEqual(request.user, self.superuser)
+        self.assertFalse(request.user.is_impersonate)
+
+    def test_lease_for_other_target_rejected(self):
+        from unittest import mock
+
+        from impersonate.lease import LEASE_KEY, check_lease, make_lease
+
+        other = UserFactory.create(username='other')
+        value = make_lease(self.superuser, other.pk)
+        self.assertTrue(check_lease(value, self.superuser, other.pk))
+        self.assertFalse(check_lease(value, self.superuser, self.user.pk))
+        self.assertFalse(check_lease(value, self.user, other.pk))
+        self.assertFalse(check_lease(value + 'x', self.superuser, other.pk))
+        self.assertFalse(check_lease('garbage', self.superuser, other.pk))
+
+        # The target pk is not trusted from the lease
+        session = {'_impersonate': self.user.pk, LEASE_KEY: value}
+        with mock.patch('impersonate.middleware.get_impersonable_user',
+                        return_value=None) as get_user:
+            request = self._process(session)
+        self.assertEqual(get_user.call_count, 1)
+        self.assertEqual(request.user, self.superuser)
+
+    def test_lease_stored_and_removed(self):
+        from impersonate.lease import LEASE_KEY
+
+        client = Client()
+        client.login(username='superuser', password='foobar')
+        client.get(reverse('impersonate-start', args=[self.user.pk]))
+        self.assertIn(LEASE_KEY, client.session)
+        client.get(reverse('impersonate-stop'))
+        self.assertNotIn(LEASE_KEY, client.session)
+
+    @override_settings(IMPERSONATE_LEASE_TIMEOUT=0)
+    def test_disabled(self):
+        from impersonate.lease import LEASE_KEY
+
+        session = {'_impersonate': self.user.pk}
+        request = self._process(session)
+        self.assertEqual(request.user, self.user)
+        self.assertNotIn(LEASE_KEY, session)
+
+    async def test_async_lease(self):
+        from impersonate.lease import LEASE_KEY
+        from impersonate.middleware import ImpersonateMiddleware
+
+        async def aget_response(request):
+            return HttpResponse()
+
+        superuser = self.superuser
+
+        async def auser():
+            return superuser
+
+        session = {'_impersonate': self.user.pk}
+        for i in range(2):
+            request = self.factory.get('/')
+            request.user = superuser
+            request.auser = auser
+            request.session = session
+            await ImpersonateMiddleware(aget_response)(request)
+            user = await request.auser()
+            self.assertEqual(user, self.user)
+            self.assertIn(LEASE_KEY, session)
+
+
+class TestTargetResolution(TestCase):
+    def setUp(self):
+        from impersonate.middleware import ImpersonateMiddleware
+
+        self.superuser = UserFactory.create(
+            username='superuser',
+            is_superuser=True,
+            password='foobar',
+        )
+        self.user = UserFactory.create(username='regular')
+        self.factory = RequestFactory()
+        self.middleware = ImpersonateMiddleware()
+
+    def _process(self, user_id):
+        request = self.factory.get('/')
+        request.user = self.superuser
+        request.session = {'_impersonate': user_id}
+        self.middleware.process_request(request)
+        return request
+
+    def test_single_query(self):
+        with self.assertNumQueries(1):
+            request = self._process(self.user.id)
+        self.assertEqual(request.user, self.user)
+        self.assertTrue(request.user.is_impersonate)
+
+    def test_missing_user(self):
+        with self.assertNumQueries(1):
+            request = self._process(self.user.id + 100)
+        self.assertEqual(request.user, self.superuser)
+        self.assertFalse(request.user.is_impersonate)
+
+    def test_superuser_target_refused(self):
+        other = UserFactory.create(username='other', is_superuser=True)
+        request = self._process(other.id)
+        self.assertEqual(request.user, self.superuser)
+
+    @override_settings(
+        IMPERSONATE_CUSTOM_USER_QUERYSET='impersonate.tests.test_qs_sliced')
+    def test_uncomposable_queryset_fallback(self):
+        request = self._process(self.user.id)
+        self.assertEqual(request.user, self.user)
+        self.assertTrue(request.user.is_impersonate)
+
+    @override_settings(
+        IMPERSONATE_CUSTOM_USER_QUERYSET='impersonate.tests.test_qs_grouped')
+    def test_repeated_user(self):
+        from django.contrib.auth.models import Group
+
+        from impersonate.helpers import get_impersonable_user
+
+        for name in ('one', 'two'):
+            Group.objects.create(name=name).user_set.add(self.user)
+        request = self.factory.get('/')
+        request.user = self.superuser
+        request.user.is_impersonate = False
+        del test_qs_calls[:]
+        with self.assertNumQueries(2):
+            end_user = get_impersonable_user(request, self.user.id)
+        self.assertEqual(end_user, self.user)
+        self.assertEqual(len(test_qs_calls), 1)
+
+    async def test_repeated_user_async(self):
+        from asgiref.sync import sync_to_async
+        from django.contrib.auth.models import Group
+
+        from impersonate.helpers import aget_impersonable_user
+
+        def add_groups():
+            for name in ('one', 'two'):
+                Group.objects.create(name=name).user_set.add(self.user)
+
+        await sync_to_async(add_groups)()
+        request = self.factory.get('/')
+        request.user = self.superuser
+        request.user.is_impersonate = False
+        with self.settings(
+            IMPERSONATE_CUSTOM_USER_QUERYSET='impersonate.tests.test_qs_grouped',
+        ):
+            end_user = await aget_impersonable_user(request, self.user.id)
+        self.assertEqual(end_user, self.user)
+
+    @override_settings(
+        IMPERSONATE_CUSTOM_USER_QUERYSET='impersonate.tests.test_qs_broken')
+    def test_broken_queryset_function(self):
+        from impersonate.helpers import get_impersonable_user
+
+        request = self.factory.get('/')
+        request.user = self.superuser
+        request.user.is_impersonate = False
+        del test_qs_calls[:]
+        with self.assertRaises(TypeError):
+            get_impersonable_user(request, self.user.id)
+        self.assertEqual(len(test_qs_calls), 1)
+
+    def test_impersonated_request_adds_one_query(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        client = Client()
+        client.login(username='superuser', password='foobar')
+        with CaptureQueriesContext(connection) as plain:
+            client.get(reverse('impersonate-test'))
+
+        client.get(reverse('impersonate-start', args=[self.user.id]))
+        with CaptureQueriesContext(connection) as impersonated:
+            response = client.get(reverse('impersonate-test'))
+        self.assertIn('regular', str(response.content))
+        self.assertEqual(len(impersonated), len(plain) + 1)
+
+
+class TestUIDResolution(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        self.superuser = UserFactory.create(
+            username='superuser',
+            is_superuser=True,
+            password='foobar',
+        )
+        self.user = UserFactory.create(username='regular')
+        self.digits = UserFactory.create(username='1234567')
+
+    def test_default_chain(self):
+        from impersonate.resolvers import resolve_uid
+
+        self.assertEqual(resolve_uid(self.user.pk), self.user)
+        self.assertEqual(resolve_uid(' regular '), self.user)
+        self.assertEqual(resolve_uid('regular@test-email.com'), self.user)
+        self.assertIsNone(resolve_uid('REGULAR@test-email.com'))
+        # Can be a pk, so only looked up by pk
+        self.assertIsNone(resolve_uid('1234567'))
+        self.assertIsNone(resolve_uid('nobody'))
+
+        # 'nobody' cannot be a pk or an email, only usernames are queried
+        with self.assertNumQueries(1):
+            self.assertIsNone(resolve_uid('nobody'))
+
+    @override_settings(IMPERSONATE_UID_RESOLVERS=['email__iexact'])
+    def test_case_insensitive(self):
+        from impersonate.resolvers import resolve_uid
+
+        self.assertEqual(resolve_uid('Regular@Test-Email.com'), self.user)
+        self.assertIsNone(resolve_uid(str(self.user.pk)))
+
+        # Ambiguous matches resolve to nobody
+        UserFactory.create(username='REGULAR')
+        self.assertIsNone(resolve_uid('regular@test-email.com'))
+
+    def test_cache(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from impersonate.resolvers import resolve_uid
+
+        uid = 'regular@test-email.com'
+        resolve_uid(uid)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(resolve_uid(uid), self.user)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('email', queries[0]['sql'].split('WHERE')[1])
+
+        # A cached user that no longer matches is not returned
+        self.user.email = 'changed@test-email.com'
+        self.user.save()
+        self.digits.email = uid
+        self.digits.save()
+        self.assertEqual(resolve_uid(uid), self.digits)
+
+        with self.settings(IMPERSONATE_UID_CACHE_TIMEOUT=0):
+            with self.assertNumQueries(1):
+                self.assertEqual(resolve_uid('changed@test-email.com'),
+                                 self.user)
+
+    @override_settings(IMPERSONATE_UID_RESOLVERS=['email__iexact'])
+    def test_view(self):
+        self.client.login(username='superuser', password='foobar')
+        self.client.get(
+            reverse('impersonate-start', args=['REGULAR@test-email.com']),
+        )
+        self.assertEqual(self.client.session['_impersonate'], self.user.pk)
+
+        response = self.client.get(
+            reverse('impersonate-start', args=['nobody@test-email.com']),
+        )
+        self.assertEqual(response.status_code, 404)
+
+    async def test_async(self):
+        from impersonate.resolvers import aresolve_uid
+
+        for i in range(2):
+            self.assertEqual(
+                await aresolve_uid('regular@test-email.com'),
+                self.user,
+            )
+        self.assertEqual(await aresolve_uid(self.user.pk), self.user)
+        self.assertIsNone(await aresolve_uid('nobody'))
+
+    def test_system_check(self):
+        from unittest import mock
+
+        from django.db.models import Index
+        from django.db.models.functions import Lower
+        from impersonate.checks import check_uid_resolvers
+
+        # The default chain is not checked for indexes
+        self.assertEqual(check_uid_resolvers(None), [])
+
+        # auth.User has no index on email
+        with self.settings(IMPERSONATE_UID_RESOLVERS=['pk', 'email']):
+            errors = check_uid_resolvers(None)
+        self.assertEqual([error.id for error in errors], ['impersonate.W001'])
+        self.assertIn("'email'", errors[0].msg)
+
+        with self.settings(IMPERSONATE_UID_RESOLVERS=['pk', 'username',
+                                                      'email__iexact']):
+            self.assertEqual(len(check_uid_resolvers(None)), 1)
+            indexes = [Index(Lower('email'), name='user_email_lower')]
+            with mock.patch.object(User._meta, 'indexes', indexes):
+                self.assertEqual(check_uid_resolvers(None), [])
+
+        with self.settings(IMPERSONATE_UID_RESOLVERS=['nickname', 'pk__gt']):
+            errors = check_uid_resolvers(None)
+            self.assertEqual(
+                [error.id for error in errors],
+                ['impersonate.E003', 'impersonate.E003'],
+            )
+
+    def test_user_model_without_email(self):
+        from unittest import mock
+
+        from django.contrib.auth.base_user import AbstractBaseUser
+        from django.db import models
+        from django.test.utils import isolate_apps
+        from impersonate.checks import check_uid_resolvers
+        from impersonate.config import ImpersonateConfig
+        from impersonate.resolvers import UIDResolver
+
+        with isolate_apps('impersonate'):
+            class NoEmailUser(AbstractBaseUser):
+                handle = models.CharField(max_length=30, unique=True)
+
+                USERNAME_FIELD = 'handle'
+
+        with mock.patch('django.contrib.auth.get_user_model',
+                        return_value=NoEmailUser):
+            config = ImpersonateConfig.from_settings()
+        self.assertEqual(config.uid_resolvers, ('pk', 'handle'))
+        with mock.patch('impersonate.resolvers.User', NoEmailUser):
+            for lookup in config.uid_resolvers:
+                self.assertTrue(UIDResolver(lookup).accepts('1'))
+            # Only explicit lookups have to exist
+            self.assertEqual(check_uid_resolvers(None), [])
+            with self.settings(IMPERSONATE_UID_RESOLVERS=['pk', 'email']):
+                errors = check_uid_resolvers(None)
+            self.assertEqual([error.id for error in errors],
+                             ['impersonate.E003'])
+
+
+class TestBulkCheck(TestCase):
+    def setUp(self):
+        self.superuser = UserFactory.create(
+            username='superuser',
+            is_superuser=True,
+        )
+        self.staff = UserFactory.create(username='staff', is_staff=True)
+        self.users = [
+            UserFactory.create(username='regular{0}'.format(i))
+            for i in range(5)
+        ]
+        self.other_superuser = UserFactory.create(
+            username='other',
+            is_superuser=True,
+        )
+        self.factory = RequestFactory()
+
+    def _request(self, user):
+        request = self.factory.get('/')
+        request.user = user
+        request.user.is_impersonate = False
+        return request
+
+    def test_matches_check_allow_for_user(self):
+        from impersonate.helpers import (check_allow_for_user,
+                                         check_allow_for_users)
+
+        everyone = list(User.objects.all())
+        for impersonator in (self.superuser, self.staff, self.users[0]):
+            request = self._request(impersonator)
+            can_impersonate = impersonator.is_superuser or impersonator.is_staff
+            with self.assertNumQueries(1 if can_impersonate else 0):
+                allowed = check_allow_for_users(request, everyone)
+            self.assertEqual(allowed, dict(
+                (user.pk, check_allow_for_user(request, user))
+                for user in everyone
+            ))
+
+    def test_pks(self):
+        from impersonate.helpers import check_allow_for_users
+
+        request = self._request(self.superuser)
+        pks = [str(user.pk) for user in self.users]
+        pks.append(self.other_superuser.pk)
+        pks.append(10000)
+        allowed = check_allow_for_users(request, pks)
+        self.assertTrue(all(allowed[user.pk] for user in self.users))
+        self.assertFalse(allowed[self.other_superuser.pk])
+        self.assertFalse(allowed[10000])
+
+        with self.settings(IMPERSONATE_ALLOW_SUPERUSER=True):
+            allowed = check_allow_for_users(request, pks)
+        self.assertTrue(allowed[self.other_superuser.pk])
+
+    @override_settings(
+        IMPERSONATE_CUSTOM_USER_QUERYSET='impersonate.tests.test_qs_sliced')
+    def test_uncomposable_queryset(self):
+        from impersonate.helpers import (annotate_impersonable,
+                                         check_allow_for_users)
+
+        request = self._request(self.superuser)
+        allowed = check_allow_for_users(request, self.users)
+        self.assertTrue(all(allowed.values()))
+
+        qs = annotate_impersonable(request, User.objects.filter(
+            pk__in=[user.pk for user in self.users],
+        ))
+        self.assertTrue(all(user.can_impersonate for user in qs))
+
+    def test_annotate(self):
+        from impersonate.helpers import annotate_impersonable
+
+        request = self._request(self.superuser)
+        with self.assertNumQueries(1):
+            flags = dict(
+                annotate_impersonable(request, User.objects.all())
+                .values_list('username', 'can_impersonate')
+            )
+        self.assertTrue(flags['regular0'])
+        self.assertTrue(flags['staff'])
+        self.assertFalse(flags['other'])
+
+        request = self._request(self.users[0])
+        qs = annotate_impersonable(request, User.objects.all(), name='ok')
+        self.assertFalse(any(user.ok for user in qs))
+
+    def test_template_tag(self):
+        from django.template import Context, Template
+
+        template = Template(
+            '{% load impersonate_tags %}'
+            '{% impersonable_pks users as allowed %}'
+            '{% for user in users %}'
+            '{% if user.pk in allowed %}{{ user.username }} {% endif %}'
+            '{% endfor %}'
+        )
+        users = [self.users[0], self.other_superuser, self.users[1]]
+        with self.assertNumQueries(1):
+            output = template.render(Context({
+                'request': self._request(self.superuser),
+                'users': users,
+            }))
+        self.assertEqual(output, 'regular0 regular1 ')
+        self.assertEqual(template.render(Context({'users': users})), '')
+
+    async def test_async(self):
+        from impersonate.helpers import acheck_allow_for_users
+
+        request = self._request(self.superuser)
+        allowed = await acheck_allow_for_users(
+            request,
+            self.users + [self.other_superuser],
+        )
+        self.assertTrue(all(allowed[user.pk] for user in self.users))
+        self.assertFalse(allowed[self.other_superuser.pk])
+
+
+class TestAsync(TestCase):
+    def setUp(self):
+        self.superuser = UserFactory.create(
+            username='superuser',
+            is_superuser=True,
+            password='foobar',
+        )
+        self.user = UserFactory.create(username='regular')
+
+    def _async_request(self, user_id):
+        from django.contrib.sessions.backends.db import SessionStore
+        from django.test import AsyncRequestFactory
+        from django.utils.functional import SimpleLazyObject
+
+        superuser = self.superuser
+        request = AsyncRequestFactory().get('/test-view/')
+        request.session = SessionStore()
+        request.session['_impersonate'] = user_id
+
+        def get_user():
+            raise AssertionError('request.user loaded synchronously')
+
+        async def auser():
+            return await User.objects.aget(pk=superuser.pk)
+
+        request.user = SimpleLazyObject(get_user)
+        request.auser = auser
+        return request
+
+    def test_sync_and_async_capable(self):
+        from asgiref.sync import iscoroutinefunction
+        from impersonate.middleware import ImpersonateMiddleware
+
+        async def aget_response(request):
+            return HttpResponse()
+
+        self.assertTrue(ImpersonateMiddleware.async_capable)
+        self.assertFalse(iscoroutinefunction(
+            ImpersonateMiddleware(lambda request: HttpResponse())
+        ))
+        self.assertTrue(iscoroutinefunction(
+            ImpersonateMiddleware(aget_response)
+        ))
+
+    async def test_auser_applies_impersonation(self):
+        from unittest import mock
+        from impersonate.middleware import ImpersonateMiddleware
+
+        async def aget_response(request):
+            return HttpResponse()
+
+        middleware = ImpersonateMiddleware(aget_response)
+        request = self._async_request(self.user.pk)
+
+        no_hop = mock.Mock(side_effect=AssertionError('thread hop'))
+        with mock.patch('impersonate.helpers.sync_to_async', no_hop), \
+                mock.patch('impersonate.middleware.sync_to_async', no_hop):
+            await middleware(request)
+            user = await request.auser()
+            impersonator = await request.aimpersonator()
+
+        self.assertEqual(user, self.user)
+        self.assertTrue(user.is_impersonate)
+        self.assertIs(request.user, user)
+        self.assertEqual(impersonator, self.superuser)
+
+    async def test_auser_not_impersonating(self):
+        from impersonate.middleware import ImpersonateMiddleware
+
+        async def aget_response(request):
+            return HttpResponse()
+
+        middleware = ImpersonateMiddleware(aget_response)
+        request = self._async_request(self.user.pk + 100)
+        await middleware(request)
+        user = await request.auser()
+
+        self.assertEqual(user, self.superuser)
+        self.assertFalse(user.is_impersonate)
+        self.assertIsNone(await request.aimpersonator())
+
+    @override_settings(
+        IMPERSONATE_CUSTOM_ALLOW='impersonate.tests.test_allow2')
+    async def test_auser_custom_allow(self):
+        from impersonate.middleware import ImpersonateMiddleware
+
+        async def aget_response(request):
+            return HttpResponse()
+
+        middleware = ImpersonateMiddleware(aget_response)
+        request = self._async_request(self.user.pk)
+        await middleware(request)
+
+        self.assertEqual(await request.auser(), self.superuser)
+
+    # Flush right away, the AsyncClient sends request_finished from a
+    # thread that cannot share the in-memory test database
+    @override_settings(IMPERSONATE_LOG_BUFFER_SIZE=1)
+    async def test_async_views(self):
+        from impersonate.models import ImpersonationLog
+
+        begin, end = [], []
+
+        def on_begin(sender, **kwargs):
+            begin.append(kwargs['impersonating'])
+
+        def on_end(sender, **kwargs):
+            end.append(kwargs['impersonating'])
+
+        session_begin.connect(on_begin)
+        session_end.connect(on_end)
+        self.addCleanup(session_begin.disconnect, on_begin)
+        self.addCleanup(session_end.disconnect, on_end)
+
+        await self.async_client.alogin(username='superuser', password='foobar')
+        response = await self.async_client.get(
+            reverse('impersonate-async:impersonate-start', args=[self.user.pk]),
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(begin, [self.user])
+
+        response = await self.async_client.get(reverse('impersonate-test'))
+        self.assertEqual(response.content, b'OK regular')
+
+        response = await self.async_client.get(
+            reverse('impersonate-async:impersonate-list'),
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['page'].object_list), 2)
+
+        response = await self.async_client.get(
+            reverse('impersonate-async:impersonate-stop'),
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(end, [self.user.pk])
+
+        response = await self.async_client.get(reverse('impersonate-test'))
+        self.assertEqual(response.content, b'OK superuser')
+
+        log = await ImpersonationLog.objects.aget()
+        self.assertEqual(log.impersonating_id, self.user.pk)
+        self.assertIsNotNone(log.session_ended_at)
+
+    async def test_async_view_missing_user(self):
+        await self.async_client.alogin(username='superuser', password='foobar')
+        response = await self.async_client.get(
+            reverse('impersonate-async:impersonate-start', args=[1000]),
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class TestImpersonationLog(TestCase):
+    def setUp(self):
+        from impersonate import audit
+
+        audit.flush_log_buffer()
+        self.superuser = UserFactory.create(
+            username='superuser',
+            is_superuser=True,
+            password='foobar',
+        )
+        self.user = UserFactory.create(username='regular')
+        self.client.login(username='superuser', password='foobar')
+
+    def test_session_logged(self):
+        from impersonate.models import ImpersonationLog
+
+        self.client.get(reverse('impersonate-start', args=[self.user.pk]))
+        log = ImpersonationLog.objects.get()
+        self.assertEqual(log.impersonator, self.superuser)
+        self.assertEqual(log.impersonating, self.user)
+        self.assertEqual(log.session_key, self.client.session.session_key)
+        self.assertIsNotNone(log.session_started_at)
+        self.assertIsNone(log.session_ended_at)
+
+        self.client.get(reverse('impersonate-stop'))
+        log = ImpersonationLog.objects.get()
+        self.assertIsNotNone(log.session_ended_at)
+        self.assertTrue(log.duration.total_seconds() >= 0)
+
+    def _broken_write(self, *args, **kwargs):
+        # A real database error, raised the way bulk_create() and
+        # update() raise it: out of an atomic(savepoint=False) block
+        from django.db import connection, transaction
+
+        with transaction.atomic(savepoint=False):
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1 FROM impersonate_missing')
+
+    def test_database_errors(self):
+        from unittest import mock
+
+        from django.db.models import QuerySet
+
+        with mock.patch.object(QuerySet, 'bulk_create', self._broken_write), \
+                self.assertLogs('impersonate.audit', 'ERROR'):
+            self.client.get(reverse('impersonate-start', args=[self.user.pk]))
+        self.assertTrue(User.objects.exists())
+
+        with mock.patch.object(QuerySet, 'update', self._broken_write), \
+                self.assertLogs('impersonate.audit', 'ERROR'):
+            response = self.client.get(reverse('impersonate-stop'))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(User.objects.exists())
+
+    async def test_database_errors_async(self):
+        from unittest import mock
+
+        from django.db.models import QuerySet
+        from impersonate.audit import alog_end
+
+        request = RequestFactory().get('/')
+        request.session = mock.Mock(session_key='abc')
+        with mock.patch.object(QuerySet, 'update', self._broken_write), \
+                self.assertLogs('impersonate.audit', 'ERROR'):
+            await alog_end(request, self.superuser)
+        self.assertTrue(await User.objects.aexists())
+
+    @override_settings(IMPERSONATE_DISABLE_LOGGING=True)
+    def test_logging_disabled(self):
+        from impersonate.models import ImpersonationLog
+
+        self.client.get(reverse('impersonate-start', args=[self.user.pk]))
+        self.client.get(reverse('impersonate-stop'))
+        self.assertFalse(ImpersonationLog.objects.exists())
+
+    def test_buffer_thresholds(self):
+        from django.utils import timezone
+        from impersonate.audit import LogBuffer
+        from impersonate.models import ImpersonationLog
+
+        def new_log():
+            return ImpersonationLog(
+                impersonator=self.superuser,
+                impersonating=self.user,
+                session_key='key',
+                session_started_at=timezone.now(),
+            )
+
+        buffer = LogBuffer(max_size=3, max_age=60)
+        self.assertFalse(buffer.add(new_log()))
+        self.assertFalse(buffer.add(new_log()))
+        self.assertTrue(buffer.add(new_log()))
+        # One INSERT, in a savepoint
+        with self.assertNumQueries(3):
+            buffer.flush()
+        self.assertEqual(ImpersonationLog.objects.count(), 3)
+        self.assertEqual(len(buffer), 0)
+        with self.assertNumQueries(0):
+            buffer.flush()
+
+        buffer = LogBuffer(max_size=100, max_age=0)
+        self.assertTrue(buffer.add(new_log()))
+
+    def test_end_buffered_session(self):
+        from django.utils import timezone
+        from impersonate.audit import LogBuffer
+        from impersonate.models import ImpersonationLog
+
+        buffer = LogBuffer()
+        buffer.add(ImpersonationLog(
+            impersonator=self.superuser,
+            impersonating=self.user,
+            session_key='key',
+            session_started_at=timezone.now(),
+        ))
+        self.assertFalse(buffer.end(self.superuser.pk, 'other', timezone.now()))
+        self.assertTrue(buffer.end(self.superuser.pk, 'key', timezone.now()))
+        buffer.flush()
+        self.assertIsNotNone(ImpersonationLog.objects.get().session_ended_at)
+
+    def test_history_queries_use_indexes(self):
+        from impersonate.models import ImpersonationLog
+
+        index_fields = [
+            index.fields for index in ImpersonationLog._meta.indexes
+        ]
+        self.assertIn(['session_ended_at', 'session_started_at'], index_fields)
+        self.assertIn(['impersonator', 'session_started_at'], index_fields)
+        self.assertIn(['impersonating', 'session_started_at'], index_fields)
+
+
+@override_settings(IMPERSONATE_CHECK_REVOCATIONS=True)
+class TestRegistry(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        from impersonate import audit
+
+        cache.clear()
+        audit.flush_log_buffer()
+        self.superuser = UserFactory.create(
+            username='superuser',
+            is_superuser=True,
+            password='foobar',
+        )
+        self.user = UserFactory.create(username='regular')
+        self.other = UserFactory.create(username='other')
+        self.client.login(username='superuser', password='foobar')
+
+    def _start(self, user):
+        self.client.get(reverse('impersonate-start', args=[user.pk]))
+
+    def _current_user(self):
+        return self.client.get(reverse('impersonate-test')).content
+
+    def test_registry(self):
+        from impersonate.registry import START_KEY, get_active_sessions
+
+        self._start(self.user)
+        self.assertIn(START_KEY, self.client.session)
+        log = get_active_sessions(impersonator=self.superuser).get()
+        self.assertEqual(log.impersonating, self.user)
+        self.assertEqual(log.session_key, self.client.session.session_key)
+        self.assertFalse(get_active_sessions(impersonating=self.other))
+
+        self.client.get(reverse('impersonate-stop'))
+        self.assertNotIn(START_KEY, self.client.session)
+        self.assertFalse(get_active_sessions())
+
+    def test_revoke_impersonator(self):
+        from impersonate.registry import get_active_sessions, revoke
+
+        self._start(self.user)
+        self.assertIn(b'regular', self._current_user())
+
+        ended = []
+
+        def on_end(sender, event=None, **kwargs):
+            ended.append(event)
+
+        session_end.connect(on_end)
+        try:
+            self.assertEqual(revoke(impersonator=self.superuser.pk), 1)
+            self.assertFalse(get_active_sessions())
+            self.assertIn(b'superuser', self._current_user())
+        finally:
+            session_end.disconnect(on_end)
+        self.assertNotIn('_impersonate', self.client.session)
+        self.assertEqual([event['impersonating'] for event in ended],
+                         [self.user.pk])
+
+        # Impersonating again after the revocation works
+        self._start(self.user)
+        self.assertIn(b'regular', self._current_user())
+
+    def test_revoke_pair(self):
+        from impersonate.registry import revoke
+
+        self._start(self.user)
+        revoke(impersonator=self.superuser, impersonating=self.other)
+        self.assertIn(b'regular', self._current_user())
+        revoke(impersonating=self.user)
+        self.assertIn(b'superuser', self._current_user())
+
+    def test_revoke_session(self):
+        from impersonate.registry import revoke
+
+        self._start(self.user)
+        revoke(session_key='another-session')
+        self.assertIn(b'regular', self._current_user())
+        revoke(session_key=self.client.session.session_key)
+        self.assertIn(b'superuser', self._current_user())
+
+        with self.assertRaises(ValueError):
+            revoke()
+
+    @override_settings(IMPERSONATE_CHECK_REVOCATIONS=False)
+    def test_check_disabled(self):
+        from impersonate.registry import revoke
+
+        self._start(self.user)
+        revoke(impersonator=self.superuser)
+        self.assertIn(b'regular', self._current_user())
+
+    def test_revocation_expires(self):
+        from unittest import mock
+
+        from django.conf import settings
+        from impersonate.registry import revoke
+
+        with mock.patch('django.core.cache.backends.locmem.LocMemCache.set') \
+                as cache_set:
+            revoke(impersonating=self.user.pk)
+        self.assertEqual(cache_set.call_args[0][2], settings.SESSION_COOKIE_AGE)
+
+    def test_command(self):
+        from io import StringIO
+
+        from django.core.management import CommandError, call_command
+        from impersonate.registry import get_active_sessions
+
+        self._start(self.user)
+        out = StringIO()
+        call_command('impersonate_sessions', stdout=out)
+        self.assertIn(self.client.session.session_key, out.getvalue())
+
+        out, err = StringIO(), StringIO()
+        call_command('impersonate_sessions', impersonating=str(self.other.pk),
+                     revoke=True, stdout=out, stderr=err)
+        self.assertIn('Revoked 0 session(s)', out.getvalue())
+        # The test settings use the local memory cache
+        self.assertIn('local to this process', err.getvalue())
+        self.assertIn(b'regular', self._current_user())
+
+        with self.settings(IMPERSONATE_CHECK_REVOCATIONS=False):
+            with self.assertRaises(CommandError):
+                call_command('impersonate_sessions', revoke=True)
+        self.assertTrue(get_active_sessions())
+
+        out = StringIO()
+        call_command('impersonate_sessions', revoke=True, stdout=out,
+                     stderr=StringIO())
+        self.assertIn('Revoked 1 session(s)', out.getvalue())
+        self.assertFalse(get_active_sessions())
+        self.assertIn(b'superuser', self._current_user())
+
+    async def test_async(self):
+        import time
+
+        from django.contrib.sessions.backends.signed_cookies import \
+            SessionStore
+        from impersonate.middleware import ImpersonateMiddleware
+        from impersonate.registry import START_KEY, arevoke
+
+        async def aget_response(request):
+            return HttpResponse()
+
+        superuser = self.superuser
+
+        async def auser():
+            return superuser
+
+        session = SessionStore()
+        session['_impersonate'] = self.user.pk
+        session[START_KEY] = time.time()
+
+        async def process():
+            request = RequestFactory().get('/')
+            request.user = superuser
+            request.auser = auser
+            request.session = session
+            await ImpersonateMiddleware(aget_response)(request)
+            return await request.auser()
+
+        self.assertEqual(await process(), self.user)
+        await arevoke(impersonating=self.user.pk)
+        self.assertEqual(await process(), self.superuser)
+        self.assertNotIn('_impersonate', session)
+
+
+@override_settings(
+    IMPERSONATE_MATERIALIZE_PERMISSIONS=True,
+    IMPERSONATE_CUSTOM_USER_QUERYSET='impersonate.tests.test_qs_visible')
+class TestMaterializedPermissions(TestCase):
+    def setUp(self):
+        self.superuser = UserFactory.create(
+            username='superuser',
+            is_superuser=True,
+            password='foobar',
+        )
+        self.user = UserFactory.create(username='regular')
+        self.hidden = UserFactory.create(
+            username='hidden',
+            last_name='hidden',
+        )
+        del test_qs_calls[:]
+
+    def _rebuild(self):
+        from io import StringIO
+
+        from django.core.management import call_command
+
+        out = StringIO()
+        call_command('impersonate_rebuild_permissions', batch_size=1,
+                     stdout=out)
+        return out.getvalue()
+
+    def _request(self):
+        request = RequestFactory().get('/')
+        request.user = self.superuser
+        request.user.is_impersonate = False
+        return request
+
+    def test_rebuild(self):
+        from impersonate.helpers import check_allow_for_user
+        from impersonate.models import (ImpersonationPermission,
+                                        MaterializedImpersonator)
+
+        self.assertFalse(check_allow_for_user(self._request(), self.user))
+
+        self.assertIn('1 impersonator(s) done', self._rebuild())
+        targets = set(ImpersonationPermission.objects.filter(
+            impersonator=self.superuser,
+        ).values_list('target_id', flat=True))
+        self.assertEqual(targets, set([self.superuser.pk, self.user.pk]))
+        # Only staff and superusers are impersonators
+        self.assertEqual(
+            list(MaterializedImpersonator.objects.values_list(
+                'impersonator_id',
+                flat=True,
+            )),
+            [self.superuser.pk],
+        )
+        self.assertFalse(ImpersonationPermission.objects.filter(
+            impersonator=self.user,
+        ).exists())
+
+        # A rebuild only writes the difference
+        self.assertIn('0 row(s) changed', self._rebuild())
+
+    def test_checks_skip_custom_queryset(self):
+        from impersonate.helpers import (check_allow_for_user,
+                                         get_impersonable_user,
+                                         users_impersonable)
+
+        self._rebuild()
+        del test_qs_calls[:]
+        request = self._request()
+        with self.assertNumQueries(1):
+            self.assertTrue(check_allow_for_user(request, self.user))
+        self.assertFalse(check_allow_for_user(request, self.hidden))
+        self.assertEqual(
+            get_impersonable_user(request, self.user.pk),
+            self.user,
         )
+        self.assertIsNone(get_impersonable_user(request, self.hidden.pk))
+        self.assertEqual(
+            set(users_impersonable(request)),
+            set([self.superuser, self.user]),
+        )
+        self.assertEqual(test_qs_calls, [])
+
+    def test_user_saved(self):
+        from impersonate.helpers import check_allow_for_user
+
+        self._rebuild()
+        request = self._request()
+
+        # As a target
+        with self.captureOnCommitCallbacks(execute=True):
+            self.hidden.last_name = 'visible'
+            self.hidden.save()
+        self.assertTrue(check_allow_for_user(request, self.hidden))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.last_name = 'hidden'
+            self.user.save()
+        self.assertFalse(check_allow_for_user(request, self.user))
+
+        # As an impersonator
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_staff = True
+            self.user.save()
+        request.user = self.user
+        request.user.is_impersonate = False
+        self.assertTrue(check_allow_for_user(request, self.hidden))
+
+        # Logging in does not refresh
+        del test_qs_calls[:]
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.user.save(update_fields=['last_login'])
+        self.assertEqual(callbacks, [])
+
+    @override_settings(IMPERSONATE_MATERIALIZE_FIELDS=['last_name'])
+    def test_tracked_fields(self):
+        from impersonate.helpers import check_allow_for_user
+
+        self._rebuild()
+        request = self._request()
+
+        # Other fields changed, no refresh
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.hidden.first_name = 'Changed'
+            self.hidden.save()
+            self.hidden.save(update_fields=['first_name'])
+        self.assertEqual(callbacks, [])
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.hidden.last_name = 'visible'
+            self.hidden.save()
+        self.assertEqual(len(callbacks), 1)
+        self.assertTrue(check_allow_for_user(request, self.hidden))
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.hidden.last_name = 'hidden'
+            self.hidden.save(update_fields=['last_name'])
+        self.assertFalse(check_allow_for_user(request, self.hidden))
+
+        # New users are always refreshed
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            new_user = UserFactory.create(username='new')
+        self.assertTrue(check_allow_for_user(request, new_user))
 
-        @classmethod
-        def _prepare(cls, create, **kwargs):
-            password = kwargs.pop('password', None)
-            user = super(UserFactory, cls)._prepare(create, **kwargs)
-            if password:
-                user.set_password(password)
-                if create:
-                    user.save()
-            return user
+    @override_settings(
+        IMPERSONATE_CUSTOM_USER_QUERYSET='impersonate.tests.test_qs_support')
+    def test_group_members_removed(self):
+        from django.contrib.auth.models import Group
+
+        from impersonate.helpers import check_allow_for_user
+
+        agent = UserFactory.create(username='agent', is_staff=True)
+        group = Group.objects.create(name='support')
+        request = self._request()
+        request.user = agent
+        request.user.is_impersonate = False
+
+        with self.captureOnCommitCallbacks(execute=True):
+            agent.groups.add(group)
+        self.assertTrue(check_allow_for_user(request, self.user))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            group.user_set.clear()
+        self.assertFalse(check_allow_for_user(request, self.user))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            group.user_set.add(agent)
+        self.assertTrue(check_allow_for_user(request, self.user))
+
+        # Deleting the group removes the memberships without m2m_changed
+        with self.captureOnCommitCallbacks(execute=True):
+            group.delete()
+        self.assertFalse(check_allow_for_user(request, self.user))
+
+    def test_refresh_permissions(self):
+        from impersonate.helpers import check_allow_for_user
+        from impersonate.permissions import refresh_permissions
+
+        self._rebuild()
+        request = self._request()
+        # Not through save(), as a change to another model would be
+        User.objects.filter(pk=self.user.pk).update(last_name='hidden')
+        self.assertTrue(check_allow_for_user(request, self.user))
+        self.assertEqual(refresh_permissions(targets=[self.user.pk]), 1)
+        self.assertFalse(check_allow_for_user(request, self.user))
+
+    async def test_async(self):
+        from asgiref.sync import sync_to_async
+        from impersonate.helpers import acheck_allow_for_user
+
+        await sync_to_async(self._rebuild)()
+        del test_qs_calls[:]
+        request = self._request()
+        self.assertTrue(await acheck_allow_for_user(request, self.user))
+        self.assertFalse(await acheck_allow_for_user(request, self.hidden))
+        self.assertEqual(test_qs_calls, [])
+
+
+class StateBackendTests(object):
+    ''' Run for every non-session IMPERSONATE_STATE_BACKEND
+    '''
+    def setUp(self):
+        from django.core.cache import cache
 
+        cache.clear()
+        self.superuser = UserFactory.create(
+            username='superuser',
+            is_superuser=True,
+            password='foobar',
+        )
+        self.staff = UserFactory.create(
+            username='staff',
+            is_staff=True,
+            password='foobar',
+        )
+        self.user = UserFactory.create(username='regular')
+        self.client.login(username='superuser', password='foobar')
 
-class TestMiddleware(TestCase):
+    def _current_user(self, client=None):
+        client = client or self.client
+        return client.get(reverse('impersonate-test')).content
+
+    def test_session_untouched(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('impersonate-start', args=[self.user.pk]))
+            self.assertIn(b'regular', self._current_user())
+            self.assertIn(b'regular', self._current_user())
+            self.client.get(reverse('impersonate-stop'))
+        self.assertNotIn('_impersonate', self.client.session)
+        self.assertFalse([
+            query for query in queries
+            if query['sql'].startswith(('UPDATE', 'INSERT')) and
+            'django_session' in query['sql']
+        ])
+        self.assertIn(b'superuser', self._current_user())
+
+    def test_bound_to_impersonator(self):
+        self.client.get(reverse('impersonate-start', args=[self.user.pk]))
+
+        client = Client()
+        client.login(username='staff', password='foobar')
+        self._copy_state(self.client, client)
+        self.assertIn(b'staff', self._current_user(client))
+
+    def test_logout_ends_impersonation(self):
+        self.client.get(reverse('impersonate-start', args=[self.user.pk]))
+        self.assertIn(b'regular', self._current_user())
+        state = self._save_state(self.client)
+
+        self.client.logout()
+        self.client.login(username='superuser', password='foobar')
+        self._restore_state(self.client, state)
+        self.assertIn(b'superuser', self._current_user())
+
+    async def test_async(self):
+        from impersonate.state import get_state_backend
+
+        request = RequestFactory().get('/')
+        request.user = self.superuser
+        request.user.is_impersonate = False
+        request.session = self.client.session
+        backend = get_state_backend()
+        await backend.aset(request, '_impersonate', self.user.pk)
+        response = HttpResponse()
+        await backend.asave(request, response)
+
+        request = RequestFactory().get('/')
+        request.COOKIES.update(
+            (key, morsel.value) for key, morsel in response.cookies.items()
+        )
+        request.user = self.superuser
+        request.session = self.client.session
+        self.assertEqual(
+            await backend.aget(request, '_impersonate'),
+            self.user.pk,
+        )
+
+
+@override_settings(
+    IMPERSONATE_STATE_BACKEND='impersonate.state.SignedCookieStateBackend')
+class TestSignedCookieState(StateBackendTests, TestCase):
+    def _copy_state(self, source, target):
+        target.cookies['impersonate'] = source.cookies['impersonate'].value
+
+    def _save_state(self, client):
+        return client.cookies['impersonate'].value
+
+    def _restore_state(self, client, state):
+        # The browser keeps the cookie
+        client.cookies['impersonate'] = state
+
+    def test_cookie(self):
+        self.client.get(reverse('impersonate-start', args=[self.user.pk]))
+        cookie = self.client.cookies['impersonate']
+        self.assertTrue(cookie['httponly'])
+
+        cookie.set('impersonate', cookie.value + 'x', cookie.value + 'x')
+        self.assertIn(b'superuser', self._current_user())
+
+        self.client.get(reverse('impersonate-start', args=[self.user.pk]))
+        self.client.get(reverse('impersonate-stop'))
+        self.assertEqual(self.client.cookies['impersonate'].value, '')
+
+
+@override_settings(
+    IMPERSONATE_STATE_BACKEND='impersonate.state.CacheStateBackend')
+class TestCacheState(StateBackendTests, TestCase):
+    def _copy_state(self, source, target):
+        from django.core.cache import cache
+
+        cache.set(
+            'impersonate:state:{0}'.format(target.session.session_key),
+            cache.get(
+                'impersonate:state:{0}'.format(source.session.session_key),
+            ),
+        )
+
+    def _save_state(self, client):
+        from django.core.cache import cache
+
+        return cache.get(
+            'impersonate:state:{0}'.format(client.session.session_key),
+        )
+
+    def _restore_state(self, client, state):
+        # A cache entry written under the new session key
+        from django.core.cache import cache
+
+        cache.set(
+            'impersonate:state:{0}'.format(client.session.session_key),
+            state,
+        )
+
+    def test_cache(self):
+        from django.core.cache import cache
+
+        key = 'impersonate:state:{0}'.format(self.client.session.session_key)
+        self.client.get(reverse('impersonate-start', args=[self.user.pk]))
+        self.assertEqual(cache.get(key)['_impersonate'], self.user.pk)
+        self.client.get(reverse('impersonate-stop'))
+        self.assertIsNone(cache.get(key))
+
+
+@override_settings(IMPERSONATE_SIGNAL_DISPATCH='background')
+class TestSignalDispatch(TestCase):
+    def setUp(self):
+        from impersonate import dispatch
+
+        # Fresh counters
+        if dispatch._dispatcher is not None:
+            dispatch._dispatcher.shutdown(wait=False)
+            dispatch._dispatcher = None
+        self.superuser = UserFactory.create(
+            username='superuser',
+            is_superuser=True,
+            password='foobar',
+        )
+        self.user = UserFactory.create(username='regular')
+        self.client.login(username='superuser', password='foobar')
+
+    def _connect(self, signal, receiver):
+        signal.connect(receiver)
+        self.addCleanup(signal.disconnect, receiver)
+
+    def test_receivers_get_event(self):
+        import threading
+        from impersonate.dispatch import get_dispatcher
+
+        events = []
+        threads = []
+
+        def receiver(sender, **kwargs):
+            events.append(kwargs)
+            threads.append(threading.current_thread())
+
+        self._connect(session_begin, receiver)
+        self._connect(session_end, receiver)
+
+        self.client.get(reverse('impersonate-start', args=[self.user.pk]),
+                        REMOTE_ADDR='10.0.0.1')
+        self.client.get(reverse('impersonate-stop'))
+        get_dispatcher().flush()
+
+        begin, end = sorted(events, key=lambda kw: kw['event']['name'])
+        self.assertNotIn('request', begin)
+        self.assertNotIn('impersonator', begin)
+        self.assertEqual(begin['event']['name'], 'session_begin')
+        self.assertEqual(begin['event']['impersonator'], self.superuser.pk)
+        self.assertEqual(begin['event']['impersonating'], self.user.pk)
+        self.assertEqual(begin['event']['remote_addr'], '10.0.0.1')
+        self.assertEqual(
+            begin['event']['session_key'],
+            self.client.session.session_key,
+        )
+        self.assertEqual(end['event']['name'], 'session_end')
+        self.assertEqual(end['event']['impersonating'], self.user.pk)
+        self.assertNotIn(threading.current_thread(), threads)
+
+        stats = get_dispatcher().stats()
+        self.assertEqual(stats['submitted'], 2)
+        self.assertEqual(stats['completed'], 2)
+        self.assertEqual(stats['pending'], 0)
+
+    def test_event_in_sync_mode(self):
+        events = []
+
+        def receiver(sender, **kwargs):
+            events.append(kwargs)
+
+        self._connect(session_begin, receiver)
+        with self.settings(IMPERSONATE_SIGNAL_DISPATCH='sync'):
+            self.client.get(
+                reverse('impersonate-start', args=[self.user.pk]),
+            )
+        self.assertEqual(events[0]['impersonating'], self.user)
+        self.assertEqual(events[0]['event']['impersonating'], self.user.pk)
+
+    def _fill_queue(self):
+        import threading
+        from impersonate.dispatch import get_dispatcher
+
+        release = threading.Event()
+
+        def slow_receiver(sender, **kwargs):
+            if kwargs.get('request') is None:
+                # in the background
+                release.wait(5)
+
+        self._connect(session_begin, slow_receiver)
+        self.addCleanup(release.set)
+        self.client.get(reverse('impersonate-start', args=[self.user.pk]))
+        self.assertEqual(get_dispatcher().stats()['pending'], 1)
+        return release
+
+    @override_settings(IMPERSONATE_SIGNAL_QUEUE_SIZE=1)
+    def test_overflow_drop(self):
+        from impersonate.dispatch import get_dispatcher
+
+        release = self._fill_queue()
+        self.client.get(reverse('impersonate-start', args=[self.user.pk]))
+        release.set()
+        get_dispatcher().flush()
+
+        stats = get_dispatcher().stats()
+        self.assertEqual(stats['submitted'], 1)
+        # session_end of the first session and the second session_begin
+        self.assertEqual(stats['dropped'], 2)
+
+    @override_settings(IMPERSONATE_SIGNAL_QUEUE_SIZE=1,
+                       IMPERSONATE_SIGNAL_OVERFLOW='inline')
+    def test_overflow_inline(self):
+        from impersonate.dispatch import get_dispatcher
+
+        inline = []
+
+        def receiver(sender, **kwargs):
+            if kwargs.get('request') is not None:
+                inline.append(kwargs['event']['name'])
+
+        self._connect(session_begin, receiver)
+        release = self._fill_queue()
+        self.client.get(reverse('impersonate-start', args=[self.user.pk]))
+        release.set()
+        get_dispatcher().flush()
+
+        self.assertEqual(inline, ['session_begin'])
+        self.assertEqual(get_dispatcher().stats()['inline'], 2)
+
+    @override_settings(IMPERSONATE_SIGNAL_QUEUE_SIZE=1,
+                       IMPERSONATE_DECISION_CACHE_TIMEOUT=60)
+    def test_internal_receivers_inline(self):
+        from django.core.cache import cache
+        from impersonate.cache import get_decision_cache
+        from impersonate.dispatch import get_dispatcher
+
+        cache.clear()
+        release = self._fill_queue()
+        self.client.get(reverse('impersonate-test'))
+        decision_cache = get_decision_cache()
+        self.assertTrue(decision_cache.get(self.superuser.pk, self.user.pk))
+
+        # session_end is dropped, the decision is dropped all the same
+        self.client.get(reverse('impersonate-stop'))
+        self.assertEqual(get_dispatcher().stats()['dropped'], 1)
+        self.assertIsNone(decision_cache.get(self.superuser.pk, self.user.pk))
+        release.set()
+
+    def test_worker_connections(self):
+        from unittest import mock
+
+        from impersonate.dispatch import get_dispatcher
+
+        with mock.patch('impersonate.dispatch.close_old_connections') as close:
+            self.client.get(
+                reverse('impersonate-start', args=[self.user.pk]),
+            )
+            get_dispatcher().flush()
+        self.assertEqual(close.call_count, 2)
+
+    def test_failed_receiver(self):
+        from impersonate.dispatch import get_dispatcher
+
+        def broken_receiver(sender, **kwargs):
+            raise ValueError('broken')
+
+        self._connect(session_begin, broken_receiver)
+        with self.assertLogs('impersonate.dispatch', 'ERROR'):
+            self.client.get(
+                reverse('impersonate-start', args=[self.user.pk]),
+            )
+            get_dispatcher().flush()
+        self.assertEqual(get_dispatcher().stats()['failed'], 1)
+
+
+@override_settings(
+    IMPERSONATE_INSTRUMENTATION='impersonate.instrumentation.MemoryInstrumentation')
+class TestInstrumentation(TestCase):
     def setUp(self):
+        from impersonate.instrumentation import get_instrumentation
         from impersonate.middleware import ImpersonateMiddleware
 
         self.superuser = UserFactory.create(
@@ -134,28 +2089,280 @@ class TestMiddleware(TestCase):
         self.user = UserFactory.create(username='regular')
         self.factory = RequestFactory()
         self.middleware = ImpersonateMiddleware()
+        self.instrumentation = get_instrumentation()
+        self.instrumentation.reset()
 
-    def _impersonated_request(self, use_id=True):
-        request = self.factory.get('/')
+    def _process(self, path='/'):
+        request = self.factory.get(path)
         request.user = self.superuser
-        request.session = {
-            '_impersonate': self.user.id if use_id else self.user,
-        }
+        request.session = {'_impersonate': self.user.pk}
         self.middleware.process_request(request)
-
-        # Check request.user and request.user.real_user
-        self.assertEqual(request.user, self.user)
-        self.assertEqual(request.impersonator, self.superuser)
-        self.assertTrue(request.user.is_impersonate)
+        return request
 
     def test_impersonated_request(self):
-        self._impersonated_request()
+        self._process()
+        summary = self.instrumentation.summary()
+        self.assertEqual(summary['apply_impersonate']['calls'], 1)
+        self.assertEqual(summary['apply_impersonate']['queries'], 1)
+        self.assertEqual(summary['get_impersonable_user']['queries'], 1)
+        self.assertEqual(summary['check_allow_impersonate']['queries'], 0)
+        self.assertEqual(summary['users_impersonable']['calls'], 1)
+        self.assertEqual(summary['check_allow_for_uri']['calls'], 1)
+        self.assertEqual(self.instrumentation.counters['impersonate.applied'], 1)
+
+        self._process('/admin/')
+        self.assertEqual(self.instrumentation.counters['impersonate.applied'], 1)
+
+    @override_settings(IMPERSONATE_DECISION_CACHE_TIMEOUT=60)
+    def test_decision_cache_counters(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        self._process()
+        self._process()
+        self.assertEqual(self.instrumentation.counters['decision_cache.miss'], 1)
+        self.assertEqual(self.instrumentation.counters['decision_cache.hit'], 1)
+
+    def test_search_and_paginator(self):
+        from impersonate.contexts import get_search_template_context
 
-    def test_impersonated_request_non_id(self):
-        ''' Test to ensure User objects don't kill the app.
-            See Issue #15
-        '''
-        self._impersonated_request(use_id=False)
+        request = self.factory.get('/')
+        request.user = self.superuser
+        request.user.is_impersonate = False
+        get_search_template_context(request, 'regular')
+        summary = self.instrumentation.summary()
+        self.assertEqual(summary['get_search_template_context']['calls'], 1)
+        self.assertEqual(summary['get_paginator']['calls'], 1)
+        self.assertEqual(summary['get_paginator']['queries'], 1)
+
+    def test_logging(self):
+        with self.settings(
+                IMPERSONATE_INSTRUMENTATION=(
+                    'impersonate.instrumentation.LoggingInstrumentation')):
+            with self.assertLogs('impersonate.instrumentation', 'DEBUG') as logs:
+                self._process()
+        self.assertTrue(any(
+            'apply_impersonate took' in line and '1 queries' in line
+            for line in logs.output
+        ))
+
+    def test_disabled(self):
+        from impersonate.instrumentation import get_instrumentation
+
+        with self.settings(IMPERSONATE_INSTRUMENTATION=None):
+            self.assertFalse(get_instrumentation().enabled)
+            self._process()
+        self.assertTrue(get_instrumentation().enabled)
+        self.assertEqual(self.instrumentation.summary(), {})
+
+
+class TestURIExclusions(TestCase):
+    def test_literal_prefix(self):
+        from impersonate.exclusions import get_literal_prefix
+
+        self.assertEqual(get_literal_prefix(r'^admin/'), 'admin/')
+        self.assertEqual(get_literal_prefix(r'^static\.files/'), 'static.files/')
+        self.assertEqual(get_literal_prefix(r'^admin/.*'), None)
+        self.assertEqual(get_literal_prefix(r'^\d+/'), None)
+        self.assertEqual(get_literal_prefix(r'admin/'), None)
+
+    def test_matcher(self):
+        from impersonate.exclusions import URIExclusionMatcher
+
+        matcher = URIExclusionMatcher(
+            [r'^admin/', r'^api/v1/', r'^users/\d+/edit/', r'health$'],
+        )
+        self.assertEqual(
+            set(matcher.prefix_trie),
+            set(['a']),
+        )
+        self.assertEqual(len(matcher.regexes), 1)
+        self.assertTrue(matcher.is_excluded('admin/'))
+        self.assertTrue(matcher.is_excluded('admin/auth/user/'))
+        self.assertTrue(matcher.is_excluded('api/v1/users/'))
+        self.assertTrue(matcher.is_excluded('users/12/edit/'))
+        self.assertTrue(matcher.is_excluded('status/health'))
+        self.assertFalse(matcher.is_excluded('adm/'))
+        self.assertFalse(matcher.is_excluded('api/v2/'))
+        self.assertFalse(matcher.is_excluded('users/me/edit/'))
+        self.assertFalse(matcher.is_excluded(''))
+
+    def test_uncombinable_patterns(self):
+        from impersonate.exclusions import URIExclusionMatcher
+
+        matcher = URIExclusionMatcher(
+            [r'^(a)\1/', r'^(?P<x>b)/', r'^(?P<x>c)/'],
+        )
+        self.assertEqual(len(matcher.regexes), 3)
+        self.assertTrue(matcher.is_excluded('aa/'))
+        self.assertTrue(matcher.is_excluded('c/'))
+        self.assertFalse(matcher.is_excluded('ab/'))
+
+    def test_verdicts_are_cached(self):
+        from impersonate.exclusions import URIExclusionMatcher
+
+        matcher = URIExclusionMatcher([r'^admin/'], cache_size=2)
+        matcher.is_excluded('admin/')
+        matcher.is_excluded('admin/')
+        info = matcher.is_excluded.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+
+        matcher.is_excluded('a/')
+        matcher.is_excluded('b/')
+        self.assertEqual(matcher.is_excluded.cache_info().currsize, 2)
+
+    def test_rebuilt_on_setting_changed(self):
+        from impersonate.helpers import check_allow_for_uri
+
+        self.assertFalse(check_allow_for_uri('/admin/'))
+        self.assertTrue(check_allow_for_uri('/test-view/'))
+        with self.settings(IMPERSONATE_URI_EXCLUSIONS=r'^test-view/'):
+            self.assertTrue(check_allow_for_uri('/admin/'))
+            self.assertFalse(check_allow_for_uri('/test-view/'))
+        with self.settings(IMPERSONATE_URI_EXCLUSIONS=()):
+            self.assertTrue(check_allow_for_uri('/admin/'))
+        self.assertFalse(check_allow_for_uri('/admin/'))
+
+
+class TestSettingFunctions(TestCase):
+    @override_settings(IMPERSONATE_CUSTOM_ALLOW='impersonate.tests.test_allow')
+    def test_resolved_once(self):
+        from impersonate import helpers
+
+        func = helpers.get_setting_func('IMPERSONATE_CUSTOM_ALLOW')
+        self.assertIs(func, test_allow)
+        self.assertIn(
+            ('IMPERSONATE_CUSTOM_ALLOW', None),
+            helpers._setting_funcs,
+        )
+        self.assertIs(helpers.get_setting_func('IMPERSONATE_CUSTOM_ALLOW'), func)
+
+        with self.settings(
+                IMPERSONATE_CUSTOM_ALLOW='impersonate.tests.test_allow2'):
+            self.assertIs(
+                helpers.get_setting_func('IMPERSONATE_CUSTOM_ALLOW'),
+                test_allow2,
+            )
+        self.assertIs(helpers.get_setting_func('IMPERSONATE_CUSTOM_ALLOW'), func)
+
+    def test_unset(self):
+        from impersonate.helpers import get_setting_func
+
+        self.assertIsNone(get_setting_func('IMPERSONATE_CUSTOM_ALLOW'))
+
+    @override_settings(
+        IMPERSONATE_CUSTOM_ALLOW='impersonate.tests.does_not_exist',
+        IMPERSONATE_CUSTOM_USER_QUERYSET='impersonate.missing_module.func',
+    )
+    def test_system_check_import_errors(self):
+        from impersonate.checks import check_function_settings
+
+        errors = check_function_settings(None)
+        self.assertEqual(
+            [error.id for error in errors],
+            ['impersonate.E001', 'impersonate.E001'],
+        )
+
+    @override_settings(IMPERSONATE_CUSTOM_ALLOW='impersonate.tests.User')
+    def test_system_check_not_callable(self):
+        from impersonate.checks import check_function_settings
+
+        self.assertEqual(check_function_settings(None), [])
+
+        with self.settings(
+                IMPERSONATE_CUSTOM_ALLOW='impersonate.tests.urlpatterns'):
+            errors = check_function_settings(None)
+            self.assertEqual([error.id for error in errors],
+                             ['impersonate.E002'])
+
+    def test_system_check_valid(self):
+        from impersonate.checks import check_function_settings
+
+        self.assertEqual(check_function_settings(None), [])
+
+
+class TestConfig(TestCase):
+    def test_snapshot_is_reused(self):
+        from impersonate.config import get_config
+
+        self.assertIs(get_config(), get_config())
+
+    def test_read_only(self):
+        from impersonate.config import get_config
+
+        config = get_config()
+        with self.assertRaises(AttributeError):
+            config.paginate_count = 5
+        with self.assertRaises(AttributeError):
+            config.something_else = 5
+        with self.assertRaises(AttributeError):
+            del config.paginate_count
+
+    def test_defaults(self):
+        from impersonate.config import get_config
+
+        config = get_config()
+        self.assertEqual(config.paginate_count, 20)
+        self.assertEqual(config.uri_exclusions, (r'^admin/',))
+        self.assertEqual(config.redirect_url, '/accounts/profile/')
+        self.assertEqual(
+            set(config.search_fields),
+            set(['username', 'first_name', 'last_name', 'email']),
+        )
+
+    def test_rebuilt_on_setting_changed(self):
+        from impersonate.config import get_config
+
+        config = get_config()
+        with self.settings(IMPERSONATE_PAGINATE_COUNT='5',
+                           IMPERSONATE_URI_EXCLUSIONS=r'^foo/'):
+            self.assertIsNot(get_config(), config)
+            self.assertEqual(get_config().paginate_count, 5)
+            self.assertEqual(get_config().uri_exclusions, (r'^foo/',))
+            self.assertEqual(get_config().fingerprint, config.fingerprint)
+
+        with self.settings(LOGIN_REDIRECT_URL='/elsewhere/'):
+            self.assertEqual(get_config().redirect_url, '/elsewhere/')
+
+        with self.settings(IMPERSONATE_ALLOW_SUPERUSER=True):
+            self.assertNotEqual(get_config().fingerprint, config.fingerprint)
+        self.assertEqual(get_config().paginate_count, 20)
+
+    def test_cache_alias(self):
+        from django.core.cache import caches
+
+        from impersonate.cache import get_user_cache
+        from impersonate.config import get_config
+        from impersonate.pagination import cached_count
+        from impersonate.registry import revoke
+        from impersonate.state import CacheStateBackend
+
+        self.assertEqual(get_config().cache_alias, 'default')
+        with self.settings(IMPERSONATE_DECISION_CACHE_ALIAS='decisions'):
+            self.assertEqual(get_config().cache_alias, 'decisions')
+
+        backend = 'django.core.cache.backends.locmem.LocMemCache'
+        with self.settings(
+            CACHES={
+                'default': {'BACKEND': backend, 'LOCATION': 'default'},
+                'impersonate': {'BACKEND': backend, 'LOCATION': 'other'},
+            },
+            IMPERSONATE_CACHE_ALIAS='impersonate',
+            IMPERSONATE_USER_CACHE_TIMEOUT=60,
+        ):
+            self.assertIs(get_user_cache().cache, caches['impersonate'])
+            self.assertIs(CacheStateBackend().cache, caches['impersonate'])
+            cached_count(User.objects.all(), 60)
+            revoke(impersonator=1)
+            self.assertEqual(len(caches['impersonate']._cache), 2)
+            self.assertEqual(len(caches['default']._cache), 0)
+
+    def test_unrelated_setting_keeps_snapshot(self):
+        from impersonate.config import get_config
+
+        config = get_config()
+        with self.settings(TIME_ZONE='Europe/London'):
+            self.assertIs(get_config(), config)
 
 
 class TestImpersonation(TestCase):
@@ -442,6 +2649,191 @@ class TestImpersonation(TestCase):
 
         self.client.logout()
 
+    def test_cursor_uuid_pk(self):
+        import uuid
+        from unittest import mock
+
+        from django.db import models
+        from impersonate.pagination import NEXT, CursorPaginator
+
+        paginator = CursorPaginator(User.objects.all(), 3)
+        pk = uuid.uuid4()
+        cursor = paginator.encode_cursor(mock.Mock(pk=pk), NEXT)
+        with mock.patch.object(User._meta, 'pk', models.UUIDField()):
+            self.assertEqual(paginator.decode_cursor(cursor), (pk, NEXT, None))
+        # Not a valid pk of this model
+        self.assertIsNone(paginator.decode_cursor(cursor))
+
+    @override_settings(IMPERSONATE_PAGINATION='cursor',
+                       IMPERSONATE_PAGINATE_COUNT=3)
+    def test_user_listing_cursor_pagination(self):
+        self.client.login(username='user1', password='foobar')
+        response = self.client.get(reverse('impersonate-list'))
+        page = response.context['page']
+        self.assertEqual(
+            [user.username for user in page.object_list],
+            ['user1', 'user2', 'user3'],
+        )
+        self.assertIsNone(response.context['page_number'])
+        self.assertIsNone(response.context['previous_cursor'])
+        next_cursor = response.context['next_cursor']
+        self.assertIsNotNone(next_cursor)
+        self.assertIn('?cursor={0}'.format(next_cursor),
+                      response.content.decode('utf-8'))
+
+        response = self.client.get(
+            reverse('impersonate-list'),
+            {'cursor': next_cursor},
+        )
+        page = response.context['page']
+        self.assertEqual(
+            [user.username for user in page.object_list],
+            ['user4'],
+        )
+        self.assertFalse(page.has_next())
+        self.assertIsNone(response.context['next_cursor'])
+        previous_cursor = response.context['previous_cursor']
+
+        response = self.client.get(
+            reverse('impersonate-list'),
+            {'cursor': previous_cursor},
+        )
+        page = response.context['page']
+        self.assertEqual(
+            [user.username for user in page.object_list],
+            ['user1', 'user2', 'user3'],
+        )
+        self.assertFalse(page.has_previous())
+        self.assertTrue(page.has_next())
+
+        # Tampered cursors start from the beginning
+        response = self.client.get(
+            reverse('impersonate-list'),
+            {'cursor': next_cursor + 'x'},
+        )
+        self.assertEqual(len(response.context['page'].object_list), 3)
+        self.assertFalse(response.context['page'].has_previous())
+        self.client.logout()
+
+    @override_settings(IMPERSONATE_PAGINATION='cursor',
+                       IMPERSONATE_PAGINATE_COUNT=1,
+                       IMPERSONATE_CURSOR_FIELD='last_name')
+    def test_user_search_cursor_pagination(self):
+        from impersonate.contexts import get_search_template_context
+
+        user = User.objects.get(username='user1')
+        seen = []
+        params = {'q': 'john'}
+        while True:
+            request = RequestFactory().get(reverse('impersonate-search'), params)
+            request.user = user
+            with self.assertNumQueries(1):
+                context = get_search_template_context(request, 'john')
+            seen.extend(user.last_name for user in context['page'])
+            if not context['next_cursor']:
+                break
+            params = {'q': 'john', 'cursor': context['next_cursor']}
+        self.assertEqual(seen, ['Doe', 'Smith'])
+
+    @override_settings(IMPERSONATE_PAGINATION='countless',
+                       IMPERSONATE_PAGINATE_COUNT=3)
+    def test_user_listing_countless_pagination(self):
+        from impersonate.contexts import get_list_template_context
+
+        user = User.objects.get(username='user1')
+        request = RequestFactory().get(reverse('impersonate-list'))
+        request.user = user
+        with self.assertNumQueries(1):
+            context = get_list_template_context(request)
+        self.assertEqual(len(context['page'].object_list), 3)
+        self.assertTrue(context['page'].has_next())
+        self.assertEqual(context['page'].next_page_number(), 2)
+        self.assertIsNone(context['paginator'].count)
+
+        request = RequestFactory().get(reverse('impersonate-list'),
+                                       {'page': 2})
+        request.user = user
+        with self.assertNumQueries(1):
+            context = get_list_template_context(request)
+        self.assertEqual(len(context['page'].object_list), 1)
+        self.assertFalse(context['page'].has_next())
+        self.assertTrue(context['page'].has_previous())
+        self.assertEqual(context['page'].start_index(), 4)
+        self.assertEqual(context['page'].end_index(), 4)
+
+        self.client.login(username='user1', password='foobar')
+        response = self.client.get(reverse('impersonate-list'), {'page': 10})
+        self.assertEqual(response.context['page'], None)
+        response = self.client.get(reverse('impersonate-list'), {'page': 'no'})
+        self.assertEqual(len(response.context['page'].object_list), 3)
+        self.assertNotIn('about', response.content.decode('utf-8'))
+        self.client.logout()
+
+    @override_settings(IMPERSONATE_PAGINATION='countless',
+                       IMPERSONATE_PAGINATION_COUNT='estimate')
+    def test_user_listing_estimated_count(self):
+        from django.core.cache import cache
+        from impersonate.helpers import get_paginator
+
+        cache.clear()
+        request = RequestFactory().get(reverse('impersonate-list'))
+        paginator, page, page_number = get_paginator(
+            request,
+            User.objects.all(),
+        )
+        # SQLite has no planner estimate, falls back to a cached COUNT(*)
+        with self.assertNumQueries(1):
+            self.assertEqual(paginator.count, 4)
+        self.assertTrue(paginator.count_is_estimate)
+        self.assertEqual(paginator.num_pages, 1)
+
+        paginator, page, page_number = get_paginator(
+            request,
+            User.objects.all(),
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual(paginator.count, 4)
+
+        self.client.login(username='user1', password='foobar')
+        response = self.client.get(reverse('impersonate-list'))
+        self.assertIn('(about 4 users)', response.content.decode('utf-8'))
+        self.client.logout()
+
+    @override_settings(
+        IMPERSONATE_LIST_FIELDS=['email', 'first_name', 'last_name'])
+    def test_user_listing_only_list_fields(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        self.client.login(username='user1', password='foobar')
+        for path, params in ((reverse('impersonate-list'), {}),
+                             (reverse('impersonate-search'), {'q': 'john'})):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(path, params)
+            user = response.context['page'].object_list[0]
+            self.assertEqual(
+                set(field.attname for field in User._meta.concrete_fields) -
+                user.get_deferred_fields(),
+                set(['id', 'email', 'first_name', 'last_name']),
+            )
+            page_sql = [query['sql'] for query in queries
+                        if 'LIMIT' in query['sql']][-1]
+            self.assertNotIn('"password"', page_sql)
+            self.assertNotIn('"last_login"', page_sql)
+            self.assertIn('"email"', page_sql)
+            self.assertEqual(response.context['users'].count(),
+                             4 if not params else 2)
+        self.client.logout()
+
+        with self.settings(IMPERSONATE_PAGINATION='cursor',
+                           IMPERSONATE_CURSOR_FIELD='username'):
+            self.client.login(username='user1', password='foobar')
+            response = self.client.get(reverse('impersonate-list'))
+            user = response.context['page'].object_list[0]
+            self.assertNotIn('username', user.get_deferred_fields())
+            self.assertIn('password', user.get_deferred_fields())
+            self.client.logout()
+
     def test_user_search_and_pagination(self):
         self.client.login(username='user1', password='foobar')
         response = self.client.get(
@@ -499,6 +2891,94 @@ class TestImpersonation(TestCase):
         self.assertEqual(response.context['users'].count(), 0)
         self.client.logout()
 
+    @override_settings(
+        IMPERSONATE_SEARCH_BACKEND='impersonate.tests.TestSearchBackend')
+    def test_user_search_custom_backend(self):
+        self.client.login(username='user1', password='foobar')
+        response = self.client.get(
+            reverse('impersonate-search'),
+            {'q': 'john'},
+        )
+        self.assertEqual(response.context['users'].count(), 0)
+
+        response = self.client.get(
+            reverse('impersonate-search'),
+            {'q': 'user3'},
+        )
+        self.assertEqual(response.context['users'].count(), 1)
+        self.client.logout()
+
+    def test_search_backend_indexes(self):
+        from django.db import connection
+        from impersonate.search import (PostgresSearchBackend,
+                                        QuerySearchBackend)
+
+        class PostgresConnection(object):
+            vendor = 'postgresql'
+
+        fields = ('username', 'first_name', 'last_name', 'email')
+        for backend_class, count in ((QuerySearchBackend, 4),
+                                     (PostgresSearchBackend, 5)):
+            backend = backend_class(fields, 'icontains')
+            self.assertEqual(backend.get_indexes(connection), [])
+            indexes = backend.get_indexes(PostgresConnection())
+            self.assertEqual(len(indexes), count)
+            self.assertEqual(len(set(index.name for index in indexes)), count)
+
+        backend = QuerySearchBackend(fields, 'exact')
+        self.assertEqual(backend.get_indexes(PostgresConnection()), [])
+
+    def test_search_indexes_command(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+
+        # SQLite, nothing to create
+        with self.assertRaises(CommandError):
+            call_command('impersonate_search_indexes', dry_run=True)
+
+    def test_user_search_json(self):
+        import json
+
+        self.client.login(username='user1', password='foobar')
+        url = reverse('impersonate-search-json')
+        self.assertEqual(url, '/search/json/')
+
+        # Session + auth user + search
+        with self.assertNumQueries(3):
+            response = self.client.get(url, {'q': 'john'})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('max-age=60', response['Cache-Control'])
+        self.assertIn('Cookie', response['Vary'])
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data['query'], 'john')
+        self.assertEqual(data['results'], [
+            {'pk': 1, 'username': 'user1', 'email': 'user1@test-email.com',
+             'name': 'John Smith'},
+            {'pk': 2, 'username': 'user2', 'email': 'user2@test-email.com',
+             'name': 'John Doe'},
+        ])
+
+        response = self.client.get(url, {'q': '  '})
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data['results'], [])
+
+        with self.settings(IMPERSONATE_TYPEAHEAD_LIMIT=3):
+            response = self.client.get(url, {'q': 'user'})
+            data = json.loads(response.content.decode('utf-8'))
+            self.assertEqual([row['pk'] for row in data['results']], [1, 2, 3])
+            self.assertEqual(data['results'][2]['name'], '')
+        self.client.logout()
+
+        # Same permission checks as the search view
+        self.client.login(username='user4', password='foobar')
+        response = self.client.get(url, {'q': 'john'})
+        self.assertEqual(response.status_code, 302)
+        self.client.logout()
+
+        response = self.client.get(url, {'q': 'john'})
+        self._redirect_check(response, '/accounts/login/')
+
     @override_settings(IMPERSONATE_LOOKUP_TYPE='exact')
     def test_user_search_custom_lookup(self):
         self.client.login(username='user1', password='foobar')
@@ -556,6 +3036,56 @@ class TestImpersonation(TestCase):
         self.assertEqual(response.context['redirect'], u'?next=/über/')
         self.client.logout()
 
+    @override_settings(IMPERSONATE_REDIRECT_FIELD_NAME='next')
+    def test_start_urls_render_unchanged(self):
+        ''' The precomputed impersonate_start_url renders exactly like
+            the per-row {% url %} tag it replaced.
+        '''
+        import os
+
+        from django.template import Context, Template
+
+        self.client.login(username='user1', password='foobar')
+        query = {'next': u'/über/?a=1&b=<2>', 'q': 'user'}
+        for name in ('impersonate-list', 'impersonate-search'):
+            response = self.client.get(reverse(name), query)
+            template_name = response.templates[0].name
+            self.assertTrue(response.context['page'].object_list)
+
+            path = os.path.join(
+                os.path.dirname(__file__),
+                'templates',
+                template_name,
+            )
+            with open(path) as fp:
+                source = fp.read()
+            self.assertIn('{{ user.impersonate_start_url }}', source)
+            old_source = source.replace(
+                '{{ user.impersonate_start_url }}',
+                "{% url 'impersonate-start' user.id %}{{ redirect }}",
+            )
+
+            context = Context(response.context.flatten())
+            self.assertEqual(
+                Template(source).render(context),
+                Template(old_source).render(context),
+            )
+            self.assertEqual(
+                response.content.decode('utf-8'),
+                Template(old_source).render(context),
+            )
+        self.client.logout()
+
+    def test_start_url_func(self):
+        from impersonate.helpers import get_start_url_func
+
+        start_url = get_start_url_func()
+        for pk in (1, 12345, 'a b', u'ü/x', '50%'):
+            self.assertEqual(
+                start_url(pk),
+                reverse('impersonate-start', args=[pk]),
+            )
+
     @override_settings(IMPERSONATE_CUSTOM_ALLOW='impersonate.tests.test_allow')
     def test_custom_user_allow_function(self):
         self.client.login(username='user1', password='foobar')
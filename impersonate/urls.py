@@ -1,6 +1,7 @@
 from django.urls import re_path
 
-from .views import impersonate, list_users, search_users, stop_impersonate
+from .views import (impersonate, list_users, search_users, search_users_json,
+                    stop_impersonate)
 
 
 urlpatterns = [
@@ -15,6 +16,9 @@ urlpatterns = [
         search_users,
         {'template': 'impersonate/search_users.html'},
         name='impersonate-search'),
+    re_path(r'^search/json/$',
+        search_users_json,
+        name='impersonate-search-json'),
     re_path(r'^(?P<uid>.+)/$',
         impersonate,
         name='impersonate-start'),
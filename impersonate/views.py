@@ -1,8 +1,12 @@
-from django.shortcuts import get_object_or_404, redirect, render
+from django.http import Http404, JsonResponse
+from django.shortcuts import redirect, render
+from django.utils.cache import patch_cache_control, patch_vary_headers
 
 from . import contexts, logic
-from .decorators import allowed_user_required
-from .helpers import User, get_redir_path
+from .decorators import aallowed_user_required, allowed_user_required
+from .config import get_config
+from .helpers import get_redir_path, sync_to_async
+from .resolvers import aresolve_uid, resolve_uid
 
 
 @allowed_user_required
@@ -17,13 +21,9 @@ def impersonate(request, uid):
         Also store the user's 'starting'/'original' URL so
         we can return them to it.
     '''
-    uid = str(uid).strip()
-    if uid.isdigit():
-        new_user = get_object_or_404(User, pk=uid)
-    elif '@' in uid:
-        new_user = get_object_or_404(User, email=uid)
-    else:
-        new_user = get_object_or_404(User, username=uid)
+    new_user = resolve_uid(uid)
+    if new_user is None:
+        raise Http404('No user matches the given query.')
     logic.stop_impersonate(request)
     logic.impersonate(request, new_user)
     return redirect(get_redir_path(request))
@@ -62,3 +62,61 @@ def search_users(request, template):
         request, search_query)
 
     return render(request, template, search_context)
+
+
+@allowed_user_required
+def search_users_json(request):
+    ''' As-you-type search through the users.
+        Takes the search query from the 'q' GET parameter and returns
+        JSON: {"query": ..., "results": [{"pk", "username", "email",
+        "name"}, ...]}, capped at IMPERSONATE_TYPEAHEAD_LIMIT results.
+    '''
+    search_query = request.GET.get('q', '')
+    response = JsonResponse(
+        contexts.get_typeahead_context(request, search_query)
+    )
+
+    # Results depend on who is asking
+    patch_cache_control(
+        response,
+        private=True,
+        max_age=get_config().typeahead_max_age,
+    )
+    patch_vary_headers(response, ('Cookie',))
+    return response
+
+
+# Async versions of the views above, see impersonate.async_urls
+
+@aallowed_user_required
+async def aimpersonate(request, uid):
+    ''' Async version of impersonate()
+    '''
+    new_user = await aresolve_uid(uid)
+    if new_user is None:
+        raise Http404('No user matches the given query.')
+    await logic.astop_impersonate(request)
+    await logic.aimpersonate(request, new_user)
+    return redirect(get_redir_path(request))
+
+
+async def astop_impersonate(request):
+    ''' Async version of stop_impersonate()
+    '''
+    dest = await logic.astop_impersonate(request)
+    return redirect(dest)
+
+
+@aallowed_user_required
+async def alist_users(request, template):
+    ''' Async version of list_users(). Paginating and rendering the
+        template run sync, so they share a single thread hop.
+    '''
+    return await sync_to_async(list_users.__wrapped__)(request, template)
+
+
+@aallowed_user_required
+async def asearch_users(request, template):
+    ''' Async version of search_users(), see alist_users()
+    '''
+    return await sync_to_async(search_users.__wrapped__)(request, template)